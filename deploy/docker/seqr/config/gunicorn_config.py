@@ -1,6 +1,7 @@
 command = 'gunicorn'
 bind = '0.0.0.0:8000'
 workers = 1
+preload_app = True  # load the app, including liftover chains, once before forking workers so they share memory
 loglevel = 'info'
 timeout = 3600   # seconds (default is 30)
 errorlog = '-'  # '${INSTALL_DIR}/logs/gunicorn-error.log'
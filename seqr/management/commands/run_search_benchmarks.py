@@ -0,0 +1,145 @@
+import logging
+from itertools import combinations, islice
+import random
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models.query_utils import Q
+from elasticsearch_dsl import Search
+
+from seqr.models import Project, Family
+from seqr.utils.elasticsearch.es_search import EsSearch, _get_valid_compound_het_pairs
+from seqr.utils.elasticsearch.utils import SEARCH_RESULTS_CACHE_LIST_FIELDS, get_es_client
+from seqr.utils.redis_utils import REDIS_CODECS, RedisChunkedList, encode_redis_value, decode_redis_value, \
+    safe_redis_get_chunked_json, get_redis_client
+
+logger = logging.getLogger(__name__)
+
+CACHE_CODECS_BENCHMARK = 'cache_codecs'
+HIT_PARSING_BENCHMARK = 'hit_parsing'
+COMPOUND_HET_PAIRS_BENCHMARK = 'compound_het_pairs'
+
+BENCHMARK_GENE_ID = 'ENSG00000000001'
+BENCHMARK_PRIMARY_CONSEQUENCES = ['frameshift_variant', 'stop_gained']
+BENCHMARK_SECONDARY_CONSEQUENCES = ['missense_variant']
+
+
+class Command(BaseCommand):
+    help = 'Benchmark parts of the variant search pipeline'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'benchmark', choices=[CACHE_CODECS_BENCHMARK, HIT_PARSING_BENCHMARK, COMPOUND_HET_PAIRS_BENCHMARK])
+        parser.add_argument('--iterations', type=int, default=5, help='number of times to repeat each measurement')
+        parser.add_argument('--cache-key', action='append', help='cached search results to benchmark on')
+        parser.add_argument('--limit', type=int, default=10, help='max number of cached search results or hits to benchmark on')
+        parser.add_argument('--project', help='project whose variants to benchmark on')
+        parser.add_argument('--baseline-ms', type=float, help='recorded hit parsing time per variant to compare against')
+        parser.add_argument('--gene-size', type=int, default=100, help='number of variants in each synthetic gene')
+        parser.add_argument('--unaffected', type=int, default=2, help='number of unaffected individuals in each synthetic family')
+
+    def handle(self, *args, **options):
+        benchmark = options['benchmark']
+        if benchmark == CACHE_CODECS_BENCHMARK:
+            _benchmark_cache_codecs(options['iterations'], options['cache_key'], options['limit'])
+        elif benchmark == HIT_PARSING_BENCHMARK:
+            if not options['project']:
+                raise CommandError('A project is required for the {} benchmark'.format(HIT_PARSING_BENCHMARK))
+            _benchmark_hit_parsing(options['iterations'], options['project'], options['limit'], options['baseline_ms'])
+        elif benchmark == COMPOUND_HET_PAIRS_BENCHMARK:
+            _benchmark_compound_het_pairs(options['iterations'], options['gene_size'], options['unaffected'])
+
+
+def _benchmark_cache_codecs(iterations, cache_keys, limit):
+    if not cache_keys:
+        # Chunked result lists are stored under their own keys, and are loaded as part of their parent search results
+        list_key_suffixes = tuple('__{}'.format(field) for field in SEARCH_RESULTS_CACHE_LIST_FIELDS)
+        cache_keys = (cache_key.decode('utf-8') for cache_key in get_redis_client().scan_iter(match='search_results__*'))
+        cache_keys = list(islice((
+            cache_key for cache_key in cache_keys if not cache_key.endswith(list_key_suffixes)
+        ), limit))
+
+    payloads = []
+    for cache_key in cache_keys:
+        value = safe_redis_get_chunked_json(cache_key, SEARCH_RESULTS_CACHE_LIST_FIELDS)
+        if value:
+            payloads.append({k: v[:] if isinstance(v, RedisChunkedList) else v for k, v in value.items()})
+    if not payloads:
+        raise CommandError('No cached search results found')
+
+    logger.info('Benchmarking {} codecs on {} cached search results'.format(len(REDIS_CODECS), len(payloads)))
+    for codec in sorted(REDIS_CODECS.keys()):
+        encode_time, encoded = _time_iterations(lambda: [encode_redis_value(p, codec=codec) for p in payloads], iterations)
+        decode_time, _ = _time_iterations(lambda: [decode_redis_value(value) for value in encoded], iterations)
+        logger.info('{codec}: {size} bytes, {encode:.1f} ms to encode, {decode:.1f} ms to decode'.format(
+            codec=codec, size=sum(len(value) for value in encoded), encode=encode_time, decode=decode_time,
+        ))
+
+
+def _benchmark_hit_parsing(iterations, project_name, limit, baseline_ms):
+    project = Project.objects.get(Q(name=project_name) | Q(guid=project_name))
+    es_search = EsSearch(Family.objects.filter(project=project))
+    raw_hits = list(Search(using=get_es_client(), index=es_search.index_name)[:limit].execute())
+    if not raw_hits:
+        raise CommandError(u'No variants found for {}'.format(project.name))
+
+    logger.info('Benchmarking hit parsing on {} variants from {}'.format(len(raw_hits), es_search.index_name))
+    batch_time, _ = _time_iterations(lambda: es_search._parse_hits(raw_hits), iterations)
+    per_variant_time = batch_time / len(raw_hits)
+    if baseline_ms:
+        # Baseline timings are recorded by running this benchmark on an earlier release against the same variants
+        logger.info('batch: {:.3f} ms per variant, baseline: {:.3f} ms per variant ({:.1f}x)'.format(
+            per_variant_time, baseline_ms, baseline_ms / per_variant_time if per_variant_time else 0))
+    else:
+        logger.info('batch: {:.3f} ms per variant'.format(per_variant_time))
+
+
+def _benchmark_compound_het_pairs(iterations, gene_size, num_unaffected):
+    # Use a fixed seed so runs are comparable
+    rand = random.Random(0)
+    unaffected_individual_guids = ['I{}_unaffected'.format(i) for i in range(num_unaffected)]
+    variants = [{
+        'variantId': str(i),
+        'genotypes': {
+            individual_guid: {'numAlt': rand.choice([0, 0, 1, 2])} for individual_guid in unaffected_individual_guids
+        },
+        'gene_consequences': {BENCHMARK_GENE_ID: [
+            rand.choice(BENCHMARK_PRIMARY_CONSEQUENCES + BENCHMARK_SECONDARY_CONSEQUENCES + ['synonymous_variant'])
+        ]},
+    } for i in range(gene_size)]
+
+    logger.info('Benchmarking compound het pairs for a gene with {} variants and {} unaffected individuals'.format(
+        gene_size, num_unaffected))
+    pairwise_time, pairwise_results = _time_iterations(lambda: _get_pairwise_compound_het_pairs(
+        variants, unaffected_individual_guids), iterations)
+    bitmask_time, bitmask_results = _time_iterations(lambda: _get_valid_compound_het_pairs(
+        BENCHMARK_GENE_ID, variants, unaffected_individual_guids, BENCHMARK_PRIMARY_CONSEQUENCES,
+        BENCHMARK_SECONDARY_CONSEQUENCES), iterations)
+    if pairwise_results != bitmask_results:
+        raise CommandError('Bitmask compound het pairs do not match the pairwise compound het pairs')
+    logger.info('{} valid pairs. pairwise: {:.1f} ms, bitmask: {:.1f} ms'.format(
+        len(bitmask_results), pairwise_time, bitmask_time))
+
+
+def _get_pairwise_compound_het_pairs(variants, unaffected_individual_guids):
+    """Reference implementation which checks the genotypes and consequences of every pair of variants"""
+    def _is_valid_compound_het_pair(variant_1, variant_2):
+        for individual_guid in unaffected_individual_guids:
+            genotypes = [variant['genotypes'].get(individual_guid, {'isRef': True}) for variant in [variant_1, variant_2]]
+            if not any(genotype.get('numAlt') == 0 or genotype.get('isRef') for genotype in genotypes):
+                return False
+        consequences = variant_1['gene_consequences'][BENCHMARK_GENE_ID] + \
+            variant_2['gene_consequences'][BENCHMARK_GENE_ID]
+        return any(consequence in BENCHMARK_PRIMARY_CONSEQUENCES for consequence in consequences) and any(
+            consequence in BENCHMARK_SECONDARY_CONSEQUENCES for consequence in consequences)
+
+    return [[variant_1, variant_2] for variant_1, variant_2 in combinations(variants, 2)
+            if _is_valid_compound_het_pair(variant_1, variant_2)]
+
+
+def _time_iterations(func, iterations):
+    """Returns the mean run time in milliseconds and the result of the last run"""
+    result = None
+    start = time.time()
+    for _ in range(iterations):
+        result = func()
+    return (time.time() - start) * 1000 / iterations, result
@@ -4,7 +4,7 @@ import __builtin__
 from copy import deepcopy
 from django.core.management.base import CommandError
 from seqr.models import Family
-from pyliftover.liftover import LiftOver
+from seqr.utils.liftover_utils import BatchLiftOver
 from seqr.views.utils.test_utils import VARIANTS, SINGLE_VARIANT
 
 from django.core.management import call_command
@@ -22,8 +22,6 @@ INDEX_METADATA = {
 }
 SAMPLE_IDS = ["NA19679", "NA19675_1", "NA19678", "HG00731", "HG00732", "HG00733"]
 
-liftover_to_38 = LiftOver('hg19', 'hg38')
-
 LIFT_MAP = {
     21003343353L: [('chr21', 3343400)],
     1248367227L: [('chr1', 248203925)],
@@ -44,11 +42,12 @@ class LiftProjectToHg38Test(TestCase):
 
     @mock.patch.object(__builtin__, 'raw_input')
     @mock.patch('seqr.management.commands.lift_project_to_hg38.get_es_variants_for_variant_tuples')
-    @mock.patch('seqr.management.commands.lift_project_to_hg38.LiftOver')
-    def test_command(self, mock_liftover, mock_get_es_variants, mock_input, mock_get_es_samples, mock_logger):
+    @mock.patch('seqr.management.commands.lift_project_to_hg38.get_liftover')
+    def test_command(self, mock_get_liftover, mock_get_es_variants, mock_input, mock_get_es_samples, mock_logger):
         mock_get_es_samples.return_value = SAMPLE_IDS, INDEX_METADATA
         mock_get_es_variants.return_value = VARIANTS
-        mock_liftover_to_38 = mock_liftover.return_value
+        mock_liftover_to_38 = mock.MagicMock()
+        mock_get_liftover.side_effect = lambda genome_version, **kwargs: BatchLiftOver(mock_liftover_to_38)
         mock_liftover_to_38.convert_coordinate.side_effect = mock_convert_coordinate
         mock_input.return_value = 'y'
         call_command('lift_project_to_hg38', u'--project={}'.format(PROJECT_NAME),
@@ -151,13 +150,14 @@ class LiftProjectToHg38Test(TestCase):
     @mock.patch.object(__builtin__, 'raw_input')
     @mock.patch('seqr.management.commands.lift_project_to_hg38.get_es_variants_for_variant_tuples')
     @mock.patch('seqr.management.commands.lift_project_to_hg38.get_single_es_variant')
-    @mock.patch('seqr.management.commands.lift_project_to_hg38.LiftOver')
-    def test_command_other_exceptions(self, mock_liftover, mock_single_es_variants,
+    @mock.patch('seqr.management.commands.lift_project_to_hg38.get_liftover')
+    def test_command_other_exceptions(self, mock_get_liftover, mock_single_es_variants,
             mock_get_es_variants, mock_input, mock_get_es_samples, mock_logger):
         mock_get_es_samples.return_value = SAMPLE_IDS, INDEX_METADATA
 
         # Test discontinue on a failed lift
-        mock_liftover_to_38 = mock_liftover.return_value
+        mock_liftover_to_38 = mock.MagicMock()
+        mock_get_liftover.side_effect = lambda genome_version, **kwargs: BatchLiftOver(mock_liftover_to_38)
         mock_liftover_to_38.convert_coordinate.return_value = None
         mock_input.return_value = 'n'
         with self.assertRaises(CommandError) as ce:
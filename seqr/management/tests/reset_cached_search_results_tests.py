@@ -5,44 +5,54 @@ import mock
 from django.core.management import call_command
 from django.test import TestCase
 
-from seqr.models import Family, VariantSearchResults
 
 PROJECT_NAME = '1kg project n\u00e5me with uni\u00e7\u00f8de'
 EMPTY_PROJECT_NAME = 'Empty Project'
 
 
 class ResetCachedSearchResultsTest(TestCase):
-    fixtures = ['users', '1kg_project', 'variant_searches']
+    fixtures = ['users', '1kg_project']
 
-    @classmethod
-    def setUpTestData(cls):
-        result = VariantSearchResults.objects.create(search_hash='abc', variant_search_id=1)
-        result.families.set(Family.objects.filter(pk=1))
-        cls.result_guid = result.guid
-
-    @mock.patch('seqr.views.utils.variant_utils.redis.StrictRedis')
+    @mock.patch('seqr.utils.redis_utils.redis.StrictRedis')
     @mock.patch('seqr.views.utils.variant_utils.logger')
     @mock.patch('seqr.management.commands.reset_cached_search_results.logger')
     def test_command(self, mock_command_logger, mock_utils_logger, mock_redis):
-        mock_redis.return_value.keys.side_effect = lambda pattern: [pattern]
+        indexed_keys = {
+            'project_search_results__R0001_1kg': [
+                'search_results__abc__xpos', 'search_results__abc__xpos__all_results', 'search_results__def__xpos',
+            ],
+        }
+        mock_redis.return_value.pipeline.return_value.execute.side_effect = lambda: [
+            indexed_keys.get(call_args[0][0], []) for call_args in mock_redis.return_value.pipeline.return_value.zrange.call_args_list
+        ]
+        mock_redis.return_value.scan_iter.side_effect = lambda match: [match]
 
         # Test command with a --project argument
         call_command('reset_cached_search_results', '--project={}'.format(PROJECT_NAME))
-        mock_redis.return_value.delete.assert_called_with('search_results__{}*'.format(self.result_guid))
-        mock_utils_logger.info.assert_called_with('Reset 1 cached results')
+        mock_redis.return_value.pipeline.return_value.zrange.assert_called_with('project_search_results__R0001_1kg', 0, -1)
+        mock_redis.return_value.delete.assert_called_with(
+            'search_results__abc__xpos', 'search_results__abc__xpos__all_results', 'search_results__def__xpos',
+            'project_search_results__R0001_1kg',
+        )
+        mock_redis.return_value.scan_iter.assert_not_called()
+        mock_utils_logger.info.assert_called_with('Reset 3 cached results')
         mock_command_logger.info.assert_called_with('Reset cached search results for {}'.format(PROJECT_NAME))
 
         # Test for empty project
         mock_redis.reset_mock()
         call_command('reset_cached_search_results', '--project={}'.format(EMPTY_PROJECT_NAME))
-        mock_redis.return_value.delete.assert_not_called()
+        mock_redis.return_value.pipeline.return_value.zrange.assert_called_with('project_search_results__R0002_empty', 0, -1)
+        mock_redis.return_value.delete.assert_called_with('project_search_results__R0002_empty')
         mock_utils_logger.info.assert_called_with('No cached results to reset')
         mock_command_logger.info.assert_called_with('Reset cached search results for {}'.format(EMPTY_PROJECT_NAME))
 
         # Test command without any arguments
         mock_redis.reset_mock()
         call_command('reset_cached_search_results')
-        mock_redis.return_value.delete.assert_called_with('search_results__*')
+        mock_redis.return_value.scan_iter.assert_has_calls([
+            mock.call(match='search_results__*'), mock.call(match='project_search_results__*'),
+        ])
+        mock_redis.return_value.delete.assert_called_with('search_results__*', 'project_search_results__*')
         mock_utils_logger.info.assert_called_with('Reset 1 cached results')
         mock_command_logger.info.assert_called_with('Reset cached search results for all projects')
 
@@ -0,0 +1,119 @@
+import json
+import mock
+import redis
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+
+from seqr.models import Family
+from seqr.utils.redis_utils import encode_redis_value
+
+CACHED_RESULTS = {'all_results': [{'variantId': '1-248367227-TC-T', 'genotypes': {}}], 'total_results': 1}
+
+
+@mock.patch('seqr.management.commands.run_search_benchmarks.logger')
+@mock.patch('seqr.utils.redis_utils.redis.StrictRedis')
+class RunSearchBenchmarksTest(TestCase):
+    fixtures = ['users', '1kg_project']
+
+    def test_cache_codecs_benchmark(self, mock_redis, mock_logger):
+        cache = {
+            b'search_results__abc__xpos': json.dumps(CACHED_RESULTS),
+            b'search_results__def__xpos': {
+                b'total_results': b'1',
+                b'__chunked_lists': json.dumps({'all_results': {'length': 1, 'chunkSize': 100}}).encode('utf-8'),
+            },
+            b'search_results__def__xpos__all_results': [encode_redis_value(CACHED_RESULTS['all_results'], codec='zlib')],
+        }
+
+        def _hgetall(key):
+            if not isinstance(cache.get(key), dict):
+                raise redis.ResponseError('WRONGTYPE')
+            return cache[key]
+
+        queued_commands = []
+
+        def _execute():
+            commands = queued_commands[:]
+            del queued_commands[:]
+            return [command() for command in commands]
+
+        mock_redis = mock_redis.return_value
+        mock_redis.get.side_effect = cache.get
+        mock_redis.lrange.side_effect = lambda key, start, end: cache[key][start:end + 1]
+        mock_pipeline = mock_redis.pipeline.return_value
+        mock_pipeline.hgetall.side_effect = lambda key: queued_commands.append(lambda: _hgetall(key))
+        mock_pipeline.llen.side_effect = lambda key: queued_commands.append(lambda: len(cache.get(key, [])))
+        mock_pipeline.execute.side_effect = _execute
+        mock_redis.scan_iter.return_value = iter(sorted(cache.keys()))
+
+        call_command('run_search_benchmarks', 'cache_codecs', '--iterations=2')
+        mock_redis.scan_iter.assert_called_with(match='search_results__*')
+        mock_logger.info.assert_has_calls([
+            mock.call('Benchmarking 2 codecs on 2 cached search results'),
+            mock.call(mock.ANY), mock.call(mock.ANY),
+        ])
+        self.assertRegexpMatches(mock_logger.info.call_args_list[1][0][0], r'^json: \d+ bytes, [\d.]+ ms to encode')
+        self.assertRegexpMatches(mock_logger.info.call_args_list[2][0][0], r'^zlib: \d+ bytes, [\d.]+ ms to encode')
+
+        # Test with specific cache keys
+        mock_logger.reset_mock()
+        call_command('run_search_benchmarks', 'cache_codecs', '--cache-key=search_results__abc__xpos')
+        mock_logger.info.assert_any_call('Benchmarking 2 codecs on 1 cached search results')
+
+        with self.assertRaises(CommandError) as ce:
+            call_command('run_search_benchmarks', 'cache_codecs', '--cache-key=search_results__missing__xpos')
+        self.assertEqual(str(ce.exception), 'No cached search results found')
+
+    @mock.patch('seqr.management.commands.run_search_benchmarks.get_es_client')
+    @mock.patch('seqr.management.commands.run_search_benchmarks.Search')
+    @mock.patch('seqr.management.commands.run_search_benchmarks.EsSearch')
+    def test_hit_parsing_benchmark(self, mock_es_search, mock_search, mock_get_es_client, mock_redis, mock_logger):
+        with self.assertRaises(CommandError) as ce:
+            call_command('run_search_benchmarks', 'hit_parsing')
+        self.assertEqual(str(ce.exception), 'A project is required for the hit_parsing benchmark')
+
+        mock_es_search.return_value.index_name = 'test_index'
+        mock_es_search.return_value._parse_hits.side_effect = lambda hits: [{'variantId': hit} for hit in hits]
+        mock_search.return_value.__getitem__.return_value.execute.return_value = ['hit1', 'hit2']
+
+        call_command('run_search_benchmarks', 'hit_parsing', '--project=R0001_1kg', '--limit=2', '--iterations=2')
+        mock_search.assert_called_with(using=mock_get_es_client.return_value, index='test_index')
+        mock_search.return_value.__getitem__.assert_called_with(slice(None, 2, None))
+        self.assertSetEqual(
+            {family.guid for family in mock_es_search.call_args[0][0]},
+            {family.guid for family in Family.objects.filter(project__guid='R0001_1kg')})
+        mock_es_search.return_value._parse_hits.assert_called_with(['hit1', 'hit2'])
+        self.assertEqual(mock_es_search.return_value._parse_hits.call_count, 2)
+        mock_logger.info.assert_has_calls([
+            mock.call('Benchmarking hit parsing on 2 variants from test_index'), mock.call(mock.ANY),
+        ])
+        self.assertRegexpMatches(mock_logger.info.call_args_list[1][0][0], r'^batch: [\d.]+ ms per variant$')
+
+        # Test comparing against a recorded baseline
+        mock_logger.reset_mock()
+        call_command('run_search_benchmarks', 'hit_parsing', '--project=R0001_1kg', '--baseline-ms=1.5')
+        self.assertRegexpMatches(
+            mock_logger.info.call_args_list[1][0][0],
+            r'^batch: [\d.]+ ms per variant, baseline: 1.500 ms per variant \([\d.]+x\)$')
+
+        mock_search.return_value.__getitem__.return_value.execute.return_value = []
+        with self.assertRaises(CommandError) as ce:
+            call_command('run_search_benchmarks', 'hit_parsing', '--project=R0001_1kg')
+        self.assertEqual(ce.exception.message, u'No variants found for 1kg project n\xe5me with uni\xe7\xf8de')
+
+    def test_compound_het_pairs_benchmark(self, mock_redis, mock_logger):
+        call_command('run_search_benchmarks', 'compound_het_pairs', '--gene-size=50', '--unaffected=3', '--iterations=1')
+        mock_logger.info.assert_has_calls([
+            mock.call('Benchmarking compound het pairs for a gene with 50 variants and 3 unaffected individuals'),
+            mock.call(mock.ANY),
+        ])
+        self.assertRegexpMatches(
+            mock_logger.info.call_args_list[1][0][0], r'^\d+ valid pairs. pairwise: [\d.]+ ms, bitmask: [\d.]+ ms$')
+
+        with mock.patch('seqr.management.commands.run_search_benchmarks._get_valid_compound_het_pairs') as mock_pairs:
+            mock_pairs.return_value = []
+            with self.assertRaises(CommandError) as ce:
+                call_command('run_search_benchmarks', 'compound_het_pairs', '--iterations=1')
+        self.assertEqual(str(ce.exception), 'Bitmask compound het pairs do not match the pairwise compound het pairs')
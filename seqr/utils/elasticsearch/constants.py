@@ -8,7 +8,10 @@ VARIANT_DOC_TYPE = 'variant'
 SV_DOC_TYPE = 'structural_variant'
 MAX_VARIANTS = 10000
 MAX_COMPOUND_HET_GENES = 1000
+COMPOUND_HET_GENES_PAGE_SIZE = 1000
 MAX_INDEX_NAME_LENGTH = 7500
+# Max inner hits returned for a nested query, which is the default ES index.max_inner_result_window
+MAX_GENOTYPE_INNER_HITS = 100
 
 XPOS_SORT_KEY = 'xpos'
 
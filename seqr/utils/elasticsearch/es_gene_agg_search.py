@@ -56,7 +56,7 @@ class EsGeneAggSearch(EsSearch):
 
         return gene_aggs
 
-    def _parse_response(self, response):
+    def _parse_response(self, response, search, **kwargs):
         if len(response.aggregations.genes.buckets) > MAX_COMPOUND_HET_GENES:
             raise Exception('This search returned too many genes')
 
@@ -96,7 +96,7 @@ class EsGeneAggSearch(EsSearch):
                     gene_counts[gene_id]['families'][family_guid] += len(variants)
 
     @classmethod
-    def process_previous_results(cls, previous_search_results, page=1, num_results=100, load_all=False):
+    def process_previous_results(cls, previous_search_results, page=1, num_results=100):
         if previous_search_results.get('gene_aggs'):
             return previous_search_results['gene_aggs'], {}
 
@@ -1,22 +1,26 @@
-from collections import defaultdict
-from copy import deepcopy
+from bisect import bisect_right
+from collections import defaultdict, namedtuple
 import elasticsearch
-from elasticsearch_dsl import Search, Q, MultiSearch
+from elasticsearch_dsl import Search, Q, A, MultiSearch
 import hashlib
+import heapq
 import json
 import logging
-from pyliftover.liftover import LiftOver
 from sys import maxsize
-from itertools import combinations
+from itertools import takewhile
 
 from reference_data.models import GENOME_VERSION_GRCh38, GENOME_VERSION_GRCh37
+from settings import REDIS_INDEX_ALIAS_TTL, REDIS_INDEX_METADATA_TTL, ELASTICSEARCH_SEARCH_THREADS, \
+    ELASTICSEARCH_INDEX_SEARCH_TIMEOUT
 from seqr.models import Sample, Individual
 from seqr.utils.elasticsearch.constants import XPOS_SORT_KEY, COMPOUND_HET, RECESSIVE, X_LINKED_RECESSIVE, \
     HAS_ALT_FIELD_KEYS, GENOTYPES_FIELD_KEY, GENOTYPE_FIELDS_CONFIG, POPULATION_RESPONSE_FIELD_CONFIGS, POPULATIONS, \
     SORTED_TRANSCRIPTS_FIELD_KEY, CORE_FIELDS_CONFIG, NESTED_FIELDS, PREDICTION_FIELDS_CONFIG, INHERITANCE_FILTERS, \
     QUERY_FIELD_NAMES, REF_REF, ANY_AFFECTED, GENOTYPE_QUERY_MAP, CLINVAR_SIGNFICANCE_MAP, HGMD_CLASS_MAP, \
-    SORT_FIELDS, MAX_VARIANTS, MAX_COMPOUND_HET_GENES, MAX_INDEX_NAME_LENGTH, SV_DOC_TYPE, QUALITY_FIELDS
-from seqr.utils.redis_utils import safe_redis_get_json, safe_redis_set_json
+    SORT_FIELDS, MAX_VARIANTS, COMPOUND_HET_GENES_PAGE_SIZE, MAX_INDEX_NAME_LENGTH, SV_DOC_TYPE, QUALITY_FIELDS, \
+    MAX_GENOTYPE_INNER_HITS
+from seqr.utils.liftover_utils import get_liftover
+from seqr.utils.redis_utils import safe_redis_get_json, safe_redis_set_json, safe_redis_mget_json, safe_redis_mset_json
 from seqr.utils.xpos_utils import get_xpos
 from seqr.views.utils.json_utils import _to_camel_case
 
@@ -27,16 +31,29 @@ class EsSearch(object):
 
     AGGREGATION_NAME = 'compound het'
     CACHED_COUNTS_KEY = 'loaded_variant_counts'
+    REMAINING_RESULTS_KEY = 'remaining_results_by_index'
+    SEARCH_CURSORS_KEY = 'search_cursors'
+    SAMPLE_TOPOLOGY_KEY = 'sample_topology'
 
     def __init__(self, families, previous_search_results=None, skip_unaffected_families=False,
-                 return_all_queried_families=False):
+                 return_all_queried_families=False, wait_for_liftover=False):
         from seqr.utils.elasticsearch.utils import get_es_client, InvalidIndexException
         self._client = get_es_client()
 
+        self.previous_search_results = previous_search_results or {}
+
+        # The sample topology is cached with the search results, so subsequent pages do not need to load any samples
+        sample_topology = self.previous_search_results.get(self.SAMPLE_TOPOLOGY_KEY)
+        if sample_topology is None:
+            sample_topology = _get_sample_topology(families)
+            self.previous_search_results[self.SAMPLE_TOPOLOGY_KEY] = sample_topology
+
         self.samples_by_family_index = defaultdict(lambda: defaultdict(dict))
-        samples = Sample.objects.filter(is_active=True, individual__family__in=families)
-        for s in samples.select_related('individual__family'):
-            self.samples_by_family_index[s.elasticsearch_index][s.individual.family.guid][s.sample_id] = s
+        for index, family_samples in sample_topology.items():
+            for family_guid, samples_by_id in family_samples.items():
+                for sample_id, (individual_guid, affected, sex) in samples_by_id.items():
+                    self.samples_by_family_index[index][family_guid][sample_id] = SearchSample(
+                        sample_id, individual_guid, affected, sex)
 
         if len(self.samples_by_family_index) < 1:
             raise InvalidIndexException('No es index found')
@@ -47,7 +64,7 @@ class EsSearch(object):
                 index_skipped_families = []
                 for family_guid, samples_by_id in family_samples.items():
                     affected_samples = [
-                        s for s in samples_by_id.values() if s.individual.affected == Individual.AFFECTED_STATUS_AFFECTED
+                        s for s in samples_by_id.values() if s.affected == Individual.AFFECTED_STATUS_AFFECTED
                     ]
                     if not affected_samples:
                         index_skipped_families.append(family_guid)
@@ -76,9 +93,13 @@ class EsSearch(object):
             dataset_type = self.index_metadata[index].get('datasetType', Sample.DATASET_TYPE_VARIANT_CALLS)
             self.indices_by_dataset_type[dataset_type].append(index)
 
-        self.previous_search_results = previous_search_results or {}
         self._return_all_queried_families = return_all_queried_families
 
+        # Requests do not wait for the liftover chains to load, so results parsed before then are missing the lifted over
+        # coordinates and should not be cached
+        self._wait_for_liftover = wait_for_liftover
+        self.missing_liftover = False
+
         self._search = Search()
         self._index_searches = defaultdict(list)
         self._sort = None
@@ -88,23 +109,55 @@ class EsSearch(object):
         self._no_sample_filters = False
         self._any_affected_sample_filters = False
         self._family_individual_affected_status = {}
-
-    def _set_index_name(self):
+        self._index_field_parsers = {}
+        self._search_cursor_requests = {}
+        self._skipped_compound_het_filters = False
+
+    def _set_index_name(self, cached_values=None, values_to_cache=None):
+        """
+        Sets the name used to search the current indices, which is an alias if the joined index names are too long.
+        Aliases are looked up in the given cached values if provided, and new aliases are added to values_to_cache by
+        expiry time if provided, instead of being cached individually
+        """
         self.index_name = ','.join(sorted(self._indices))
         if len(self.index_name) > MAX_INDEX_NAME_LENGTH:
-            alias = hashlib.md5(self.index_name).hexdigest()
-            cache_key = 'index_alias__{}'.format(alias)
-            if safe_redis_get_json(cache_key) != self.index_name:
+            alias = _get_index_alias(self.index_name)
+            cache_key = _get_index_alias_cache_key(alias)
+            cached_index_name = cached_values.get(cache_key) if cached_values is not None else \
+                safe_redis_get_json(cache_key)
+            if cached_index_name != self.index_name:
                 self._client.indices.update_aliases(body={'actions': [
                     {'add': {'indices': self._indices, 'alias': alias}}
                 ]})
-                safe_redis_set_json(cache_key, self.index_name)
+                if values_to_cache is not None:
+                    values_to_cache[REDIS_INDEX_ALIAS_TTL][cache_key] = self.index_name
+                else:
+                    safe_redis_set_json(cache_key, self.index_name, expire=REDIS_INDEX_ALIAS_TTL)
             self.index_name = alias
 
     def _set_index_metadata(self):
-        self._set_index_name()
-        from seqr.utils.elasticsearch.utils import get_index_metadata
-        self.index_metadata = get_index_metadata(self.index_name, self._client)
+        from seqr.utils.elasticsearch.utils import get_index_metadata_cache_key, load_index_metadata
+
+        # The alias and metadata cache keys are known before either is loaded, so they are fetched from redis in a
+        # single round trip, and any values which need to be cached are written in a single round trip
+        index_name = ','.join(sorted(self._indices))
+        if len(index_name) > MAX_INDEX_NAME_LENGTH:
+            alias = _get_index_alias(index_name)
+            cache_keys = [_get_index_alias_cache_key(alias), get_index_metadata_cache_key(alias)]
+        else:
+            cache_keys = [get_index_metadata_cache_key(index_name)]
+        cached_values = safe_redis_mget_json(cache_keys)
+
+        values_to_cache = defaultdict(dict)
+        self._set_index_name(cached_values=cached_values, values_to_cache=values_to_cache)
+        metadata_cache_key = get_index_metadata_cache_key(self.index_name)
+        self.index_metadata = cached_values.get(metadata_cache_key)
+        if not self.index_metadata:
+            self.index_metadata = load_index_metadata(self.index_name, self._client)
+            values_to_cache[REDIS_INDEX_METADATA_TTL][metadata_cache_key] = self.index_metadata
+
+        for expire, values in values_to_cache.items():
+            safe_redis_mset_json(values, expire=expire)
 
     def update_dataset_type(self, dataset_type, keep_previous=False):
         new_indices = self.indices_by_dataset_type[dataset_type]
@@ -125,15 +178,68 @@ class EsSearch(object):
         self._search = self._search.filter(new_filter)
         return self
 
+    def get_query_plan(self):
+        """
+        Returns the compiled searches and filter state for this search as json, so later requests for the same search can
+        load them instead of rebuilding them. The plan does not include the sort, so it can be used with any sort.
+        Returns None if the plan is incomplete because compound hets were already loaded or the liftover chain was not
+        available to lift over the searched variant ids
+        """
+        if self._skipped_compound_het_filters or self.missing_liftover:
+            return None
+        return {
+            'indices': sorted(self._indices),
+            'search': _get_query_plan_search(self._search),
+            'index_searches': {
+                index: [_get_query_plan_search(search) for search in searches]
+                for index, searches in self._index_searches.items()
+            },
+            'allowed_consequences': self._allowed_consequences,
+            'allowed_consequences_secondary': self._allowed_consequences_secondary,
+            'filtered_variant_ids': self._filtered_variant_ids,
+            'no_sample_filters': self._no_sample_filters,
+            'any_affected_sample_filters': self._any_affected_sample_filters,
+            'family_individual_affected_status': self._family_individual_affected_status,
+        }
+
+    def load_query_plan(self, query_plan):
+        """
+        Loads a plan from get_query_plan in place of applying the search filters. The sort should be set first
+        """
+        self._indices = query_plan['indices']
+        self._set_index_name()
+
+        self._search = self._get_query_plan_search(query_plan['search'])
+        has_previous_compound_hets = self.previous_search_results.get('grouped_results')
+        for index, plan_searches in query_plan['index_searches'].items():
+            searches = [
+                self._get_query_plan_search(plan_search) for plan_search in plan_searches
+                if not (plan_search['compound_het'] and has_previous_compound_hets)
+            ]
+            if searches:
+                self._index_searches[index] = searches
+
+        self._allowed_consequences = query_plan['allowed_consequences']
+        self._allowed_consequences_secondary = query_plan['allowed_consequences_secondary']
+        self._filtered_variant_ids = query_plan['filtered_variant_ids']
+        self._no_sample_filters = query_plan['no_sample_filters']
+        self._any_affected_sample_filters = query_plan['any_affected_sample_filters']
+        self._family_individual_affected_status = query_plan['family_individual_affected_status']
+        return self
+
+    def _get_query_plan_search(self, plan_search):
+        search = Search.from_dict(plan_search['query'])
+        if self._sort:
+            search = search.sort(*self._sort)
+        if plan_search['compound_het']:
+            self._add_compound_het_gene_aggs(search)
+        return search
+
     def filter_by_frequency(self, frequencies):
         q = Q()
         for pop, freqs in frequencies.items():
             if freqs.get('af') is not None:
-                filter_field = next(
-                    (field_key for field_key in POPULATIONS[pop]['filter_AF']
-                     if any(field_key in index_metadata['fields'] for index_metadata in self.index_metadata.values())),
-                    POPULATIONS[pop]['AF'])
-                q &= _pop_freq_filter(filter_field, freqs['af'])
+                q &= _pop_freq_filter(self._get_pop_af_filter_field(pop), freqs['af'])
             elif freqs.get('ac') is not None:
                 q &= _pop_freq_filter(POPULATIONS[pop]['AC'], freqs['ac'])
 
@@ -142,6 +248,55 @@ class EsSearch(object):
                 q &= _pop_freq_filter(POPULATIONS[pop]['Hemi'], freqs['hh'])
         self.filter(q)
 
+    def filter_results_by_frequency(self, frequencies, results, grouped=False):
+        """
+        Filters already loaded variants, or grouped compound het results, with the same filters applied by
+        filter_by_frequency. Groups are only kept if all their variants pass the filters.
+        Returns None if the filters can not be exactly applied to the parsed variants
+        """
+        pop_filters = []
+        for pop, freqs in frequencies.items():
+            if freqs.get('af') is not None:
+                af_field = self._get_pop_af_filter_field(pop)
+                pop_filters.append((
+                    pop, 'filter_AF' if af_field in POPULATIONS[pop]['filter_AF'] else 'AF', af_field, freqs['af']))
+            elif freqs.get('ac') is not None:
+                pop_filters.append((pop, 'AC', POPULATIONS[pop]['AC'], freqs['ac']))
+
+            if freqs.get('hh') is not None:
+                pop_filters += [
+                    (pop, 'Hom', POPULATIONS[pop]['Hom'], freqs['hh']), (pop, 'Hemi', POPULATIONS[pop]['Hemi'], freqs['hh'])]
+
+        indices_fields = [index_metadata['fields'] for index_metadata in self.index_metadata.values()]
+        for pop, pop_field, filter_field, _ in pop_filters:
+            # Parsed variants do not include which index they are from, so if the filter field is missing from some
+            # indices it is not possible to tell which variants the ES filter would have skipped
+            if any(filter_field not in fields for fields in indices_fields):
+                return None
+            # Parsed values are taken from the first of their lookup fields present in each hit, so if any other lookup
+            # field is present a parsed value may not be from the field ES filters on
+            lookup_fields = POPULATIONS[pop][pop_field] if isinstance(POPULATIONS[pop][pop_field], list) else \
+                [POPULATIONS[pop][pop_field]]
+            other_fields = set(lookup_fields + ['{}_{}'.format(pop, pop_field)]) - {filter_field}
+            if any(field in fields for field in other_fields for fields in indices_fields):
+                return None
+        pop_filters = [(pop, pop_field.lower(), value) for pop, pop_field, _, value in pop_filters]
+
+        def _is_valid_variant(variant):
+            # Variants missing a frequency field pass the ES filter, and are parsed with a missing or default value
+            return all(variant['populations'][pop][key] is None or variant['populations'][pop][key] <= value
+                       for pop, key, value in pop_filters)
+
+        if grouped:
+            return [group for group in results if all(_is_valid_variant(variant) for variant in group.values()[0])]
+        return [variant for variant in results if _is_valid_variant(variant)]
+
+    def _get_pop_af_filter_field(self, pop):
+        return next(
+            (field_key for field_key in POPULATIONS[pop]['filter_AF']
+             if any(field_key in index_metadata['fields'] for index_metadata in self.index_metadata.values())),
+            POPULATIONS[pop]['AF'])
+
     def filter_by_annotations(self, annotations, pathogenicity_filter):
         consequences_filter, allowed_consequences = _annotations_filter(annotations or {})
         if allowed_consequences:
@@ -161,14 +316,16 @@ class EsSearch(object):
         variant_id_genome_versions = {variant_id: genome_version for variant_id in variant_ids or []}
         if variant_id_genome_versions and genome_version:
             lifted_genome_version = GENOME_VERSION_GRCh37 if genome_version == GENOME_VERSION_GRCh38 else GENOME_VERSION_GRCh38
-            liftover = _liftover_grch38_to_grch37() if genome_version == GENOME_VERSION_GRCh38 else _liftover_grch37_to_grch38()
-            if liftover:
-                for variant_id in deepcopy(variant_ids):
-                    chrom, pos, ref, alt = self.parse_variant_id(variant_id)
-                    lifted_coord = liftover.convert_coordinate('chr{}'.format(chrom), pos)
-                    if lifted_coord and lifted_coord[0]:
+            liftover = get_liftover(genome_version, wait=self._wait_for_liftover)
+            if not liftover:
+                self.missing_liftover = True
+            else:
+                parsed_variant_ids = [self.parse_variant_id(variant_id) for variant_id in variant_ids]
+                lifted_coords = liftover.lift_coordinates([(chrom, pos) for chrom, pos, _, _ in parsed_variant_ids])
+                for (_, _, ref, alt), lifted_coord in zip(parsed_variant_ids, lifted_coords):
+                    if lifted_coord:
                         lifted_variant_id = '{chrom}-{pos}-{ref}-{alt}'.format(
-                            chrom=lifted_coord[0][0].lstrip('chr'), pos=lifted_coord[0][1], ref=ref, alt=alt
+                            chrom=lifted_coord[0], pos=lifted_coord[1], ref=ref, alt=alt
                         )
                         variant_id_genome_versions[lifted_variant_id] = lifted_genome_version
                         variant_ids.append(lifted_variant_id)
@@ -210,12 +367,15 @@ class EsSearch(object):
 
         quality_filters_by_family = _quality_filters_by_family(quality_filter, self.samples_by_family_index, self._indices)
 
-        if inheritance_mode in {RECESSIVE, COMPOUND_HET} and not has_previous_compound_hets:
-            if secondary_dataset_type:
-                self.update_dataset_type(secondary_dataset_type, keep_previous=True)
-            self._filter_compound_hets(quality_filters_by_family, annotations_secondary_search)
-            if inheritance_mode == COMPOUND_HET:
-                return
+        if inheritance_mode in {RECESSIVE, COMPOUND_HET}:
+            if has_previous_compound_hets:
+                self._skipped_compound_het_filters = True
+            else:
+                if secondary_dataset_type:
+                    self.update_dataset_type(secondary_dataset_type, keep_previous=True)
+                self._filter_compound_hets(quality_filters_by_family, annotations_secondary_search)
+                if inheritance_mode == COMPOUND_HET:
+                    return
 
         self._filter_by_genotype(inheritance_mode, inheritance_filter, quality_filters_by_family)
 
@@ -223,6 +383,9 @@ class EsSearch(object):
         has_inheritance_filter = inheritance_filter or inheritance_mode
         all_sample_search = (not quality_filters_by_family) and (inheritance_mode == ANY_AFFECTED or not has_inheritance_filter)
         no_filter_indices = set()
+        if all_sample_search:
+            from seqr.utils.elasticsearch.utils import get_index_sample_counts
+            index_sample_counts = get_index_sample_counts(self._indices)
         for index in self._indices:
             family_samples_by_id = self.samples_by_family_index[index]
             index_fields = self.index_metadata[index]['fields']
@@ -230,14 +393,13 @@ class EsSearch(object):
             genotypes_q = None
             if all_sample_search:
                 search_sample_count = sum(len(samples) for samples in family_samples_by_id.values()) + self._skipped_sample_count[index]
-                index_sample_count = Sample.objects.filter(elasticsearch_index=index, is_active=True).count()
-                if search_sample_count == index_sample_count:
+                if search_sample_count == index_sample_counts[index]:
                     if inheritance_mode == ANY_AFFECTED:
                         sample_ids = []
                         for family_guid, samples_by_id in family_samples_by_id.items():
                             sample_ids += [
                                 sample_id for sample_id, sample in samples_by_id.items()
-                                if self._family_individual_affected_status[family_guid][sample.individual.guid] == Individual.AFFECTED_STATUS_AFFECTED]
+                                if self._family_individual_affected_status[family_guid][sample.individual_guid] == Individual.AFFECTED_STATUS_AFFECTED]
                         genotypes_q = _any_affected_sample_filter(sample_ids)
                         self._any_affected_sample_filters = True
                     else:
@@ -256,7 +418,7 @@ class EsSearch(object):
                     if inheritance_mode == ANY_AFFECTED:
                         # Only return variants where at least one of the affected samples has an alt allele
                         sample_ids = [sample_id for sample_id, sample in samples_by_id.items()
-                                      if affected_status[sample.individual.guid] == Individual.AFFECTED_STATUS_AFFECTED]
+                                      if affected_status[sample.individual_guid] == Individual.AFFECTED_STATUS_AFFECTED]
                         family_samples_q = _any_affected_sample_filter(sample_ids)
                     elif has_inheritance_filter:
                         if inheritance_mode:
@@ -353,19 +515,32 @@ class EsSearch(object):
 
         for index, compound_het_q in comp_het_q_by_index.items():
             compound_het_search = (annotations_secondary_search or self._search).filter(compound_het_q)
-            compound_het_search.aggs.bucket(
-                'genes', 'terms', field='geneIds', min_doc_count=2, size=MAX_COMPOUND_HET_GENES + 1
-            ).metric(
-                'vars_by_gene', 'top_hits', size=100, sort=self._sort, _source=QUERY_FIELD_NAMES
-            )
+            self._add_compound_het_gene_aggs(compound_het_search)
             self._index_searches[index].append(compound_het_search)
 
-    def search(self,  **kwargs):
+    def _add_compound_het_gene_aggs(self, search, after_key=None, load_hits=True):
+        """
+        Groups compound het variants by gene with a composite aggregation, so genes are loaded in pages instead of all
+        gene buckets being returned in a single response. Composite aggregations do not support a minimum doc count, so
+        genes with a single variant are removed by a bucket selector instead, and their hits are never returned
+        """
+        gene_agg_kwargs = {'after': after_key} if after_key else {}
+        gene_agg = search.aggs.bucket(
+            'genes', 'composite', size=COMPOUND_HET_GENES_PAGE_SIZE, sources=[{'gene_id': A('terms', field='geneIds')}],
+            **gene_agg_kwargs
+        )
+        if load_hits:
+            gene_agg.metric('vars_by_gene', 'top_hits', size=100, sort=self._sort, _source=QUERY_FIELD_NAMES)
+        gene_agg.pipeline(
+            'min_doc_count', 'bucket_selector', buckets_path={'doc_count': '_count'}, script='params.doc_count > 1'
+        )
+
+    def search(self, page=1, num_results=100):
         indices = self._indices
 
         logger.info('Searching in elasticsearch indices: {}'.format(', '.join(indices)))
 
-        is_single_search, search_kwargs = self._should_execute_single_search(**kwargs)
+        is_single_search, search_kwargs = self._should_execute_single_search(page=page, num_results=num_results)
 
         if is_single_search:
             return self._execute_single_search(**search_kwargs)
@@ -374,6 +549,90 @@ class EsSearch(object):
         else:
             return self._execute_multi_search(**search_kwargs)
 
+    def count(self):
+        """
+        Counts the variants matching the search without loading any documents, using a size 0 request for each index with
+        a filters aggregation on each family's query. Returns the total count and the counts by family and by index.
+        Variants found in multiple indices are counted once per index, as duplicates can only be merged once loaded.
+        Compound het pairs are only found from the loaded variants, so compound het searches are counted with a paged gene
+        aggregation instead, as the number of variants in genes with at least 2 matching variants. This is an upper bound
+        on the number of variants in compound het pairs, and is counted under the index name with a "_compound_het" suffix.
+        The family counts for compound het searches include all the variants matching each family's genotype filters
+        """
+        indices = sorted(self._index_searches.keys() or self._indices)
+        logger.info('Counting variants in elasticsearch indices: {}'.format(', '.join(indices)))
+
+        ms = MultiSearch()
+        searches = []
+        for index in indices:
+            for search in self._index_searches.get(index, [self._search]):
+                plan_search = _get_query_plan_search(search)
+                search = Search.from_dict(plan_search['query']).index(index)[:0]
+                # Later pages of compound het genes only need the gene aggregation, so they are cloned from the query
+                searches.append((index, plan_search['compound_het'], search._clone()))
+                search = search.extra(track_total_hits=True)
+                search.aggs.bucket('families', 'filters', filters=self._get_family_count_filters(index, search))
+                if plan_search['compound_het']:
+                    self._add_compound_het_gene_aggs(search, load_hits=False)
+                ms = ms.index(index).add(search)
+
+        counts_by_index = defaultdict(int)
+        counts_by_family = defaultdict(int)
+        for (index, is_compound_het, search), response in zip(searches, self._execute_search(ms)):
+            if is_compound_het:
+                counts_by_index['{}_compound_het'.format(index)] += self._count_compound_het_gene_variants(
+                    response, search)
+            else:
+                counts_by_index[index] += response.hits.total
+            for family_guid, bucket in response.aggregations.to_dict()['families']['buckets'].items():
+                counts_by_family[family_guid] += bucket['doc_count']
+
+        return {
+            'total': sum(counts_by_index.values()),
+            'families': dict(counts_by_family),
+            'indices': dict(counts_by_index),
+        }
+
+    def _count_compound_het_gene_variants(self, response, search):
+        count = 0
+        while True:
+            count += sum(bucket['doc_count'] for bucket in response.aggregations.genes.buckets)
+            after_key = getattr(response.aggregations.genes, 'after_key', None)
+            if not after_key:
+                return count
+            page_search = search._clone()
+            self._add_compound_het_gene_aggs(page_search, after_key=after_key.to_dict(), load_hits=False)
+            logger.info('Counting next page of {}s'.format(self.AGGREGATION_NAME))
+            response = self._execute_search(page_search)
+
+    def _get_family_count_filters(self, index, search):
+        # Compound het searches across data types are keyed by both of their indices
+        family_samples_by_id = defaultdict(dict)
+        for index_name in index.split(','):
+            for family_guid, samples_by_id in self.samples_by_family_index.get(index_name, {}).items():
+                family_samples_by_id[family_guid].update(samples_by_id)
+
+        # Hits for searches with named family queries are returned for the families whose query they match
+        named_queries = _get_named_queries(search.to_dict().get('query', {}))
+        if named_queries:
+            return {
+                family_guid: query for family_guid, query in named_queries.items() if family_guid in family_samples_by_id
+            }
+
+        if self._return_all_queried_families:
+            return {family_guid: Q('match_all') for family_guid in family_samples_by_id.keys()}
+
+        # Otherwise, hits are returned for the families with an alt allele in a matched sample
+        family_filters = {}
+        for family_guid, samples_by_id in family_samples_by_id.items():
+            sample_ids = [
+                sample_id for sample_id, sample in samples_by_id.items() if not self._any_affected_sample_filters or
+                self._family_individual_affected_status[family_guid][sample.individual_guid] == Individual.AFFECTED_STATUS_AFFECTED
+            ]
+            if sample_ids:
+                family_filters[family_guid] = _any_affected_sample_filter(sample_ids)
+        return family_filters
+
     def _is_single_search(self):
         return len(self._indices) == 1 and len(self._index_searches) < 2 and \
                len(self._index_searches.get(self._indices[0], [])) <= 1
@@ -407,7 +666,7 @@ class EsSearch(object):
             self.index_name, page=page, num_results=num_results_for_search, start_index=start_index
         )[0]
         response = self._execute_search(search)
-        parsed_response = self._parse_response(response)
+        parsed_response = self._parse_response(response, search, search_cursor_key=self.index_name)
         return self._process_single_search_response(
             parsed_response, page=page, num_results=num_results, deduplicate=deduplicate, **kwargs)
 
@@ -439,7 +698,14 @@ class EsSearch(object):
         if self.CACHED_COUNTS_KEY and not self.previous_search_results.get(self.CACHED_COUNTS_KEY):
             self.previous_search_results[self.CACHED_COUNTS_KEY] = {}
 
+        # Indices whose unreturned results already fill the requested page do not need to load any more results
+        num_results_to_load = kwargs.get('page', 1) * kwargs.get('num_results', 100) - len(
+            self.previous_search_results.get('all_results', []))
+        remaining_results_by_index = self.previous_search_results.get(self.REMAINING_RESULTS_KEY, {})
+
         ms = MultiSearch()
+        all_searches = []
+        search_cursor_keys = []
         for index_name in indices:
             start_index = 0
             if self.CACHED_COUNTS_KEY:
@@ -448,6 +714,9 @@ class EsSearch(object):
                     start_index = self.previous_search_results[self.CACHED_COUNTS_KEY][index_name]['loaded']
                     if start_index >= index_total:
                         continue
+                    if len(remaining_results_by_index.get(index_name, [])) >= num_results_to_load and \
+                            not self._merges_all_loaded_results():
+                        continue
                 else:
                     self.previous_search_results[self.CACHED_COUNTS_KEY][index_name] = {'loaded': 0, 'total': 0}
 
@@ -455,13 +724,39 @@ class EsSearch(object):
             ms = ms.index(index_name.split(','))
             for search in searches:
                 ms = ms.add(search)
+            all_searches += searches
+            search_cursor_keys += [index_name] * len(searches)
 
-        responses = self._execute_search(ms)
-        parsed_responses = [self._parse_response(response) for response in responses]
+        if ELASTICSEARCH_SEARCH_THREADS and len(all_searches) > 1:
+            parsed_responses = self._execute_parallel_searches(all_searches, search_cursor_keys)
+        else:
+            responses = self._execute_search(ms)
+            parsed_responses = [
+                self._parse_response(response, search, search_cursor_key=search_cursor_key)
+                for response, search, search_cursor_key in zip(responses, all_searches, search_cursor_keys)
+            ]
         return self._process_multi_search_responses(parsed_responses, **kwargs)
 
+    def _execute_parallel_searches(self, searches, search_cursor_keys):
+        from seqr.utils.elasticsearch.utils import get_search_thread_pool
+
+        searches = [search.params(request_timeout=ELASTICSEARCH_INDEX_SEARCH_TIMEOUT) for search in searches]
+
+        def _execute_indexed_search(indexed_search):
+            i, search = indexed_search
+            return i, self._execute_search(search)
+
+        # Parse each response as soon as it is returned instead of waiting for the slowest index. Responses are then
+        # processed in the original search order, so results are the same regardless of which index returns first
+        parsed_responses = [None] * len(searches)
+        for i, response in get_search_thread_pool().imap_unordered(_execute_indexed_search, enumerate(searches)):
+            parsed_responses[i] = self._parse_response(response, searches[i], search_cursor_key=search_cursor_keys[i])
+        return parsed_responses
+
     def _process_multi_search_responses(self, parsed_responses, page=1, num_results=100):
-        new_results = []
+        # Unreturned results are kept sorted separately for each index, and new hits from an index sort after its
+        # unreturned results, so they are appended
+        remaining_results_by_index = self.previous_search_results.get(self.REMAINING_RESULTS_KEY, {})
         compound_het_results = self.previous_search_results.get('compound_het_results', [])
         for response_hits, response_total, is_compound_het, index_name in parsed_responses:
             if not response_total:
@@ -472,44 +767,128 @@ class EsSearch(object):
                 self.previous_search_results['loaded_variant_counts']['{}_compound_het'.format(index_name)] = {
                     'total': response_total, 'loaded': response_total}
             else:
-                new_results += response_hits
+                if response_hits:
+                    remaining_results_by_index[index_name] = remaining_results_by_index.get(index_name, []) + response_hits
                 self.previous_search_results['loaded_variant_counts'][index_name]['total'] = response_total
                 self.previous_search_results['loaded_variant_counts'][index_name]['loaded'] += len(response_hits)
 
         self.previous_search_results['total_results'] = sum(
             counts['total'] for counts in self.previous_search_results['loaded_variant_counts'].values())
 
-        # combine new results with unsorted previously loaded results to correctly sort/paginate
-        all_loaded_results = self.previous_search_results.get('all_results', [])
-        new_results += self.previous_search_results.get('variant_results', [])
-
-        new_results = sorted(new_results, key=lambda variant: variant['_sort'])
-        variant_results = self._deduplicate_results(new_results)
+        index_names = sorted(remaining_results_by_index.keys())
+        index_results = [remaining_results_by_index[index_name] for index_name in index_names]
+        index_results.append(self.previous_search_results.get('variant_results', []))
 
         if compound_het_results or self.previous_search_results.get('grouped_results'):
+            variant_results = self._deduplicate_results(
+                _merge_sorted_results(index_results, lambda variant: variant['_sort']))
+            self.previous_search_results.pop(self.REMAINING_RESULTS_KEY, None)
             if compound_het_results:
                 compound_het_results = self._deduplicate_compound_het_results(compound_het_results)
                 compound_het_results = _sort_compound_hets(compound_het_results)
             return self._process_compound_hets(compound_het_results, variant_results, num_results)
         else:
+            all_loaded_results = self.previous_search_results.get('all_results', [])
             end_index = num_results * page
             num_loaded = num_results * page - len(all_loaded_results)
-            self.previous_search_results['all_results'] = all_loaded_results + variant_results[:num_loaded]
-            self.previous_search_results['variant_results'] = variant_results[num_loaded:]
+
+            new_results, num_used_by_list = _get_merged_results_page(
+                index_results, None if self._merges_all_loaded_results() else num_loaded)
+            self.previous_search_results['all_results'] = all_loaded_results + self._deduplicate_results(new_results)
+            self.previous_search_results[self.REMAINING_RESULTS_KEY] = {
+                index_name: results[num_used:] for index_name, results, num_used
+                in zip(index_names, index_results, num_used_by_list) if len(results) > num_used
+            }
+            self.previous_search_results['variant_results'] = index_results[-1][num_used_by_list[-1]:]
             return self.previous_search_results['all_results'][end_index-num_results:end_index]
 
-    def _parse_response(self, response):
+    def _merges_all_loaded_results(self):
+        # Variants from different genome builds are deduplicated by their lifted over position, so duplicates are not
+        # adjacent once sorted, and searched variant ids may be filtered out. In these cases all the loaded results need
+        # to be merged to fill a page
+        return bool(self._filtered_variant_ids) or \
+            len({self.index_metadata[index]['genomeVersion'] for index in self._indices}) > 1
+
+    def _parse_response(self, response, search, search_cursor_key=None):
         index_name = response.hits[0].meta.index if response.hits else None
         if hasattr(response.aggregations, 'genes') and response.hits:
-            response_hits, response_total = self._parse_compound_het_response(response)
+            response_hits, response_total = self._parse_compound_het_response(response, search)
             return response_hits, response_total, True, index_name
 
         response_total = response.hits.total
         logger.info('Total hits: {} ({} seconds)'.format(response_total, response.took / 1000.0))
-        return [self._parse_hit(hit) for hit in response], response_total, False, index_name
+        raw_hits = list(response)
+        if search_cursor_key:
+            raw_hits = self._advance_search_cursor(search_cursor_key, raw_hits)
+        return self._parse_hits(raw_hits), response_total, False, index_name
+
+    def _advance_search_cursor(self, cursor_key, raw_hits):
+        """
+        Drops hits which were already loaded by the previous page and saves the search_after cursor for the next page.
+        search_after only returns hits which sort strictly after the given sort values, so hits tied with the last hit
+        would be skipped if the cursor was the last hit. Instead, the cursor is the last hit before the tied hits, and the
+        tied hits are skipped when loading the next page
+        """
+        if cursor_key not in self._search_cursor_requests:
+            return raw_hits
+
+        start_index, cursor = self._search_cursor_requests.pop(cursor_key)
+        if cursor:
+            skip_hit_ids = set(cursor['skip'])
+            raw_hits = [raw_hit for raw_hit in raw_hits if _get_search_cursor_hit_id(raw_hit) not in skip_hit_ids]
+        if not raw_hits:
+            return raw_hits
+
+        search_cursors = self.previous_search_results.get(self.SEARCH_CURSORS_KEY, {})
+        search_cursors.pop(cursor_key, None)
+        if not hasattr(raw_hits[-1].meta, 'sort'):
+            return raw_hits
+
+        last_sort = list(raw_hits[-1].meta.sort)
+        tied_hits = list(takewhile(lambda raw_hit: list(raw_hit.meta.sort) == last_sort, reversed(raw_hits)))
+        skip_hit_ids = [_get_search_cursor_hit_id(raw_hit) for raw_hit in tied_hits]
+        if len(tied_hits) < len(raw_hits):
+            search_after = list(raw_hits[-len(tied_hits) - 1].meta.sort)
+        elif cursor and cursor['sort'] == last_sort:
+            search_after = cursor['after']
+            skip_hit_ids = cursor['skip'] + skip_hit_ids
+        elif cursor or not start_index:
+            search_after = cursor['sort'] if cursor else None
+        else:
+            # No hit sorts before the tied hits, so there is nothing to continue the search from
+            return raw_hits
+
+        search_cursors[cursor_key] = {
+            'after': search_after, 'sort': last_sort, 'skip': skip_hit_ids, 'loaded': start_index + len(raw_hits),
+        }
+        self.previous_search_results[self.SEARCH_CURSORS_KEY] = search_cursors
+        return raw_hits
+
+    def _parse_hits(self, raw_hits):
+        """
+        Parses a page of hits, resolving the field lookups for each index schema once rather than for every hit and
+        lifting over all the coordinates in a single batch
+        """
+        results = [
+            self._parse_hit_fields(raw_hit, self._get_index_field_parsers(raw_hit.meta.index)) for raw_hit in raw_hits
+        ]
+        if not _set_lifted_over_coordinates(results, wait=self._wait_for_liftover):
+            self.missing_liftover = True
+        return results
+
+    def _get_index_field_parsers(self, index_name):
+        if index_name not in self._index_field_parsers:
+            self._index_field_parsers[index_name] = _compile_index_field_parsers(
+                self.index_metadata[index_name]['fields'])
+        return self._index_field_parsers[index_name]
 
-    def _parse_hit(self, raw_hit):
+    def _parse_hit_fields(self, raw_hit, field_parsers):
         hit = {k: raw_hit[k] for k in QUERY_FIELD_NAMES if k in raw_hit}
+        if hasattr(raw_hit.meta, 'inner_hits'):
+            hit[GENOTYPES_FIELD_KEY] = [
+                genotype_hit['_source']
+                for genotype_hit in raw_hit.meta.inner_hits.to_dict()[GENOTYPES_FIELD_KEY]['hits']['hits']
+            ]
         index_name = raw_hit.meta.index
         index_family_samples = self.samples_by_family_index[index_name]
 
@@ -527,7 +906,7 @@ class EsSearch(object):
             if self._any_affected_sample_filters:
                 # If using the any inheritance filter only include matched families
                 def _is_matched_sample(family_guid, sample):
-                    return self._family_individual_affected_status[family_guid][sample.individual.guid] == \
+                    return self._family_individual_affected_status[family_guid][sample.individual_guid] == \
                            Individual.AFFECTED_STATUS_AFFECTED
             else:
                 _is_matched_sample = lambda *args: True
@@ -541,18 +920,19 @@ class EsSearch(object):
         for family_guid in family_guids:
             samples_by_id = index_family_samples[family_guid]
             genotypes.update({
-                samples_by_id[genotype_hit['sample_id']].individual.guid: _get_field_values(genotype_hit, GENOTYPE_FIELDS_CONFIG)
+                samples_by_id[genotype_hit['sample_id']].individual_guid: _get_compiled_field_values(
+                    genotype_hit, field_parsers['genotypes'])
                 for genotype_hit in hit[GENOTYPES_FIELD_KEY] if genotype_hit['sample_id'] in samples_by_id
             })
             if len(samples_by_id) != len(genotypes) and is_sv:
                 # Family members with no variants are not included in the SV index
                 for sample_id, sample in samples_by_id.items():
-                    if sample.individual.guid not in genotypes:
-                        genotypes[sample.individual.guid] = _get_field_values(
-                            {'sample_id': sample_id}, GENOTYPE_FIELDS_CONFIG)
-                        genotypes[sample.individual.guid]['isRef'] = True
-                        if hit['contig'] == 'X' and sample.individual.sex == Individual.SEX_MALE:
-                            genotypes[sample.individual.guid]['cn'] = 1
+                    if sample.individual_guid not in genotypes:
+                        genotypes[sample.individual_guid] = _get_compiled_field_values(
+                            {'sample_id': sample_id}, field_parsers['genotypes'])
+                        genotypes[sample.individual_guid]['isRef'] = True
+                        if hit['contig'] == 'X' and sample.sex == Individual.SEX_MALE:
+                            genotypes[sample.individual_guid]['cn'] = 1
 
         # If an SV has genotype-specific coordinates that differ from the main coordinates, use those
         if is_sv and all((gen.get('isRef') or gen.get('start') or gen.get('end')) for gen in genotypes.values()):
@@ -572,28 +952,10 @@ class EsSearch(object):
                     gen['end'] = None
 
         genome_version = self.index_metadata[index_name]['genomeVersion']
-        lifted_over_genome_version = None
-        lifted_over_chrom = None
-        lifted_over_pos = None
-        liftover_grch38_to_grch37 = _liftover_grch38_to_grch37()
-        if liftover_grch38_to_grch37 and genome_version == GENOME_VERSION_GRCh38:
-            if liftover_grch38_to_grch37:
-                grch37_coord = liftover_grch38_to_grch37.convert_coordinate(
-                    'chr{}'.format(hit['contig'].lstrip('chr')), int(hit['start'])
-                )
-                if grch37_coord and grch37_coord[0]:
-                    lifted_over_genome_version = GENOME_VERSION_GRCh37
-                    lifted_over_chrom = grch37_coord[0][0].lstrip('chr')
-                    lifted_over_pos = grch37_coord[0][1]
 
         populations = {
-            population: _get_field_values(
-                hit, POPULATION_RESPONSE_FIELD_CONFIGS, format_response_key=lambda key: key.lower(),
-                lookup_field_prefix=population,
-                existing_fields=self.index_metadata[index_name]['fields'],
-                get_addl_fields=lambda field: pop_config[field] if isinstance(pop_config[field], list) else [pop_config[field]],
-            )
-            for population, pop_config in POPULATIONS.items()
+            population: _get_compiled_field_values(hit, population_field_parsers)
+            for population, population_field_parsers in field_parsers['populations'].items()
         }
 
         sorted_transcripts = [
@@ -606,10 +968,10 @@ class EsSearch(object):
         main_transcript_id = sorted_transcripts[0]['transcriptId'] \
             if len(sorted_transcripts) and 'transcriptRank' in sorted_transcripts[0] else None
 
-        result = _get_field_values(hit, CORE_FIELDS_CONFIG, format_response_key=str)
+        result = _get_compiled_field_values(hit, field_parsers['core'])
         result.update({
-            field_name: _get_field_values(hit, fields, lookup_field_prefix=field_name)
-            for field_name, fields in NESTED_FIELDS.items()
+            field_name: _get_compiled_field_values(hit, nested_field_parsers)
+            for field_name, nested_field_parsers in field_parsers['nested'].items()
         })
         if hasattr(raw_hit.meta, 'sort'):
             result['_sort'] = [_parse_es_sort(sort, self._sort[i]) for i, sort in enumerate(raw_hit.meta.sort)]
@@ -618,22 +980,17 @@ class EsSearch(object):
             'familyGuids': sorted(family_guids),
             'genotypes': genotypes,
             'genomeVersion': genome_version,
-            'liftedOverGenomeVersion': lifted_over_genome_version,
-            'liftedOverChrom': lifted_over_chrom,
-            'liftedOverPos': lifted_over_pos,
+            'liftedOverGenomeVersion': None,
+            'liftedOverChrom': None,
+            'liftedOverPos': None,
             'mainTranscriptId': main_transcript_id,
             'populations': populations,
-            'predictions': _get_field_values(
-                hit, PREDICTION_FIELDS_CONFIG, format_response_key=lambda key: key.split('_')[1].lower()
-            ),
+            'predictions': _get_compiled_field_values(hit, field_parsers['predictions']),
             'transcripts': dict(transcripts),
         })
         return result
 
-    def _parse_compound_het_response(self, response):
-        if len(response.aggregations.genes.buckets) > MAX_COMPOUND_HET_GENES:
-            raise Exception('This search returned too many compound heterozygous variants. Please add stricter filters')
-
+    def _parse_compound_het_response(self, response, search):
         family_unaffected_individual_guids = {
             family_guid: {individual_guid for individual_guid, affected_status in individual_affected_status.items() if
                           affected_status == Individual.AFFECTED_STATUS_UNAFFECTED}
@@ -641,53 +998,19 @@ class EsSearch(object):
         }
 
         compound_het_pairs_by_gene = {}
-        for gene_agg in response.aggregations.genes.buckets:
-            gene_variants = [self._parse_hit(hit) for hit in gene_agg['vars_by_gene']]
-            gene_id = gene_agg['key']
-
-            if gene_id in compound_het_pairs_by_gene:
-                continue
-
-            # Variants are returned if any transcripts have the filtered consequence, but to be compound het
-            # the filtered consequence needs to be present in at least one transcript in the gene of interest
-            if self._allowed_consequences:
-                for variant in gene_variants:
-                    variant['gene_consequences'] = {
-                        k: [variant['svType']] if variant.get('svType') else [
-                            transcript['majorConsequence'] for transcript in transcripts
-                        ] for k, transcripts in variant['transcripts'].items()}
-
-                gene_variants = [variant for variant in gene_variants if any(
-                    consequence in self._allowed_consequences + (self._allowed_consequences_secondary or [])
-                    for consequence in variant['gene_consequences'].get(gene_id, [])
-                )]
-
-            if len(gene_variants) < 2:
-                continue
-
-            # Do not include groups multiple times if identical variants are in the same multiple genes
-            if any((not variant['mainTranscriptId']) or all(t['transcriptId'] != variant['mainTranscriptId']
-                       for t in variant['transcripts'][gene_id]) for variant in gene_variants):
-                if not self._is_primary_compound_het_gene(gene_id, gene_variants, compound_het_pairs_by_gene):
-                    continue
-
-            family_compound_het_pairs = defaultdict(list)
-            for variant in gene_variants:
-                for family_guid in variant['familyGuids']:
-                    family_compound_het_pairs[family_guid].append(variant)
-
-            self._filter_invalid_family_compound_hets(gene_id, family_compound_het_pairs, family_unaffected_individual_guids)
-
-            gene_compound_het_pairs = [ch_pair for ch_pairs in family_compound_het_pairs.values() for ch_pair in ch_pairs]
-            for compound_het_pair in gene_compound_het_pairs:
-                for variant in compound_het_pair:
-                    variant['familyGuids'] = [family_guid for family_guid in variant['familyGuids']
-                                              if len(family_compound_het_pairs[family_guid]) > 0]
-                    variant.pop('gene_consequences', None)
-            gene_compound_het_pairs = [compound_het_pair for compound_het_pair in gene_compound_het_pairs
-                                       if compound_het_pair[0]['familyGuids'] and compound_het_pair[1]['familyGuids']]
-            if gene_compound_het_pairs:
-                compound_het_pairs_by_gene[gene_id] = gene_compound_het_pairs
+        while True:
+            # Pairs are found for each page of genes before loading the next, so only one page of hits is held at a time
+            for gene_agg in response.aggregations.genes.buckets:
+                self._parse_compound_het_gene(gene_agg, compound_het_pairs_by_gene, family_unaffected_individual_guids)
+
+            # The bucket selector can remove any of the genes in a page, so only a missing after key marks the last page
+            after_key = getattr(response.aggregations.genes, 'after_key', None)
+            if not after_key:
+                break
+            page_search = search._clone()
+            self._add_compound_het_gene_aggs(page_search, after_key=after_key.to_dict())
+            logger.info('Loading next page of {}s'.format(self.AGGREGATION_NAME))
+            response = self._execute_search(page_search)
 
         total_compound_het_results = sum(len(compound_het_pairs) for compound_het_pairs in compound_het_pairs_by_gene.values())
         logger.info('Total compound het hits: {}'.format(total_compound_het_results))
@@ -697,6 +1020,54 @@ class EsSearch(object):
             compound_het_results.extend([{k: compound_het_pair} for compound_het_pair in compound_het_pairs])
         return compound_het_results, total_compound_het_results
 
+    def _parse_compound_het_gene(self, gene_agg, compound_het_pairs_by_gene, family_unaffected_individual_guids):
+        gene_id = gene_agg['key']['gene_id']
+        if gene_id in compound_het_pairs_by_gene:
+            return
+
+        gene_variants = self._parse_hits(gene_agg['vars_by_gene'])
+
+        # Variants are returned if any transcripts have the filtered consequence, but to be compound het
+        # the filtered consequence needs to be present in at least one transcript in the gene of interest
+        if self._allowed_consequences:
+            for variant in gene_variants:
+                variant['gene_consequences'] = {
+                    k: [variant['svType']] if variant.get('svType') else [
+                        transcript['majorConsequence'] for transcript in transcripts
+                    ] for k, transcripts in variant['transcripts'].items()}
+
+            gene_variants = [variant for variant in gene_variants if any(
+                consequence in self._allowed_consequences + (self._allowed_consequences_secondary or [])
+                for consequence in variant['gene_consequences'].get(gene_id, [])
+            )]
+
+        if len(gene_variants) < 2:
+            return
+
+        # Do not include groups multiple times if identical variants are in the same multiple genes
+        if any((not variant['mainTranscriptId']) or all(t['transcriptId'] != variant['mainTranscriptId']
+                   for t in variant['transcripts'][gene_id]) for variant in gene_variants):
+            if not self._is_primary_compound_het_gene(gene_id, gene_variants, compound_het_pairs_by_gene):
+                return
+
+        family_compound_het_pairs = defaultdict(list)
+        for variant in gene_variants:
+            for family_guid in variant['familyGuids']:
+                family_compound_het_pairs[family_guid].append(variant)
+
+        self._filter_invalid_family_compound_hets(gene_id, family_compound_het_pairs, family_unaffected_individual_guids)
+
+        gene_compound_het_pairs = [ch_pair for ch_pairs in family_compound_het_pairs.values() for ch_pair in ch_pairs]
+        for compound_het_pair in gene_compound_het_pairs:
+            for variant in compound_het_pair:
+                variant['familyGuids'] = [family_guid for family_guid in variant['familyGuids']
+                                          if len(family_compound_het_pairs[family_guid]) > 0]
+                variant.pop('gene_consequences', None)
+        gene_compound_het_pairs = [compound_het_pair for compound_het_pair in gene_compound_het_pairs
+                                   if compound_het_pair[0]['familyGuids'] and compound_het_pair[1]['familyGuids']]
+        if gene_compound_het_pairs:
+            compound_het_pairs_by_gene[gene_id] = gene_compound_het_pairs
+
     def _is_primary_compound_het_gene(self, gene_id, gene_variants, compound_het_pairs_by_gene):
         primary_genes = set()
         for variant in gene_variants:
@@ -729,38 +1100,9 @@ class EsSearch(object):
 
     def _filter_invalid_family_compound_hets(self, gene_id, family_compound_het_pairs, family_unaffected_individual_guids):
         for family_guid, variants in family_compound_het_pairs.items():
-            unaffected_genotypes = [
-                [variant['genotypes'].get(individual_guid, {'isRef': True}) for variant in variants]
-                for individual_guid in family_unaffected_individual_guids.get(family_guid, [])
-            ]
-
-            gene_consequences = [
-                variant['gene_consequences'].get(gene_id, []) for variant in variants
-            ]
-
-            def _is_valid_compound_het_pair(variant_1_index, variant_2_index):
-                # To be compound het all unaffected individuals need to be hom ref for at least one of the variants
-                for genotype in unaffected_genotypes:
-                    is_valid_for_individual = any(
-                        genotype[variant_index].get('numAlt') == 0 or genotype[variant_index].get('isRef')
-                        for variant_index in [variant_1_index, variant_2_index]
-                    )
-                    if not is_valid_for_individual:
-                        return False
-                if self._allowed_consequences and self._allowed_consequences_secondary:
-                    consequences = gene_consequences[variant_1_index] + gene_consequences[variant_2_index]
-                    if all(consequence not in self._allowed_consequences for consequence in consequences) or all(
-                            consequence not in self._allowed_consequences_secondary for consequence in consequences):
-                        return False
-                return True
-
-            valid_combinations = [[ch_1_index, ch_2_index] for ch_1_index, ch_2_index in
-                                  combinations(range(len(variants)), 2)
-                                  if _is_valid_compound_het_pair(ch_1_index, ch_2_index)]
-
-            family_compound_het_pairs[family_guid] = [
-                [variants[valid_ch_1_index], variants[valid_ch_2_index]] for
-                valid_ch_1_index, valid_ch_2_index in valid_combinations]
+            family_compound_het_pairs[family_guid] = _get_valid_compound_het_pairs(
+                gene_id, variants, family_unaffected_individual_guids.get(family_guid, []),
+                self._allowed_consequences, self._allowed_consequences_secondary)
 
     def _deduplicate_results(self, sorted_new_results):
         original_result_count = len(sorted_new_results)
@@ -834,34 +1176,24 @@ class EsSearch(object):
     def _deduplicate_compound_het_results(self, compound_het_results):
         duplicates = 0
         results = {}
+        # Pairs in each gene are keyed by their variant ids, so each duplicate is found with a single lookup
+        pairs_by_variant_ids = defaultdict(dict)
         for gene_compound_het_pair in compound_het_results:
             gene = gene_compound_het_pair.keys()[0]
             compound_het_pair = gene_compound_het_pair[gene]
-            if gene in results:
-                variant_ids = {variant['variantId'] for variant in compound_het_pair}
-                existing_index = next(
-                    (i for i, existing in enumerate(results[gene]) if
-                     {variant['variantId'] for variant in existing} == variant_ids), None,
-                )
-                if existing_index is not None:
-                    existing_compound_het_pair = results[gene][existing_index]
-
-                    def _update_existing_variant(existing_variant, variant):
-                        existing_variant['genotypes'].update(variant['genotypes'])
-                        existing_variant['familyGuids'] = sorted(
-                            existing_variant['familyGuids'] + variant['familyGuids']
-                        )
-                    if existing_compound_het_pair[0]['variantId'] == compound_het_pair[0]['variantId']:
-                        _update_existing_variant(existing_compound_het_pair[0], compound_het_pair[0])
-                        _update_existing_variant(existing_compound_het_pair[1], compound_het_pair[1])
-                    else:
-                        _update_existing_variant(existing_compound_het_pair[0], compound_het_pair[1])
-                        _update_existing_variant(existing_compound_het_pair[1], compound_het_pair[0])
-                    duplicates += 1
+            variant_ids = frozenset(variant['variantId'] for variant in compound_het_pair)
+            existing_compound_het_pair = pairs_by_variant_ids[gene].get(variant_ids)
+            if existing_compound_het_pair is not None:
+                if existing_compound_het_pair[0]['variantId'] == compound_het_pair[0]['variantId']:
+                    _update_existing_variant(existing_compound_het_pair[0], compound_het_pair[0])
+                    _update_existing_variant(existing_compound_het_pair[1], compound_het_pair[1])
                 else:
-                    results[gene].append(compound_het_pair)
+                    _update_existing_variant(existing_compound_het_pair[0], compound_het_pair[1])
+                    _update_existing_variant(existing_compound_het_pair[1], compound_het_pair[0])
+                duplicates += 1
             else:
-                results[gene] = [compound_het_pair]
+                pairs_by_variant_ids[gene][variant_ids] = compound_het_pair
+                results.setdefault(gene, []).append(compound_het_pair)
 
         deduplicated_results = []
         for gene, compound_het_pairs in results.items():
@@ -876,12 +1208,11 @@ class EsSearch(object):
         if not self.previous_search_results.get('grouped_results'):
             self.previous_search_results['grouped_results'] = []
 
-        # Sort merged result sets
-        grouped_variants = [{None: [var]} for var in variant_results]
-        grouped_variants = compound_het_results + grouped_variants
-        grouped_variants = _sort_compound_hets(grouped_variants)
+        # Merge the sorted result sets
+        grouped_variants = _merge_sorted_results(
+            [compound_het_results, [{None: [var]} for var in variant_results]], _get_grouped_variants_sort)
 
-        loaded_result_count = len(grouped_variants + self.previous_search_results['grouped_results'])
+        loaded_result_count = len(grouped_variants) + len(self.previous_search_results['grouped_results'])
 
         # Get requested page of variants
         merged_variant_results = []
@@ -924,18 +1255,63 @@ class EsSearch(object):
                 end_index = page * num_results
                 if start_index is None:
                     start_index = end_index - num_results
-                if end_index > MAX_VARIANTS:
-                    # ES request size limits are limited by offset + size, which is the same as end_index
-                    raise Exception(
-                        'Unable to load more than {} variants ({} requested)'.format(MAX_VARIANTS, end_index))
 
-                search = search[start_index:end_index]
-                search = search.source(QUERY_FIELD_NAMES)
+                cursor = self.previous_search_results.get(self.SEARCH_CURSORS_KEY, {}).get(index_name)
+                if start_index and cursor and cursor['loaded'] == start_index:
+                    # Continue from the last loaded variant, instead of having ES sort and skip all the earlier variants
+                    # Hits tied with the cursor are loaded again and skipped, so they count towards the request size
+                    size = end_index - start_index + len(cursor['skip'])
+                    if size > MAX_VARIANTS:
+                        raise Exception('Unable to load more than {} variants ({} requested)'.format(MAX_VARIANTS, size))
+                    if cursor['after']:
+                        search = search.extra(search_after=cursor['after'])
+                    search = search[:size]
+                else:
+                    cursor = None
+                    if end_index > MAX_VARIANTS:
+                        # ES request size limits are limited by offset + size, which is the same as end_index
+                        raise Exception(
+                            'Unable to load more than {} variants ({} requested)'.format(MAX_VARIANTS, end_index))
+                    search = search[start_index:end_index]
+
+                search = self._add_search_source(search, index_name)
+                if cursor or end_index >= MAX_VARIANTS:
+                    # Cursors are only needed to load variants past MAX_VARIANTS
+                    self._search_cursor_requests[index_name] = (start_index, cursor)
                 logger.info('Loading {} records {}-{}'.format(index_name, start_index, end_index))
 
             searches.append(search)
         return searches
 
+    def _add_search_source(self, search, index_name):
+        """
+        Indices have genotypes for every sample in the callset, but only the genotypes for the searched samples are used.
+        If genotypes are nested, only the searched samples' genotypes are loaded, as inner hits of a nested query which
+        does not filter the hits. Inner hits are limited in size, so searches with more samples load all genotypes
+        """
+        source_fields = QUERY_FIELD_NAMES
+        indices = self._indices if index_name == self.index_name else index_name.split(',')
+        sample_ids = sorted({
+            sample_id for index in indices for samples_by_id in self.samples_by_family_index[index].values()
+            for sample_id in samples_by_id.keys()
+        })
+        if len(sample_ids) > MAX_GENOTYPE_INNER_HITS or not all(
+                GENOTYPES_FIELD_KEY in self.index_metadata[index].get('nestedFields', []) for index in indices):
+            return search.source(source_fields)
+
+        genotypes_q = Q(
+            'nested', path=GENOTYPES_FIELD_KEY, score_mode='none', inner_hits={'size': len(sample_ids)},
+            query=Q('terms', **{'{}.sample_id'.format(GENOTYPES_FIELD_KEY): sample_ids}),
+        )
+        search = search.source([field for field in source_fields if field != GENOTYPES_FIELD_KEY])
+        query = search.query._proxied
+        if query:
+            search.query = Q('bool', filter=[query], should=[genotypes_q])
+        else:
+            # Every variant has genotypes for all the samples in the callset, so the nested query alone matches every hit
+            search.query = Q('bool', should=[genotypes_q])
+        return search
+
     def _execute_search(self, search):
         logger.debug(json.dumps(search.to_dict(), indent=2))
         try:
@@ -955,13 +1331,9 @@ class EsSearch(object):
         return canceled
 
     @classmethod
-    def process_previous_results(cls, previous_search_results, page=1, num_results=100, load_all=False):
-        num_results_to_use = num_results
-        total_results = previous_search_results.get('total_results')
-        if load_all:
-            num_results_to_use = total_results or MAX_VARIANTS
-        start_index = (page - 1) * num_results_to_use
-        end_index = page * num_results_to_use
+    def process_previous_results(cls, previous_search_results, page=1, num_results=100):
+        start_index = (page - 1) * num_results
+        end_index = page * num_results
         if previous_search_results.get('total_results') is not None:
             end_index = min(end_index, previous_search_results['total_results'])
 
@@ -975,7 +1347,7 @@ class EsSearch(object):
             if results is not None:
                 return results, {}
 
-        return None, {'page': page, 'num_results': num_results_to_use}
+        return None, {'page': page, 'num_results': num_results}
 
     @classmethod
     def parse_variant_id(cls, variant_id):
@@ -986,26 +1358,123 @@ class EsSearch(object):
 
 
 # TODO  move liftover to hail pipeline once upgraded to 0.2 (https://github.com/macarthur-lab/seqr/issues/1010)
-LIFTOVER_GRCH38_TO_GRCH37 = None
-def _liftover_grch38_to_grch37():
-    global LIFTOVER_GRCH38_TO_GRCH37
-    if not LIFTOVER_GRCH38_TO_GRCH37:
-        try:
-            LIFTOVER_GRCH38_TO_GRCH37 = LiftOver('hg38', 'hg19')
-        except Exception as e:
-            logger.warn('WARNING: Unable to set up liftover. {}'.format(e))
-    return LIFTOVER_GRCH38_TO_GRCH37
+def _get_index_alias(index_name):
+    return hashlib.md5(index_name).hexdigest()
 
 
-LIFTOVER_GRCH37_TO_GRCH38 = None
-def _liftover_grch37_to_grch38():
-    global LIFTOVER_GRCH37_TO_GRCH38
-    if not LIFTOVER_GRCH37_TO_GRCH38:
-        try:
-            LIFTOVER_GRCH37_TO_GRCH38 = LiftOver('hg19', 'hg38')
-        except Exception as e:
-            logger.warn('WARNING: Unable to set up liftover. {}'.format(e))
-    return LIFTOVER_GRCH37_TO_GRCH38
+def _get_index_alias_cache_key(alias):
+    return 'index_alias__{}'.format(alias)
+
+
+def _set_lifted_over_coordinates(results, wait=False):
+    """
+    Adds the GRCh37 coordinates to all GRCh38 results. Returns False if there were GRCh38 results but the liftover chain
+    was not available
+    """
+    grch38_results = [result for result in results if result['genomeVersion'] == GENOME_VERSION_GRCh38]
+    if not grch38_results:
+        return True
+    liftover_grch38_to_grch37 = get_liftover(GENOME_VERSION_GRCh38, wait=wait)
+    if not liftover_grch38_to_grch37:
+        return False
+
+    lifted_coords = liftover_grch38_to_grch37.lift_coordinates(
+        [(result['chrom'], result['pos']) for result in grch38_results])
+    for result, lifted_coord in zip(grch38_results, lifted_coords):
+        if lifted_coord:
+            result.update({
+                'liftedOverGenomeVersion': GENOME_VERSION_GRCh37,
+                'liftedOverChrom': lifted_coord[0],
+                'liftedOverPos': lifted_coord[1],
+            })
+    return True
+
+
+class SearchSample(namedtuple('SearchSample', ['sample_id', 'individual_guid', 'affected', 'sex'])):
+    """
+    Immutable record of the metadata for a searched sample and its individual. Searches only use these records, and never
+    the Sample or Individual models
+    """
+    __slots__ = ()
+
+
+def _get_sample_topology(families):
+    """
+    Returns a json serializable mapping of index to family guid to sample id to the individual guid, affected status
+    and sex of the sample, for all the active samples in the given families
+    """
+    sample_topology = defaultdict(lambda: defaultdict(dict))
+    for index, family_guid, sample_id, individual_guid, affected, sex in Sample.objects.filter(
+            is_active=True, individual__family__in=families).values_list(
+            'elasticsearch_index', 'individual__family__guid', 'sample_id', 'individual__guid', 'individual__affected',
+            'individual__sex'):
+        sample_topology[index][family_guid][sample_id] = [individual_guid, affected, sex]
+    return {index: dict(family_samples) for index, family_samples in sample_topology.items()}
+
+
+def _get_valid_compound_het_pairs(gene_id, variants, unaffected_individual_guids, allowed_consequences,
+                                  allowed_consequences_secondary):
+    check_consequences = bool(allowed_consequences and allowed_consequences_secondary)
+    allowed_consequences = set(allowed_consequences or [])
+    allowed_consequences_secondary = set(allowed_consequences_secondary or [])
+    primary_consequence_bit = 1 << len(unaffected_individual_guids)
+    secondary_consequence_bit = primary_consequence_bit << 1
+
+    # Each variant is encoded as a bitmask with a bit for each unaffected individual who is hom ref for the variant, and
+    # a bit each for having a primary or secondary consequence in the gene. To be compound het all unaffected
+    # individuals need to be hom ref for at least one of the variants and the pair needs both consequence types, so a
+    # pair is valid if every bit is set by at least one of its variants
+    variant_masks = []
+    for variant in variants:
+        mask = 0
+        for i, individual_guid in enumerate(unaffected_individual_guids):
+            genotype = variant['genotypes'].get(individual_guid, {'isRef': True})
+            if genotype.get('numAlt') == 0 or genotype.get('isRef'):
+                mask |= 1 << i
+        if check_consequences:
+            consequences = variant['gene_consequences'].get(gene_id, [])
+            if any(consequence in allowed_consequences for consequence in consequences):
+                mask |= primary_consequence_bit
+            if any(consequence in allowed_consequences_secondary for consequence in consequences):
+                mask |= secondary_consequence_bit
+        variant_masks.append(mask)
+
+    valid_mask = (secondary_consequence_bit << 1 if check_consequences else primary_consequence_bit) - 1
+    return [[variants[ch_1_index], variants[ch_2_index]] for ch_1_index, ch_2_index in
+            _get_valid_compound_het_index_pairs(variant_masks, valid_mask)]
+
+
+def _get_valid_compound_het_index_pairs(variant_masks, valid_mask):
+    """
+    Returns the index pairs, in the same order as itertools.combinations, of the variants whose masks together set every
+    bit of valid_mask. Variants are grouped by mask, so only distinct masks need to be compared with each other
+    """
+    indices_by_mask = defaultdict(list)
+    for index, mask in enumerate(variant_masks):
+        indices_by_mask[mask].append(index)
+    partner_masks = {
+        mask: [other_mask for other_mask in indices_by_mask.keys() if mask | other_mask == valid_mask]
+        for mask in indices_by_mask.keys()
+    }
+
+    num_variants = len(variant_masks)
+    index_pairs = []
+    for index, mask in enumerate(variant_masks):
+        if mask == valid_mask:
+            partner_indices = range(index + 1, num_variants)
+        else:
+            partner_indices = []
+            for partner_mask in partner_masks[mask]:
+                mask_indices = indices_by_mask[partner_mask]
+                partner_indices += mask_indices[bisect_right(mask_indices, index):]
+            partner_indices.sort()
+        index_pairs += [(index, partner_index) for partner_index in partner_indices]
+    return index_pairs
+
+
+def _update_existing_variant(existing_variant, variant):
+    existing_variant['genotypes'].update(variant['genotypes'])
+    existing_variant['familyGuids'] = sorted(existing_variant['familyGuids'] + variant['familyGuids'])
 
 
 def _get_family_affected_status(family_samples_by_id, inheritance_filter):
@@ -1014,8 +1483,8 @@ def _get_family_affected_status(family_samples_by_id, inheritance_filter):
     for family_guid, samples_by_id in family_samples_by_id.items():
         affected_status[family_guid] = {}
         for sample in samples_by_id.values():
-            indiv = sample.individual
-            affected_status[family_guid][indiv.guid] = individual_affected_status.get(indiv.guid) or indiv.affected
+            affected_status[family_guid][sample.individual_guid] = \
+                individual_affected_status.get(sample.individual_guid) or sample.affected
 
     return affected_status
 
@@ -1059,21 +1528,19 @@ def _any_affected_sample_filter(sample_ids):
 def _family_genotype_inheritance_filter(inheritance_mode, inheritance_filter, samples_by_id, individual_affected_status, index_fields):
     samples_q = None
 
-    individuals = [sample.individual for sample in samples_by_id.values()]
-
     individual_genotype_filter = inheritance_filter.get('genotype') or {}
 
     if inheritance_mode == X_LINKED_RECESSIVE:
         samples_q = Q('match', contig='X')
-        for individual in individuals:
-            if individual_affected_status[individual.guid] == Individual.AFFECTED_STATUS_UNAFFECTED \
-                    and individual.sex == Individual.SEX_MALE:
-                individual_genotype_filter[individual.guid] = REF_REF
+        for sample in samples_by_id.values():
+            if individual_affected_status[sample.individual_guid] == Individual.AFFECTED_STATUS_UNAFFECTED \
+                    and sample.sex == Individual.SEX_MALE:
+                individual_genotype_filter[sample.individual_guid] = REF_REF
 
     is_sv_comp_het = inheritance_mode == COMPOUND_HET and 'samples' in index_fields
     for sample_id, sample in samples_by_id.items():
 
-        individual_guid = sample.individual.guid
+        individual_guid = sample.individual_guid
         affected = individual_affected_status[individual_guid]
 
         genotype = individual_genotype_filter.get(individual_guid) or inheritance_filter.get(affected)
@@ -1115,6 +1582,19 @@ def _named_family_sample_q(family_samples_q, family_guid, quality_filters_by_fam
     return Q('bool', must=sample_queries, _name=family_guid)
 
 
+def _get_named_queries(query):
+    named_queries = {}
+    if isinstance(query, list):
+        for sub_query in query:
+            named_queries.update(_get_named_queries(sub_query))
+    elif isinstance(query, dict):
+        for query_type, query_body in query.items():
+            if isinstance(query_body, dict) and query_body.get('_name'):
+                named_queries[query_body['_name']] = {query_type: query_body}
+            named_queries.update(_get_named_queries(query_body))
+    return named_queries
+
+
 def _location_filter(genes, intervals, rs_ids, variant_ids, location_filter):
     q = None
     if intervals:
@@ -1232,27 +1712,85 @@ def _get_sort(sort_key):
     return sorts
 
 
+def _get_search_cursor_hit_id(raw_hit):
+    return '{}/{}'.format(raw_hit.meta.index, raw_hit.meta.id)
+
+
+def _get_query_plan_search(search):
+    # The sort and compound het aggregations depend on the requested sort, so they are added when the plan is loaded
+    search_dict = search.to_dict()
+    search_dict.pop('sort', None)
+    is_compound_het = bool(search_dict.pop('aggs', None))
+    return {'query': search_dict, 'compound_het': is_compound_het}
+
+
+def _get_grouped_variants_sort(grouped_variants):
+    return grouped_variants.values()[0][0]['_sort']
+
+
 def _sort_compound_hets(grouped_variants):
-    return sorted(grouped_variants, key=lambda variants: variants.values()[0][0]['_sort'])
+    return sorted(grouped_variants, key=_get_grouped_variants_sort)
+
+
+def _merge_sorted_results(sorted_results_lists, get_sort):
+    """
+    Merges lists of results which are each already sorted, without re-sorting them. Tied results keep the order of their
+    lists, and then their order within each list, the same as a stable sort of the concatenated lists would
+    """
+    return [result for _, result in _iter_merged_sorted_results(sorted_results_lists, get_sort)]
+
+
+def _iter_merged_sorted_results(sorted_results_lists, get_sort):
+    """
+    Lazily merges lists of sorted results, yielding the index of the list each result is from with the result. Results
+    are only decorated as they are merged, so taking the first n results is O(n log k) for k lists
+    """
+    # heapq.merge does not support a key function in python 2, so results are decorated with their sort
+    decorated_results_lists = [
+        _decorate_sorted_results(results, list_index, get_sort) for list_index, results in enumerate(sorted_results_lists)
+    ]
+    for _, list_index, _, result in heapq.merge(*decorated_results_lists):
+        yield list_index, result
+
+
+def _get_merged_results_page(sorted_results_lists, num_results):
+    """
+    Merges sorted variant results until there are num_results distinct variants, so unreturned results do not need to
+    be merged on every page. Copies of the last variant from other lists are included so they can be deduplicated.
+    All the results are merged if num_results is None. Returns the merged results and the number of results used from
+    each list
+    """
+    merged_results = []
+    merged_variant_ids = set()
+    num_used_by_list = [0] * len(sorted_results_lists)
+    for list_index, variant in _iter_merged_sorted_results(sorted_results_lists, lambda variant: variant['_sort']):
+        if num_results is not None and len(merged_variant_ids) >= num_results and \
+                variant['variantId'] not in merged_variant_ids:
+            break
+        merged_results.append(variant)
+        merged_variant_ids.add(variant['variantId'])
+        num_used_by_list[list_index] += 1
+    return merged_results, num_used_by_list
+
+
+def _decorate_sorted_results(results, list_index, get_sort):
+    for result_index, result in enumerate(results):
+        yield get_sort(result), list_index, result_index, result
 
 
 def _get_compound_het_page(grouped_variants, start_index, end_index):
-    skipped = 0
+    end_index = max(end_index, 1)
+    if len(grouped_variants) < end_index:
+        return None
+
     variant_results = []
-    variant_count = 0
-    for variants in grouped_variants:
+    for variants in grouped_variants[start_index:end_index]:
         curr_variant = variants.values()[0]
-        if skipped < start_index:
-            skipped += 1
+        if len(curr_variant) == 1:
+            variant_results += curr_variant
         else:
-            if len(curr_variant) == 1:
-                variant_results += curr_variant
-            else:
-                variant_results.append(curr_variant)
-            variant_count += 1
-        if variant_count + skipped >= end_index:
-            return variant_results
-    return None
+            variant_results.append(curr_variant)
+    return variant_results
 
 
 def _parse_es_sort(sort, sort_config):
@@ -1275,21 +1813,53 @@ def _parse_es_sort(sort, sort_config):
     return sort
 
 
-def _get_field_values(hit, field_configs, format_response_key=_to_camel_case, get_addl_fields=None, lookup_field_prefix='', existing_fields=None):
+def _compile_field_configs(field_configs, format_response_key=_to_camel_case, get_addl_fields=None, lookup_field_prefix='', existing_fields=None):
+    """
+    Resolves the response key, lookup keys and missing value for each field ahead of time
+    Returns a list of (response_key, lookup_keys, format_value, default_value, missing_value) tuples
+    """
+    compiled_fields = []
+    for field, field_config in field_configs.items():
+        keys = (get_addl_fields(field) if get_addl_fields else []) + \
+            ['{}_{}'.format(lookup_field_prefix, field) if lookup_field_prefix else field]
+        default_value = field_config.get('default_value')
+        missing_value = default_value if not existing_fields or any(key in existing_fields for key in keys) else None
+        compiled_fields.append((
+            field_config.get('response_key', format_response_key(field)), keys, field_config.get('format_value'),
+            default_value, missing_value,
+        ))
+    return compiled_fields
+
+
+def _compile_index_field_parsers(existing_fields):
     return {
-        field_config.get('response_key', format_response_key(field)): _value_if_has_key(
-            hit,
-            (get_addl_fields(field) if get_addl_fields else []) +
-            ['{}_{}'.format(lookup_field_prefix, field) if lookup_field_prefix else field],
-            existing_fields=existing_fields,
-            **field_config
-        )
-        for field, field_config in field_configs.items()
+        'core': _compile_field_configs(CORE_FIELDS_CONFIG, format_response_key=str),
+        'nested': {
+            field_name: _compile_field_configs(fields, lookup_field_prefix=field_name)
+            for field_name, fields in NESTED_FIELDS.items()
+        },
+        'populations': {
+            population: _compile_field_configs(
+                POPULATION_RESPONSE_FIELD_CONFIGS, format_response_key=lambda key: key.lower(),
+                lookup_field_prefix=population, existing_fields=existing_fields,
+                get_addl_fields=lambda field: pop_config[field] if isinstance(pop_config[field], list) else [pop_config[field]],
+            )
+            for population, pop_config in POPULATIONS.items()
+        },
+        'predictions': _compile_field_configs(
+            PREDICTION_FIELDS_CONFIG, format_response_key=lambda key: key.split('_')[1].lower()),
+        'genotypes': _compile_field_configs(GENOTYPE_FIELDS_CONFIG),
     }
 
 
-def _value_if_has_key(hit, keys, format_value=None, default_value=None, existing_fields=None, **kwargs):
-    for key in keys:
-        if key in hit:
-            return format_value(default_value if hit[key] is None else hit[key]) if format_value else hit[key]
-    return default_value if not existing_fields or any(key in existing_fields for key in keys) else None
\ No newline at end of file
+def _get_compiled_field_values(hit, compiled_fields):
+    values = {}
+    for response_key, keys, format_value, default_value, missing_value in compiled_fields:
+        for key in keys:
+            if key in hit:
+                value = hit[key]
+                values[response_key] = format_value(default_value if value is None else value) if format_value else value
+                break
+        else:
+            values[response_key] = missing_value
+    return values
\ No newline at end of file
@@ -1,13 +1,24 @@
 from copy import deepcopy
+import hashlib
 import mock
 import json
+import redis
 from collections import defaultdict
+from itertools import combinations
 from django.test import TestCase
+from elasticsearch_dsl.utils import AttrDict
 
 from seqr.models import Family, Sample, VariantSearch, VariantSearchResults
 from seqr.utils.elasticsearch.utils import get_es_variants_for_variant_tuples, get_single_es_variant, get_es_variants, \
-    get_es_variant_gene_counts, get_es_variants_for_variant_ids
-from seqr.utils.elasticsearch.es_search import _get_family_affected_status
+    get_es_variant_gene_counts, get_es_variants_for_variant_ids, get_es_client, get_search_results_cache_key, \
+    invalidate_project_search_results, get_search_thread_pool, get_index_sample_counts, update_index_sample_counts, \
+    get_search_query_plan_cache_key, prefetch_es_variants, get_es_variant_counts, SEARCH_RESULTS_CACHE_LIST_FIELDS, SEARCH_RESULTS_CACHE_CHUNK_SIZE, INDEX_SAMPLE_COUNTS_CACHE_KEY, \
+    _SEARCH_PREFETCHES
+from seqr.utils.elasticsearch.constants import MAX_VARIANTS
+from seqr.utils.elasticsearch.es_search import EsSearch, SearchSample, _get_family_affected_status, \
+    _get_valid_compound_het_index_pairs, _merge_sorted_results, _get_merged_results_page
+from seqr.utils.liftover_utils import BatchLiftOver
+from seqr.utils.redis_utils import safe_redis_get_chunked_json, safe_redis_set_chunked_json, RedisChunkedList
 
 INDEX_NAME = 'test_index'
 SECOND_INDEX_NAME = 'test_index_second'
@@ -392,6 +403,8 @@ EXTRA_FAMILY_ES_VARIANTS = deepcopy(ES_VARIANTS) + [deepcopy(ES_VARIANTS[0])]
 EXTRA_FAMILY_ES_VARIANTS[2]['matched_queries'][INDEX_NAME] = ['F000005_5']
 MISSING_SAMPLE_ES_VARIANTS = deepcopy(ES_VARIANTS)
 MISSING_SAMPLE_ES_VARIANTS[1]['_source']['samples_num_alt_1'] = []
+COMPOUND_HET_GENE_DOC_COUNTS = {'ENSG00000135953': 3, 'ENSG00000228198': 2}
+
 COMPOUND_HET_INDEX_VARIANTS = {
     INDEX_NAME: {'ENSG00000135953': EXTRA_FAMILY_ES_VARIANTS, 'ENSG00000228198': EXTRA_FAMILY_ES_VARIANTS},
     SECOND_INDEX_NAME: {
@@ -1027,14 +1040,125 @@ RECESSIVE_INHERITANCE_QUERY = {
 ANNOTATION_QUERY = {'terms': {'transcriptConsequenceTerms': ['frameshift_variant']}}
 
 REDIS_CACHE = {}
-def _set_cache(k, v):
+def _set_cache(k, v, ex=None):
     REDIS_CACHE[k] = v
-MOCK_REDIS = mock.MagicMock()
-MOCK_REDIS.get.side_effect = REDIS_CACHE.get
-MOCK_REDIS.set.side_effect =_set_cache
+
+
+class MockRedis(object):
+    """In-memory redis supporting the commands used to cache search results"""
+
+    @staticmethod
+    def _get_typed_value(key, value_type):
+        value = REDIS_CACHE.get(key)
+        if value is not None and not isinstance(value, value_type):
+            raise redis.ResponseError('WRONGTYPE Operation against a key holding the wrong kind of value')
+        return value
+
+    def get(self, key):
+        value = REDIS_CACHE.get(key)
+        return None if isinstance(value, (dict, list)) else value
+
+    def set(self, key, value, ex=None, nx=False):
+        if not (nx and key in REDIS_CACHE):
+            _set_cache(key, value)
+
+    def mget(self, keys):
+        return [self.get(key) for key in keys]
+
+    def incr(self, key):
+        REDIS_CACHE[key] = int(REDIS_CACHE.get(key, 0)) + 1
+        return REDIS_CACHE[key]
+
+    def delete(self, *keys):
+        for key in keys:
+            REDIS_CACHE.pop(key, None)
+
+    def expire(self, key, seconds):
+        pass
+
+    def hgetall(self, key):
+        value = self._get_typed_value(key, dict) or {}
+        return {field.encode('utf-8'): field_value for field, field_value in value.items()}
+
+    def hget(self, key, field):
+        return (self._get_typed_value(key, dict) or {}).get(field)
+
+    def hmset(self, key, mapping):
+        REDIS_CACHE.setdefault(key, {}).update(mapping)
+
+    def hmget(self, key, fields):
+        value = self._get_typed_value(key, dict) or {}
+        return [value.get(field) for field in fields]
+
+    def hsetnx(self, key, field, value):
+        REDIS_CACHE.setdefault(key, {}).setdefault(field, value)
+
+    def lrange(self, key, start, end):
+        return (self._get_typed_value(key, list) or [])[start:None if end == -1 else end + 1]
+
+    def lset(self, key, index, value):
+        REDIS_CACHE[key][index] = value
+
+    def rpush(self, key, *values):
+        REDIS_CACHE.setdefault(key, []).extend(values)
+
+    def llen(self, key):
+        return len(self._get_typed_value(key, list) or [])
+
+    def zadd(self, key, mapping):
+        REDIS_CACHE.setdefault(key, {}).update(mapping)
+
+    def zremrangebyscore(self, key, min_score, max_score):
+        pass
+
+    def pipeline(self, **kwargs):
+        return MockRedisPipeline()
+
+
+class MockRedisPipeline(object):
+    """Queues commands until executed, except for commands between a call to watch and a call to multi"""
+
+    def __init__(self):
+        self._redis = MockRedis()
+        self._queued_commands = []
+        self._is_immediate = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def __getattr__(self, name):
+        command = getattr(self._redis, name)
+        if self._is_immediate:
+            return command
+
+        def _queue_command(*args, **kwargs):
+            self._queued_commands.append((command, args, kwargs))
+        return _queue_command
+
+    def watch(self, *keys):
+        self._is_immediate = True
+
+    def multi(self):
+        self._is_immediate = False
+
+    def execute(self):
+        results = [command(*args, **kwargs) for command, args, kwargs in self._queued_commands]
+        self._queued_commands = []
+        return results
+
+MOCK_REDIS = MockRedis()
+
+
+def _get_cache_key(results_model, sort='xpos'):
+    project_guids = sorted(set(results_model.families.values_list('project__guid', flat=True)))
+    return get_search_results_cache_key(results_model, sort, project_guids)
 
 MOCK_LIFTOVER = mock.MagicMock()
 MOCK_LIFTOVER.convert_coordinate.side_effect = lambda chrom, pos: [[chrom, pos - 10]]
+MOCK_BATCH_LIFTOVER = BatchLiftOver(MOCK_LIFTOVER)
 
 MOCK_ES_CLIENT = mock.MagicMock()
 MOCK_ES_CLIENT.indices.get_mapping.side_effect = lambda index='': {
@@ -1043,7 +1167,7 @@ MOCK_ES_CLIENT.indices.get_mapping.side_effect = lambda index='': {
 
 class MockHit:
 
-    def __init__(self, matched_queries=None, _source=None, increment_sort=False, no_matched_queries=False, sort=None, index=INDEX_NAME):
+    def __init__(self, matched_queries=None, _source=None, increment_sort=False, no_matched_queries=False, sort=None, index=INDEX_NAME, genotype_sample_ids=None):
         self.meta = mock.MagicMock()
         self.meta.index = index
         if no_matched_queries:
@@ -1065,6 +1189,12 @@ class MockHit:
         else:
             del self.meta.sort
         self._dict = _source
+        if genotype_sample_ids is None:
+            del self.meta.inner_hits
+        else:
+            self.meta.inner_hits.to_dict.return_value = {'genotypes': {'hits': {'hits': [
+                {'_source': genotype} for genotype in self._dict.pop('genotypes') if genotype['sample_id'] in genotype_sample_ids
+            ]}}}
         mock_transcripts = []
         for transcript in self._dict['sortedTranscriptConsequences']:
             mock_transcript = mock.MagicMock()
@@ -1083,8 +1213,13 @@ def create_mock_response(search, index=INDEX_NAME):
     indices = index.split(',')
     no_matched_queries = True
     variant_id_filters = None
+    genotype_sample_ids = None
     if 'query' in search:
-        for search_filter in search['query']['bool']['filter']:
+        query = search['query']
+        if query['bool'].get('should'):
+            genotype_sample_ids = query['bool']['should'][0]['nested']['query']['terms']['genotypes.sample_id']
+            query = query['bool']['filter'][0] if query['bool'].get('filter') else {'bool': {}}
+        for search_filter in query['bool'].get('filter', []):
             if not variant_id_filters:
                 variant_id_filters = search_filter.get('terms', {}).get('variantId')
             possible_inheritance_filters = search_filter.get('bool', {}).get('should', [])
@@ -1097,7 +1232,8 @@ def create_mock_response(search, index=INDEX_NAME):
     hits = []
     for index_name in sorted(indices):
         index_hits = [
-            MockHit(no_matched_queries=no_matched_queries, sort=search.get('sort'), index=index_name, **var)
+            MockHit(no_matched_queries=no_matched_queries, sort=search.get('sort'), index=index_name,
+                    genotype_sample_ids=genotype_sample_ids, **var)
             for var in deepcopy(INDEX_ES_VARIANTS[index_name])
         ]
         if variant_id_filters:
@@ -1109,15 +1245,32 @@ def create_mock_response(search, index=INDEX_NAME):
     else:
         mock_response.hits.__nonzero__.return_value = False
 
-    if search.get('aggs'):
+    if search.get('aggs', {}).get('families'):
+        mock_response.aggregations.to_dict.return_value = {'families': {'buckets': {
+            family_guid: {'doc_count': len(hits)} for family_guid in search['aggs']['families']['filters']['filters']
+        }}}
+
+    if search.get('aggs', {}).get('genes'):
         index_vars = COMPOUND_HET_INDEX_VARIANTS.get(index, {})
-        mock_response.aggregations.genes.buckets = [{'key': gene_id, 'doc_count': 3}
-                                                    for gene_id in ['ENSG00000135953', 'ENSG00000228198']]
+        gene_ids = ['ENSG00000135953', 'ENSG00000228198']
+        if 'composite' in search['aggs']['genes']:
+            gene_agg = search['aggs']['genes']['composite']
+            after_gene_id = gene_agg.get('after', {}).get('gene_id')
+            gene_ids = [gene_id for gene_id in gene_ids if not after_gene_id or gene_id > after_gene_id][:gene_agg['size']]
+            mock_response.aggregations.genes.buckets = [
+                {'key': {'gene_id': gene_id}, 'doc_count': COMPOUND_HET_GENE_DOC_COUNTS[gene_id]} for gene_id in gene_ids
+            ]
+            if gene_ids:
+                mock_response.aggregations.genes.after_key = AttrDict({'gene_id': gene_ids[-1]})
+            else:
+                del mock_response.aggregations.genes.after_key
+        else:
+            mock_response.aggregations.genes.buckets = [{'key': gene_id, 'doc_count': 3} for gene_id in gene_ids]
         if search['aggs']['genes']['aggs'].get('vars_by_gene'):
-            for bucket in mock_response.aggregations.genes.buckets:
+            for bucket, gene_id in zip(mock_response.aggregations.genes.buckets, gene_ids):
                 bucket['vars_by_gene'] = [MockHit(increment_sort=True, index=index, **var)
-                                          for var in deepcopy(index_vars.get(bucket['key'], ES_VARIANTS))]
-        else:
+                                          for var in deepcopy(index_vars.get(gene_id, ES_VARIANTS))]
+        elif 'terms' in search['aggs']['genes']:
             for bucket in mock_response.aggregations.genes.buckets:
                 for sample_field in ['samples', 'samples_num_alt_1', 'samples_num_alt_2']:
                     gene_samples = defaultdict(int)
@@ -1132,7 +1285,8 @@ def create_mock_response(search, index=INDEX_NAME):
 
 @mock.patch('seqr.utils.redis_utils.redis.StrictRedis', lambda **kwargs: MOCK_REDIS)
 @mock.patch('seqr.utils.elasticsearch.utils.elasticsearch.Elasticsearch', lambda **kwargs: MOCK_ES_CLIENT)
-@mock.patch('seqr.utils.elasticsearch.es_search._liftover_grch38_to_grch37', lambda: MOCK_LIFTOVER)
+@mock.patch.dict('seqr.utils.elasticsearch.utils._ES_CLIENTS', clear=True)
+@mock.patch('seqr.utils.elasticsearch.es_search.get_liftover', lambda genome_version, **kwargs: MOCK_BATCH_LIFTOVER)
 class EsUtilsTest(TestCase):
     fixtures = ['users', '1kg_project', 'reference_data']
     multi_db = True
@@ -1144,24 +1298,31 @@ class EsUtilsTest(TestCase):
         self.searched_indices = []
 
         def mock_execute_search(search):
-            self.executed_search = deepcopy(search.to_dict())
+            executed_search = deepcopy(search.to_dict())
+            if isinstance(executed_search, dict) and \
+                    executed_search.get('aggs', {}).get('genes', {}).get('composite', {}).get('after'):
+                # Later pages of compound het genes are not recorded, so assertions check the initial search
+                return create_mock_response(executed_search, index=','.join(search._index))
+
+            self.executed_search = executed_search
             self.searched_indices += search._index
 
             if isinstance(self.executed_search, list):
                 return [create_mock_response(exec_search, index=','.join(self.executed_search[i-1]['index']))
                         for i, exec_search in enumerate(self.executed_search) if not exec_search.get('index')]
             else:
-                return create_mock_response(self.executed_search, index=','.join(self.searched_indices))
+                return create_mock_response(self.executed_search, index=','.join(search._index))
 
         patcher = mock.patch('seqr.utils.elasticsearch.es_search.EsSearch._execute_search')
-        patcher.start().side_effect = mock_execute_search
+        self.mock_execute_search = patcher.start()
+        self.mock_execute_search.side_effect = mock_execute_search
         self.addCleanup(patcher.stop)
 
-    def assertExecutedSearch(self, filters=None, start_index=0, size=2, sort=None, gene_aggs=False, gene_count_aggs=None, index=INDEX_NAME):
+    def assertExecutedSearch(self, filters=None, start_index=0, size=2, sort=None, gene_aggs=False, gene_count_aggs=None, index=INDEX_NAME, search_after=None):
         self.assertIsInstance(self.executed_search, dict)
         self.assertListEqual(sorted(self.searched_indices), sorted(index.split(',')))
         self.assertSameSearch(
-            self.executed_search, dict(filters=filters, start_index=start_index, size=size, sort=sort, gene_aggs=gene_aggs, gene_count_aggs=gene_count_aggs)
+            self.executed_search, dict(filters=filters, start_index=start_index, size=size, sort=sort, gene_aggs=gene_aggs, gene_count_aggs=gene_count_aggs, search_after=search_after)
         )
         self.executed_search = None
         self.searched_indices = []
@@ -1191,12 +1352,20 @@ class EsUtilsTest(TestCase):
         if expected_search_params.get('sort'):
             expected_search['sort'] = expected_search_params['sort']
 
+        if expected_search_params.get('search_after'):
+            expected_search['search_after'] = expected_search_params['search_after']
+
         if expected_search_params.get('gene_aggs'):
             expected_search['aggs'] = {
-                'genes': {'terms': {'field': 'geneIds', 'min_doc_count': 2, 'size': 1001}, 'aggs': {
+                'genes': {'composite': {
+                    'sources': [{'gene_id': {'terms': {'field': 'geneIds'}}}], 'size': 1000,
+                }, 'aggs': {
                     'vars_by_gene': {
                         'top_hits': {'sort': expected_search_params['sort'], '_source': mock.ANY, 'size': 100}
-                    }
+                    },
+                    'min_doc_count': {'bucket_selector': {
+                        'buckets_path': {'doc_count': '_count'}, 'script': 'params.doc_count > 1',
+                    }},
                 }}}
         elif expected_search_params.get('gene_count_aggs'):
             expected_search['aggs'] = {'genes': {
@@ -1214,7 +1383,16 @@ class EsUtilsTest(TestCase):
             self.assertSetEqual(SOURCE_FIELDS, set(source))
 
     def assertCachedResults(self, results_model, expected_results, sort='xpos'):
-        self.assertDictEqual(json.loads(REDIS_CACHE.get('search_results__{}__{}'.format(results_model.guid, sort))), expected_results)
+        cached_results = safe_redis_get_chunked_json(
+            _get_cache_key(results_model, sort=sort), SEARCH_RESULTS_CACHE_LIST_FIELDS)
+        cached_results = {k: v[:] if isinstance(v, RedisChunkedList) else v for k, v in cached_results.items()}
+        # The sample topology is always cached with the results, and is only checked by tests which expect it
+        sample_topology = cached_results.pop('sample_topology', None)
+        self.assertIsInstance(sample_topology, dict)
+        if 'sample_topology' in expected_results:
+            expected_results = dict(expected_results)
+            self.assertDictEqual(sample_topology, expected_results.pop('sample_topology'))
+        self.assertDictEqual(cached_results, expected_results)
 
     def test_get_es_variants_for_variant_tuples(self):
         variants = get_es_variants_for_variant_tuples(
@@ -1262,6 +1440,95 @@ class EsUtilsTest(TestCase):
             get_single_es_variant(self.families, '10-10334333-A-G')
         self.assertEqual(str(cm.exception), 'Variant 10-10334333-A-G not found')
 
+    @mock.patch('seqr.utils.elasticsearch.es_search.MAX_INDEX_NAME_LENGTH', 10)
+    def test_index_alias(self):
+        index_name = ','.join([INDEX_NAME, SV_INDEX_NAME])
+        alias = hashlib.md5(index_name).hexdigest()
+        alias_cache_key = 'index_alias__{}'.format(alias)
+        metadata_cache_key = 'index_metadata__{}'.format(alias)
+        self.addCleanup(_set_cache, alias_cache_key, None)
+        self.addCleanup(_set_cache, metadata_cache_key, None)
+
+        with mock.patch.object(MOCK_ES_CLIENT.indices, 'get_mapping') as mock_get_mapping, \
+                mock.patch.object(MOCK_ES_CLIENT.indices, 'update_aliases') as mock_update_aliases, \
+                mock.patch.object(MOCK_REDIS, 'mget', wraps=MOCK_REDIS.mget) as mock_mget, \
+                mock.patch.object(MOCK_REDIS, 'pipeline', wraps=MOCK_REDIS.pipeline) as mock_pipeline:
+            mock_get_mapping.return_value = {
+                index: {'mappings': INDEX_METADATA[index]} for index in [INDEX_NAME, SV_INDEX_NAME]}
+
+            # The alias and metadata are loaded from redis together, and both are cached together
+            es_search = EsSearch(self.families)
+            self.assertEqual(es_search.index_name, alias)
+            self.assertSetEqual(set(es_search.index_metadata.keys()), {INDEX_NAME, SV_INDEX_NAME})
+            mock_mget.assert_called_once_with([alias_cache_key, metadata_cache_key])
+            mock_update_aliases.assert_called_once()
+            alias_action = mock_update_aliases.call_args[1]['body']['actions'][0]['add']
+            self.assertEqual(alias_action['alias'], alias)
+            self.assertListEqual(sorted(alias_action['indices']), [INDEX_NAME, SV_INDEX_NAME])
+            mock_get_mapping.assert_called_once_with(index=alias)
+            mock_pipeline.assert_called_once()
+            self.assertEqual(json.loads(REDIS_CACHE[alias_cache_key]), index_name)
+            self.assertSetEqual(set(json.loads(REDIS_CACHE[metadata_cache_key]).keys()), {INDEX_NAME, SV_INDEX_NAME})
+
+            # Cached aliases and metadata are not loaded from ES
+            mock_mget.reset_mock()
+            mock_update_aliases.reset_mock()
+            mock_get_mapping.reset_mock()
+            mock_pipeline.reset_mock()
+            es_search = EsSearch(self.families)
+            self.assertEqual(es_search.index_name, alias)
+            self.assertSetEqual(set(es_search.index_metadata.keys()), {INDEX_NAME, SV_INDEX_NAME})
+            mock_mget.assert_called_once_with([alias_cache_key, metadata_cache_key])
+            mock_update_aliases.assert_not_called()
+            mock_get_mapping.assert_not_called()
+            mock_pipeline.assert_not_called()
+
+    def test_get_single_es_variant_nested_genotypes(self):
+        index_metadata_cache_key = 'index_metadata__{},{}'.format(INDEX_NAME, SV_INDEX_NAME)
+        _set_cache(index_metadata_cache_key, None)
+        self.addCleanup(_set_cache, index_metadata_cache_key, None)
+        nested_properties = {'genotypes': {'type': 'nested'}}
+        with mock.patch.dict(INDEX_METADATA[INDEX_NAME]['variant']['properties'], nested_properties), \
+                mock.patch.dict(INDEX_METADATA[SV_INDEX_NAME]['structural_variant']['properties'], nested_properties):
+            variant = get_single_es_variant(self.families, '2-103343353-GAGA-G')
+        self.assertDictEqual(variant, PARSED_NO_SORT_VARIANTS[1])
+
+        # Only the genotypes for the searched samples are loaded
+        self.assertSetEqual(set(self.executed_search['_source']), SOURCE_FIELDS - {'genotypes'})
+        self.assertDictEqual(self.executed_search['query'], {'bool': {
+            'filter': [{'bool': {'filter': [{'terms': {'variantId': ['2-103343353-GAGA-G']}}]}}],
+            'should': [{'nested': {
+                'path': 'genotypes',
+                'score_mode': 'none',
+                'inner_hits': {'size': 5},
+                'query': {'terms': {'genotypes.sample_id': ['HG00731', 'HG00732', 'HG00733', 'NA20870', 'NA20874']}},
+            }}],
+        }})
+
+    def test_get_es_variants_nested_genotypes_no_filters(self):
+        index_metadata_cache_key = 'index_metadata__{},{}'.format(INDEX_NAME, SV_INDEX_NAME)
+        _set_cache(index_metadata_cache_key, None)
+        self.addCleanup(_set_cache, index_metadata_cache_key, None)
+        search_model = VariantSearch.objects.create(search={})
+        results_model = VariantSearchResults.objects.create(variant_search=search_model)
+        results_model.families.set(self.families)
+
+        with mock.patch.dict(
+                INDEX_METADATA[SV_INDEX_NAME]['structural_variant']['properties'], {'genotypes': {'type': 'nested'}}):
+            variants, _ = get_es_variants(results_model, num_results=5)
+        self.assertListEqual(variants, [PARSED_SV_VARIANT] + PARSED_VARIANTS)
+
+        # Searches without any filters only query the nested genotypes
+        self.assertDictEqual(self.executed_search[0], {'index': [SV_INDEX_NAME]})
+        sv_search = self.executed_search[1]
+        self.assertSetEqual(set(sv_search['_source']), SOURCE_FIELDS - {'genotypes'})
+        self.assertDictEqual(sv_search['query'], {'bool': {'should': [{'nested': {
+            'path': 'genotypes',
+            'score_mode': 'none',
+            'inner_hits': {'size': 2},
+            'query': {'terms': {'genotypes.sample_id': ['HG00731', 'HG00732']}},
+        }}]}})
+
     def test_get_es_variants(self):
         search_model = VariantSearch.objects.create(search={'annotations': {'frameshift': ['frameshift_variant']}})
         results_model = VariantSearchResults.objects.create(variant_search=search_model)
@@ -1274,6 +1541,10 @@ class EsUtilsTest(TestCase):
         self.assertEqual(total_results, 5)
 
         self.assertCachedResults(results_model, {'all_results': variants, 'total_results': 5})
+        cache_key = _get_cache_key(results_model)
+        self.assertTrue({
+            cache_key, '{}__all_results'.format(cache_key), '{}__grouped_results'.format(cache_key)
+        }.issubset(REDIS_CACHE['project_search_results__R0001_1kg'].keys()))
 
         self.assertExecutedSearch(filters=[ANNOTATION_QUERY, ALL_INHERITANCE_QUERY], sort=['xpos'])
 
@@ -1297,11 +1568,99 @@ class EsUtilsTest(TestCase):
         self.assertListEqual(variants, PARSED_VARIANTS + PARSED_VARIANTS[:1])
         self.assertEqual(total_results, 5)
 
-        # test load_all
-        variants, _ = get_es_variants(results_model, page=1, num_results=2, load_all=True)
-        self.assertExecutedSearch(filters=[ANNOTATION_QUERY, ALL_INHERITANCE_QUERY], sort=['xpos'], start_index=4, size=1)
-        self.assertEqual(len(variants), 5)
-        self.assertListEqual(variants, PARSED_VARIANTS + PARSED_VARIANTS + PARSED_VARIANTS[:1])
+        # test updating project data invalidates cached results
+        cache_key = _get_cache_key(results_model)
+        invalidate_project_search_results(results_model.families.first().project)
+        self.assertNotEqual(_get_cache_key(results_model), cache_key)
+        get_es_variants(results_model, page=1, num_results=2)
+        self.assertExecutedSearch(filters=[ANNOTATION_QUERY, ALL_INHERITANCE_QUERY], sort=['xpos'])
+
+    def test_get_es_variants_past_max_variants(self):
+        search_model = VariantSearch.objects.create(search={'annotations': {'frameshift': ['frameshift_variant']}})
+        results_model = VariantSearchResults.objects.create(variant_search=search_model)
+        results_model.families.set(self.families)
+
+        loaded_results = [{'variantId': str(i)} for i in range(MAX_VARIANTS)]
+        cursor = {
+            'after': [1000000000], 'sort': [1248367227], 'skip': ['test_index/1-248367227-TC-T'], 'loaded': MAX_VARIANTS,
+        }
+        safe_redis_set_chunked_json(
+            _get_cache_key(results_model),
+            {'all_results': loaded_results, 'total_results': MAX_VARIANTS + 5, 'search_cursors': {INDEX_NAME: cursor}},
+            SEARCH_RESULTS_CACHE_LIST_FIELDS, SEARCH_RESULTS_CACHE_CHUNK_SIZE)
+
+        execute_search = self.mock_execute_search.side_effect
+
+        def _execute_search(search):
+            response = execute_search(search)
+            response.hits.total = MAX_VARIANTS + 5
+            return response
+        self.mock_execute_search.side_effect = _execute_search
+
+        # Skipped variants tied with the cursor count towards the ES request size limit
+        with self.assertRaises(Exception) as cm:
+            get_es_variants(results_model, page=2, num_results=MAX_VARIANTS)
+        self.assertEqual(str(cm.exception), 'Unable to load more than 10000 variants (10001 requested)')
+        self.assertIsNone(self.executed_search)
+
+        # Continues from the cursor instead of using an offset, and skips previously loaded variants tied with the cursor
+        variants, total_results = get_es_variants(results_model, page=MAX_VARIANTS // 2 + 1, num_results=2)
+        self.assertListEqual(variants, [PARSED_VARIANTS[1]])
+        self.assertEqual(total_results, MAX_VARIANTS + 5)
+        self.assertExecutedSearch(
+            filters=[ANNOTATION_QUERY, ALL_INHERITANCE_QUERY], sort=['xpos'], start_index=0, size=3,
+            search_after=[1000000000])
+        self.assertCachedResults(results_model, {
+            'all_results': loaded_results + [PARSED_VARIANTS[1]],
+            'total_results': MAX_VARIANTS + 5,
+            'search_cursors': {INDEX_NAME: {
+                'after': [1248367227], 'sort': [2103343353], 'skip': ['test_index/2-103343353-GAGA-G'],
+                'loaded': MAX_VARIANTS + 1,
+            }},
+        })
+
+        # Without a cursor, can not load past MAX_VARIANTS
+        invalidate_project_search_results(results_model.families.first().project)
+        with self.assertRaises(Exception) as cm:
+            get_es_variants(results_model, page=MAX_VARIANTS // 2 + 1, num_results=2)
+        self.assertEqual(str(cm.exception), 'Unable to load more than 10000 variants (10002 requested)')
+
+    def test_cached_sample_topology(self):
+        search_model = VariantSearch.objects.create(search={'annotations': {'frameshift': ['frameshift_variant']}})
+        results_model = VariantSearchResults.objects.create(variant_search=search_model)
+        results_model.families.set(self.families)
+
+        get_es_variants(results_model, num_results=2)
+        self.assertCachedResults(results_model, {
+            'all_results': PARSED_VARIANTS,
+            'total_results': 5,
+            'sample_topology': {
+                INDEX_NAME: {
+                    'F000002_2': {
+                        'HG00731': ['I000004_hg00731', 'A', 'F'],
+                        'HG00732': ['I000005_hg00732', 'N', 'M'],
+                        'HG00733': ['I000006_hg00733', 'N', 'F'],
+                    },
+                    'F000003_3': {'NA20870': ['I000007_na20870', 'A', 'M']},
+                    'F000005_5': {'NA20874': ['I000009_na20874', 'N', 'M']},
+                },
+                SV_INDEX_NAME: {
+                    'F000002_2': {
+                        'HG00731': ['I000004_hg00731', 'A', 'F'],
+                        'HG00732': ['I000005_hg00732', 'N', 'M'],
+                    },
+                },
+            },
+        })
+
+        # Subsequent pages use the cached topology and do not load any samples
+        self.searched_indices = []
+        with mock.patch('seqr.utils.elasticsearch.es_search.Sample.objects') as mock_samples:
+            variants, _ = get_es_variants(results_model, page=2, num_results=2)
+        mock_samples.filter.assert_not_called()
+        self.assertListEqual(variants, PARSED_VARIANTS)
+        self.assertExecutedSearch(
+            filters=[ANNOTATION_QUERY, ALL_INHERITANCE_QUERY], sort=['xpos'], start_index=2, size=2)
 
     def test_filtered_get_es_variants(self):
         search_model = VariantSearch.objects.create(search={
@@ -1620,6 +1979,48 @@ class EsUtilsTest(TestCase):
             dict(filters=[ALL_INHERITANCE_QUERY], start_index=0, size=5, sort=['xpos'], index=INDEX_NAME),
         ])
 
+    def test_paged_multi_dataset_get_es_variants(self):
+        search_model = VariantSearch.objects.create(search={})
+        results_model = VariantSearchResults.objects.create(variant_search=search_model)
+        results_model.families.set(self.families)
+
+        variants, _ = get_es_variants(results_model, num_results=1)
+        self.assertListEqual(variants, [PARSED_SV_VARIANT])
+
+        # Unreturned results are cached sorted by index, and only a page of them is merged
+        cached_results = safe_redis_get_chunked_json(_get_cache_key(results_model), SEARCH_RESULTS_CACHE_LIST_FIELDS)
+        self.assertDictEqual(cached_results['remaining_results_by_index'], {INDEX_NAME: PARSED_VARIANTS})
+        self.assertListEqual(cached_results['variant_results'], [])
+        self.assertDictEqual(cached_results['loaded_variant_counts'], {
+            SV_INDEX_NAME: {'loaded': 1, 'total': 5}, INDEX_NAME: {'loaded': 2, 'total': 5},
+        })
+
+        # Indices with enough unreturned results for the next page are not searched again
+        get_es_variants(results_model, page=2, num_results=1)
+        self.assertExecutedSearches([
+            dict(filters=None, start_index=1, size=1, sort=['xpos'], index=SV_INDEX_NAME),
+        ])
+
+    @mock.patch('seqr.utils.elasticsearch.es_search.ELASTICSEARCH_SEARCH_THREADS', 2)
+    @mock.patch('seqr.utils.elasticsearch.utils.ELASTICSEARCH_SEARCH_THREADS', 2)
+    def test_parallel_multi_dataset_get_es_variants(self):
+        search_model = VariantSearch.objects.create(search={})
+        results_model = VariantSearchResults.objects.create(variant_search=search_model)
+        results_model.families.set(self.families)
+
+        variants, _ = get_es_variants(results_model, num_results=5)
+        self.assertListEqual(variants, [PARSED_SV_VARIANT] + PARSED_VARIANTS)
+
+        executed_searches = sorted(
+            [call_args[0][0] for call_args in self.mock_execute_search.call_args_list], key=lambda search: search._index)
+        self.assertListEqual([search._index for search in executed_searches], [[INDEX_NAME], [SV_INDEX_NAME]])
+        self.assertDictEqual(executed_searches[0]._params, {'request_timeout': 60})
+        self.assertDictEqual(executed_searches[1]._params, {'request_timeout': 60})
+        self.assertSameSearch(
+            executed_searches[0].to_dict(), dict(filters=[ALL_INHERITANCE_QUERY], start_index=0, size=5, sort=['xpos']))
+        self.assertSameSearch(
+            executed_searches[1].to_dict(), dict(filters=None, start_index=0, size=5, sort=['xpos']))
+
     def test_compound_het_get_es_variants(self):
         search_model = VariantSearch.objects.create(search={
             'qualityFilter': {'min_gq': 10},
@@ -1651,6 +2052,34 @@ class EsUtilsTest(TestCase):
         get_es_variants(results_model, page=2, num_results=2)
         self.assertIsNone(self.executed_search)
 
+    @mock.patch('seqr.utils.elasticsearch.es_search.COMPOUND_HET_GENES_PAGE_SIZE', 1)
+    def test_paged_compound_het_get_es_variants(self):
+        search_model = VariantSearch.objects.create(search={
+            'qualityFilter': {'min_gq': 10},
+            'annotations': {'frameshift': ['frameshift_variant']},
+            'inheritance': {'mode': 'compound_het'},
+        })
+        results_model = VariantSearchResults.objects.create(variant_search=search_model)
+        results_model.families.set(self.families)
+
+        variants, total_results = get_es_variants(results_model, num_results=2)
+        self.assertListEqual(variants, [PARSED_COMPOUND_HET_VARIANTS])
+        self.assertEqual(total_results, 1)
+
+        # Genes are loaded one page at a time, until a page has no after key
+        self.assertEqual(self.mock_execute_search.call_count, 3)
+        executed_gene_aggs = [
+            call_args[0][0].to_dict()['aggs']['genes']['composite'] for call_args in self.mock_execute_search.call_args_list
+        ]
+        self.assertListEqual([gene_agg['size'] for gene_agg in executed_gene_aggs], [1, 1, 1])
+        self.assertListEqual([gene_agg.get('after') for gene_agg in executed_gene_aggs], [
+            None, {'gene_id': 'ENSG00000135953'}, {'gene_id': 'ENSG00000228198'},
+        ])
+        self.assertListEqual(
+            [call_args[0][0].to_dict()['query'] for call_args in self.mock_execute_search.call_args_list],
+            [{'bool': {'filter': [ANNOTATION_QUERY, COMPOUND_HET_INHERITANCE_QUERY]}}] * 3,
+        )
+
     def test_compound_het_get_es_variants_secondary_annotation(self):
         search_model = VariantSearch.objects.create(search={
             'qualityFilter': {'min_gq': 10},
@@ -1695,7 +2124,7 @@ class EsUtilsTest(TestCase):
             'annotations_secondary': {'other': ['intron']},
         }
         search_model.save()
-        _set_cache('search_results__{}__xpos'.format(results_model.guid), None)
+        _set_cache(_get_cache_key(results_model), None)
 
         variants, total_results = get_es_variants(results_model, num_results=2)
         self.assertIsNone(variants)
@@ -1776,6 +2205,141 @@ class EsUtilsTest(TestCase):
         get_es_variants(results_model, page=2, num_results=2)
         self.assertIsNone(self.executed_search)
 
+    @mock.patch('seqr.utils.elasticsearch.utils.parse_locus_list_items')
+    def test_cached_query_plan(self, mock_parse_locus_list_items):
+        mock_parse_locus_list_items.return_value = (None, None, [])
+        search_model = VariantSearch.objects.create(search={
+            'annotations': {'frameshift': ['frameshift_variant']},
+            'qualityFilter': {'min_gq': 10, 'vcf_filter': 'pass'},
+            'inheritance': {'mode': 'recessive'},
+        })
+        results_model = VariantSearchResults.objects.create(variant_search=search_model)
+        results_model.families.set(self.families)
+        project_guids = sorted(set(self.families.values_list('project__guid', flat=True)))
+        query_plan_cache_key = get_search_query_plan_cache_key(results_model, project_guids)
+        _set_cache(query_plan_cache_key, None)
+
+        def _get_executed_searches(sort):
+            _set_cache(_get_cache_key(results_model, sort=sort), None)
+            mock_parse_locus_list_items.reset_mock()
+            variants, _ = get_es_variants(results_model, sort=sort, num_results=2)
+            return variants, self.executed_search
+
+        variants, executed_searches = _get_executed_searches('xpos')
+        mock_parse_locus_list_items.assert_called_once()
+        query_plan = json.loads(REDIS_CACHE[query_plan_cache_key])
+        self.assertSetEqual(set(query_plan.keys()), {'es_search', 'search_kwargs', 'index_sample_counts'})
+        self.assertDictEqual(query_plan['index_sample_counts'], {INDEX_NAME: 6})
+        self.assertListEqual(
+            sorted(plan_search['compound_het'] for plan_search in query_plan['es_search']['index_searches'][INDEX_NAME]),
+            [False, True])
+
+        # Searches with a cached plan do not rebuild the search filters
+        cached_plan_variants, cached_plan_executed_searches = _get_executed_searches('xpos')
+        mock_parse_locus_list_items.assert_not_called()
+        self.assertListEqual(cached_plan_variants, variants)
+        self.assertListEqual(cached_plan_executed_searches, executed_searches)
+
+        # The cached plan is used with any sort
+        _, cached_plan_executed_searches = _get_executed_searches('cadd')
+        mock_parse_locus_list_items.assert_not_called()
+        _set_cache(query_plan_cache_key, None)
+        _, executed_searches = _get_executed_searches('cadd')
+        mock_parse_locus_list_items.assert_called_once()
+        self.assertListEqual(cached_plan_executed_searches, executed_searches)
+
+        # Updating a searched project's data invalidates the plan
+        invalidate_project_search_results(self.families.first().project)
+        _get_executed_searches('cadd')
+        mock_parse_locus_list_items.assert_called_once()
+
+        # Changing the number of active samples in a searched index invalidates the plan
+        _get_executed_searches('cadd')
+        mock_parse_locus_list_items.assert_not_called()
+        Sample.objects.filter(sample_id='NA19679').update(is_active=True)
+        update_index_sample_counts([INDEX_NAME])
+        _get_executed_searches('cadd')
+        mock_parse_locus_list_items.assert_called_once()
+        query_plan = json.loads(REDIS_CACHE[get_search_query_plan_cache_key(results_model, project_guids)])
+        self.assertDictEqual(query_plan['index_sample_counts'], {INDEX_NAME: 7})
+
+        Sample.objects.filter(sample_id='NA19679').update(is_active=False)
+        update_index_sample_counts([INDEX_NAME])
+
+    def test_refined_get_es_variants(self):
+        families = self.families.filter(guid__in=['F000003_3', 'F000005_5'])
+        parent_search = {'annotations': {'frameshift': ['frameshift_variant']}}
+        parent_search_model = VariantSearch.objects.create(search=parent_search)
+        parent_results_model = VariantSearchResults.objects.create(
+            variant_search=parent_search_model, search_hash='parent')
+        parent_results_model.families.set(families)
+        safe_redis_set_chunked_json(
+            _get_cache_key(parent_results_model), {'all_results': PARSED_VARIANTS, 'total_results': 2},
+            SEARCH_RESULTS_CACHE_LIST_FIELDS, SEARCH_RESULTS_CACHE_CHUNK_SIZE)
+
+        search_model = VariantSearch.objects.create(search=dict(parent_search, freqs={
+            'callset': {'af': 0.05}, 'exac': {'af': 0.0007, 'hh': 1},
+        }))
+        results_model = VariantSearchResults.objects.create(variant_search=search_model, search_hash='refined')
+        results_model.families.set(families)
+
+        # Refined searches are filtered from the fully loaded parent results
+        variants, total_results = get_es_variants(results_model, num_results=2, parent_search_model=parent_results_model)
+        self.mock_execute_search.assert_not_called()
+        self.assertListEqual(variants, [PARSED_VARIANTS[1]])
+        self.assertEqual(total_results, 1)
+        self.assertCachedResults(results_model, {'all_results': [PARSED_VARIANTS[1]], 'total_results': 1})
+
+        _set_cache(_get_cache_key(results_model), None)
+        search_model.search['freqs'] = {'exac': {'af': 0.0004}}
+        search_model.save()
+        variants, total_results = get_es_variants(results_model, num_results=2, parent_search_model=parent_results_model)
+        self.mock_execute_search.assert_not_called()
+        self.assertListEqual(variants, [PARSED_VARIANTS[1]])
+
+        # Compound het groups are only kept if all their variants pass the filters
+        _set_cache(_get_cache_key(results_model), None)
+        safe_redis_set_chunked_json(
+            _get_cache_key(parent_results_model), {
+                'grouped_results': [{'ENSG00000228198': PARSED_COMPOUND_HET_VARIANTS}, {None: [PARSED_VARIANTS[1]]}],
+                'total_results': 2,
+            }, SEARCH_RESULTS_CACHE_LIST_FIELDS, SEARCH_RESULTS_CACHE_CHUNK_SIZE)
+        variants, total_results = get_es_variants(results_model, num_results=2, parent_search_model=parent_results_model)
+        self.mock_execute_search.assert_not_called()
+        self.assertListEqual(variants, [PARSED_VARIANTS[1]])
+        self.assertEqual(total_results, 1)
+
+        # Searches which are not refinements of a fully loaded parent are loaded from ES
+        def _assert_not_refined(search, parent_results):
+            _set_cache(_get_cache_key(results_model), None)
+            search_model.search = search
+            search_model.save()
+            safe_redis_set_chunked_json(
+                _get_cache_key(parent_results_model), parent_results, SEARCH_RESULTS_CACHE_LIST_FIELDS,
+                SEARCH_RESULTS_CACHE_CHUNK_SIZE)
+            self.mock_execute_search.reset_mock()
+            get_es_variants(results_model, num_results=2, parent_search_model=parent_results_model)
+            self.mock_execute_search.assert_called_once()
+
+        loaded_parent_results = {'all_results': PARSED_VARIANTS, 'total_results': 2}
+        refined_search = dict(parent_search, freqs={'callset': {'af': 0.05}})
+        _assert_not_refined(refined_search, {'all_results': PARSED_VARIANTS, 'total_results': 5})
+        _assert_not_refined({'annotations': {'missense': ['missense_variant']}}, loaded_parent_results)
+        parent_search_model.search = dict(parent_search, freqs={'callset': {'af': 0.01}})
+        parent_search_model.save()
+        _assert_not_refined(refined_search, loaded_parent_results)
+        _assert_not_refined(dict(parent_search, freqs={'callset': {'ac': 1}}), loaded_parent_results)
+
+        # Frequencies parsed from more than one possible field can not be filtered locally
+        parent_search_model.search = parent_search
+        parent_search_model.save()
+        _assert_not_refined(dict(parent_search, freqs={'gnomad_genomes': {'af': 0.0004}}), loaded_parent_results)
+
+        # Frequency fields missing from some of the searched indices can not be filtered locally
+        parent_results_model.families.set(self.families)
+        results_model.families.set(self.families)
+        _assert_not_refined(dict(parent_search, freqs={'callset': {'af': 0.05}}), loaded_parent_results)
+
     def test_multi_datatype_recessive_get_es_variants(self):
         search_model = VariantSearch.objects.create(search={
             'annotations': {'frameshift': ['frameshift_variant'], 'structural': ['DEL']},
@@ -2190,6 +2754,36 @@ class EsUtilsTest(TestCase):
             size=4,
         )
 
+    def test_get_es_variants_missing_liftover(self):
+        search_model = VariantSearch.objects.create(search={
+            'annotations': {'frameshift': ['frameshift_variant']},
+            'locus': {'rawVariantItems': '2-103343363-GAGA-G', 'genomeVersion': '38'},
+        })
+        results_model = VariantSearchResults.objects.create(variant_search=search_model)
+        results_model.families.set(Family.objects.all())
+        project_guids = sorted(set(Family.objects.values_list('project__guid', flat=True)))
+        query_plan_cache_key = get_search_query_plan_cache_key(results_model, project_guids)
+
+        with mock.patch('seqr.utils.elasticsearch.es_search.get_liftover') as mock_get_liftover:
+            mock_get_liftover.return_value = None
+            get_es_variants(results_model, num_results=2)
+            mock_get_liftover.assert_called_with('38', wait=False)
+
+            # Results and query plans from before the liftover chain loads are not cached
+            self.assertIsNone(REDIS_CACHE.get(_get_cache_key(results_model)))
+            self.assertIsNone(REDIS_CACHE.get(query_plan_cache_key))
+            self.assertExecutedSearch(
+                index='{},{}'.format(INDEX_NAME, SECOND_INDEX_NAME),
+                filters=[{'terms': {'variantId': ['2-103343363-GAGA-G']}}, ANNOTATION_QUERY],
+                sort=['xpos'],
+                size=2,
+            )
+
+            # Single variant lookups are not run when serving search results, so wait for the chain to load
+            mock_get_liftover.reset_mock()
+            get_single_es_variant(Family.objects.all(), '2-103343363-GAGA-G')
+            mock_get_liftover.assert_called_with('38', wait=True)
+
     def test_get_es_variant_gene_counts(self):
         search_model = VariantSearch.objects.create(search={
             'annotations': {'frameshift': ['frameshift_variant']},
@@ -2207,7 +2801,7 @@ class EsUtilsTest(TestCase):
             'loaded_variant_counts': {'test_index_compound_het': {'total': 2, 'loaded': 2}, INDEX_NAME: {'loaded': 2, 'total': 5}},
             'total_results': 7,
         }
-        _set_cache('search_results__{}__xpos'.format(results_model.guid), json.dumps(initial_cached_results))
+        _set_cache(_get_cache_key(results_model), json.dumps(initial_cached_results))
 
         #  Test gene counts
         gene_counts = get_es_variant_gene_counts(results_model)
@@ -2246,7 +2840,7 @@ class EsUtilsTest(TestCase):
             },
             'total_results': 13,
         }
-        _set_cache('search_results__{}__xpos'.format(results_model.guid), json.dumps(initial_cached_results))
+        _set_cache(_get_cache_key(results_model), json.dumps(initial_cached_results))
 
         #  Test gene counts
         gene_counts = get_es_variant_gene_counts(results_model)
@@ -2291,7 +2885,7 @@ class EsUtilsTest(TestCase):
         })
         results_model = VariantSearchResults.objects.create(variant_search=search_model)
         results_model.families.set(Family.objects.all())
-        _set_cache('search_results__{}__xpos'.format(results_model.guid), json.dumps({'total_results': 5}))
+        _set_cache(_get_cache_key(results_model), json.dumps({'total_results': 5}))
         gene_counts = get_es_variant_gene_counts(results_model)
 
         self.assertDictEqual(gene_counts, {
@@ -2315,7 +2909,7 @@ class EsUtilsTest(TestCase):
     def test_cached_get_es_variant_gene_counts(self):
         search_model = VariantSearch.objects.create(search={})
         results_model = VariantSearchResults.objects.create(variant_search=search_model)
-        cache_key = 'search_results__{}__xpos'.format(results_model.guid)
+        cache_key = _get_cache_key(results_model)
 
         cached_gene_counts = {
             'ENSG00000135953': {'total': 5, 'families': {'F000003_3': 2, 'F000002_2': 1, 'F000011_11': 4}},
@@ -2353,14 +2947,139 @@ class EsUtilsTest(TestCase):
         })
         self.assertIsNone(self.executed_search)
 
+    def test_get_es_variant_counts(self):
+        self.addCleanup(lambda: [REDIS_CACHE.pop(k) for k in list(REDIS_CACHE.keys()) if k.startswith('search_counts__')])
+
+        search_model = VariantSearch.objects.create(search={
+            'annotations': {'frameshift': ['frameshift_variant']},
+            'inheritance': {'mode': 'recessive'},
+        })
+        results_model = VariantSearchResults.objects.create(variant_search=search_model)
+        results_model.families.set(self.families)
+
+        # Compound hets are counted from the genes with multiple matching variants
+        counts = get_es_variant_counts(results_model)
+        self.assertDictEqual(counts, {
+            'total': 10,
+            'indices': {INDEX_NAME: 5, '{}_compound_het'.format(INDEX_NAME): 5},
+            'families': {'F000002_2': 4, 'F000003_3': 4},
+        })
+        self.assertEqual(len(self.executed_search), 4)
+        self.assertSetEqual(
+            {tuple(sorted(search['aggs'].keys())) for search in self.executed_search[1::2]},
+            {('families',), ('families', 'genes')})
+        compound_het_search = next(search for search in self.executed_search[1::2] if 'genes' in search['aggs'])
+        self.assertDictEqual(compound_het_search['aggs']['genes'], {
+            'composite': {'sources': [{'gene_id': {'terms': {'field': 'geneIds'}}}], 'size': 1000},
+            'aggs': {'min_doc_count': {'bucket_selector': {
+                'buckets_path': {'doc_count': '_count'}, 'script': 'params.doc_count > 1',
+            }}},
+        })
+        self.assertEqual(compound_het_search['size'], 0)
+        self.assertNotIn('sort', compound_het_search)
+
+        search_model = VariantSearch.objects.create(search={'annotations': {'frameshift': ['frameshift_variant']}})
+        results_model = VariantSearchResults.objects.create(variant_search=search_model, search_hash='counts_search')
+        results_model.families.set(self.families)
+        counts = get_es_variant_counts(results_model)
+        self.assertDictEqual(counts, {
+            'total': 5, 'indices': {INDEX_NAME: 5}, 'families': {'F000002_2': 2, 'F000003_3': 2, 'F000005_5': 2},
+        })
+
+        self.assertIsInstance(self.executed_search, list)
+        self.assertEqual(len(self.executed_search), 2)
+        self.assertDictEqual(self.executed_search[0], {'index': [INDEX_NAME]})
+        family_queries = {
+            family_query['bool']['_name']: family_query for family_query in ALL_INHERITANCE_QUERY['bool']['should']
+        }
+        self.assertDictEqual(self.executed_search[1], {
+            'query': {'bool': {'filter': [ANNOTATION_QUERY, ALL_INHERITANCE_QUERY]}},
+            'from': 0,
+            'size': 0,
+            'track_total_hits': True,
+            'aggs': {'families': {'filters': {'filters': family_queries}}},
+        })
+
+        # counts are cached
+        self.executed_search = None
+        self.assertDictEqual(get_es_variant_counts(results_model), counts)
+        self.assertIsNone(self.executed_search)
+
+    @mock.patch('seqr.utils.elasticsearch.es_search.COMPOUND_HET_GENES_PAGE_SIZE', 1)
+    def test_get_multi_datatype_es_variant_counts(self):
+        self.addCleanup(lambda: [REDIS_CACHE.pop(k) for k in list(REDIS_CACHE.keys()) if k.startswith('search_counts__')])
+
+        search_model = VariantSearch.objects.create(search={
+            'annotations': {'frameshift': ['frameshift_variant'], 'structural': ['DEL']},
+            'inheritance': {'mode': 'recessive'},
+        })
+        results_model = VariantSearchResults.objects.create(variant_search=search_model)
+        results_model.families.set(self.families)
+
+        # Compound het genes are counted one page at a time
+        counts = get_es_variant_counts(results_model)
+        paired_index = ','.join([INDEX_NAME, SV_INDEX_NAME])
+        self.assertDictEqual(counts, {
+            'total': 20,
+            'indices': {
+                INDEX_NAME: 5, SV_INDEX_NAME: 5, '{}_compound_het'.format(INDEX_NAME): 5,
+                '{}_compound_het'.format(paired_index): 5,
+            },
+            'families': {'F000002_2': 6, 'F000003_3': 4},
+        })
+        self.assertEqual(self.mock_execute_search.call_count, 5)
+        page_searches = [call_args[0][0].to_dict() for call_args in self.mock_execute_search.call_args_list[1:]]
+        self.assertListEqual(
+            [search['aggs']['genes']['composite'].get('after') for search in page_searches],
+            [{'gene_id': 'ENSG00000135953'}, {'gene_id': 'ENSG00000228198'}] * 2)
+        self.assertSetEqual({tuple(search['aggs'].keys()) for search in page_searches}, {('genes',)})
+
+        # Families for compound het searches across data types are found from both indices
+        executed_searches = dict(zip(
+            [','.join(search['index']) for search in self.executed_search[::2]], self.executed_search[1::2]))
+        self.assertListEqual(
+            executed_searches[paired_index]['aggs']['families']['filters']['filters'].keys(), ['F000002_2'])
+
+    def test_get_index_sample_counts(self):
+        REDIS_CACHE.pop(INDEX_SAMPLE_COUNTS_CACHE_KEY, None)
+        self.addCleanup(REDIS_CACHE.pop, INDEX_SAMPLE_COUNTS_CACHE_KEY, None)
+
+        # Missing counts are computed in a single query
+        indices = [INDEX_NAME, SECOND_INDEX_NAME, 'missing_index']
+        with self.assertNumQueries(1):
+            self.assertDictEqual(get_index_sample_counts(indices), {
+                INDEX_NAME: 6, SECOND_INDEX_NAME: 1, 'missing_index': 0,
+            })
+
+        # Cached counts do not query the database
+        with self.assertNumQueries(0):
+            self.assertDictEqual(get_index_sample_counts([INDEX_NAME, SECOND_INDEX_NAME]), {
+                INDEX_NAME: 6, SECOND_INDEX_NAME: 1,
+            })
+
+        # Cached counts are only updated when explicitly recomputed
+        Sample.objects.filter(sample_id='NA19675').update(is_active=False)
+        self.assertEqual(get_index_sample_counts([INDEX_NAME])[INDEX_NAME], 6)
+        update_index_sample_counts([INDEX_NAME, None])
+        with self.assertNumQueries(0):
+            self.assertDictEqual(get_index_sample_counts(indices), {
+                INDEX_NAME: 5, SECOND_INDEX_NAME: 1, 'missing_index': 0,
+            })
+
     def test_get_family_affected_status(self):
         samples_by_id = {'F000002_2': {
-            sample_id: Sample.objects.get(sample_id=sample_id, dataset_type=Sample.DATASET_TYPE_VARIANT_CALLS)
-            for sample_id in ['HG00731', 'HG00732', 'HG00733']
+            'HG00731': SearchSample('HG00731', 'I000004_hg00731', 'A', 'F'),
+            'HG00732': SearchSample('HG00732', 'I000005_hg00732', 'N', 'M'),
+            'HG00733': SearchSample('HG00733', 'I000006_hg00733', 'N', 'F'),
         }}
         custom_affected = {'I000004_hg00731': 'N', 'I000005_hg00732': 'A'}
         custom_multi_affected = {'I000005_hg00732': 'A'}
 
+        # Sample records are immutable
+        sample = samples_by_id['F000002_2']['HG00731']
+        with self.assertRaises(AttributeError):
+            sample.affected = 'N'
+
         self.assertDictEqual(_get_family_affected_status(samples_by_id, {}), {
             'F000002_2': {'I000004_hg00731': 'A', 'I000005_hg00732': 'N', 'I000006_hg00733': 'N'}})
 
@@ -2372,6 +3091,49 @@ class EsUtilsTest(TestCase):
         self.assertDictEqual(custom_affected_status, {
             'F000002_2': {'I000004_hg00731': 'A', 'I000005_hg00732': 'A', 'I000006_hg00733': 'N'}})
 
+    def test_get_valid_compound_het_index_pairs(self):
+        variant_masks = [0b011, 0b100, 0b111, 0b001, 0b110, 0b000]
+        self.assertListEqual(_get_valid_compound_het_index_pairs(variant_masks, 0b111), [
+            (0, 1), (0, 2), (0, 4), (1, 2), (2, 3), (2, 4), (2, 5), (3, 4),
+        ])
+        self.assertListEqual(
+            _get_valid_compound_het_index_pairs(variant_masks, 0b111),
+            [(i, j) for i, j in combinations(range(len(variant_masks)), 2)
+             if variant_masks[i] | variant_masks[j] == 0b111])
+        self.assertListEqual(_get_valid_compound_het_index_pairs([0, 0, 0], 0), [(0, 1), (0, 2), (1, 2)])
+
+    def test_merge_sorted_results(self):
+        sorted_results_lists = [
+            [{'id': 'a1', '_sort': [1]}, {'id': 'a3', '_sort': [3]}, {'id': 'a5', '_sort': [5]}],
+            [],
+            [{'id': 'b1', '_sort': [1]}, {'id': 'b2', '_sort': [2]}, {'id': 'b3', '_sort': [3]}],
+            [{'id': 'c0', '_sort': [0]}, {'id': 'c3', '_sort': [3]}, {'id': 'c3_2', '_sort': [3]}],
+        ]
+        merged = _merge_sorted_results(sorted_results_lists, lambda result: result['_sort'])
+        self.assertListEqual(
+            [result['id'] for result in merged], ['c0', 'a1', 'b1', 'b2', 'a3', 'b3', 'c3', 'c3_2', 'a5'])
+        self.assertListEqual(
+            merged, sorted([result for results in sorted_results_lists for result in results], key=lambda r: r['_sort']))
+        self.assertListEqual(_merge_sorted_results([[], []], lambda result: result['_sort']), [])
+
+    def test_get_merged_results_page(self):
+        sorted_results_lists = [
+            [{'variantId': 'a', '_sort': [1]}, {'variantId': 'c', '_sort': [3]}, {'variantId': 'd', '_sort': [4]}],
+            [{'variantId': 'a', '_sort': [1]}, {'variantId': 'b', '_sort': [2]}, {'variantId': 'e', '_sort': [5]}],
+            [],
+        ]
+        merged, num_used_by_list = _get_merged_results_page(sorted_results_lists, 2)
+        self.assertListEqual([result['variantId'] for result in merged], ['a', 'a', 'b'])
+        self.assertListEqual(num_used_by_list, [1, 2, 0])
+
+        merged, num_used_by_list = _get_merged_results_page(sorted_results_lists, 1)
+        self.assertListEqual([result['variantId'] for result in merged], ['a', 'a'])
+        self.assertListEqual(num_used_by_list, [1, 1, 0])
+
+        merged, num_used_by_list = _get_merged_results_page(sorted_results_lists, None)
+        self.assertListEqual([result['variantId'] for result in merged], ['a', 'a', 'b', 'c', 'd', 'e'])
+        self.assertListEqual(num_used_by_list, [3, 3, 0])
+
     def test_genotype_inheritance_filter(self):
         custom_affected = {'I000004_hg00731': 'N', 'I000005_hg00732': 'A'}
         custom_multi_affected = {'I000005_hg00732': 'A'}
@@ -2379,7 +3141,7 @@ class EsUtilsTest(TestCase):
         search_model = VariantSearch.objects.create(search={})
         results_model = VariantSearchResults.objects.create(variant_search=search_model)
         results_model.families.set(Family.objects.filter(guid='F000002_2'))
-        cache_key = 'search_results__{}__xpos'.format(results_model.guid)
+        cache_key = _get_cache_key(results_model)
 
         def _execute_inheritance_search(
                 mode=None, inheritance_filter=None, expected_filter=None, expected_comp_het_filter=None,
@@ -2674,3 +3436,108 @@ class EsUtilsTest(TestCase):
         with self.assertRaises(Exception) as cm:
             _execute_inheritance_search(inheritance_filter={'affected': custom_affected})
         self.assertEqual(str(cm.exception), 'Inheritance must be specified if custom affected status is set')
+
+
+@mock.patch.dict('seqr.utils.elasticsearch.utils._ES_CLIENTS', clear=True)
+class EsClientTest(TestCase):
+
+    @mock.patch('seqr.utils.elasticsearch.utils.os.getpid')
+    @mock.patch('seqr.utils.elasticsearch.utils.elasticsearch.Elasticsearch')
+    def test_get_es_client(self, mock_es, mock_getpid):
+        mock_getpid.return_value = 1
+        mock_es.side_effect = lambda **kwargs: mock.MagicMock()
+
+        client = get_es_client()
+        self.assertIs(get_es_client(), client)
+        mock_es.assert_called_once_with(
+            hosts=[{'host': 'localhost', 'port': '9200'}], timeout=60, maxsize=10,
+            headers={'Connection': 'keep-alive'})
+
+        # different timeouts use different clients
+        long_timeout_client = get_es_client(timeout=3600)
+        self.assertIsNot(long_timeout_client, client)
+        self.assertIs(get_es_client(timeout=3600), long_timeout_client)
+        self.assertEqual(mock_es.call_count, 2)
+
+        # forked processes do not reuse the parent process' clients
+        mock_getpid.return_value = 2
+        forked_client = get_es_client()
+        self.assertIsNot(forked_client, client)
+        self.assertIs(get_es_client(), forked_client)
+        self.assertEqual(mock_es.call_count, 3)
+
+    @mock.patch('seqr.utils.elasticsearch.utils.ELASTICSEARCH_SEARCH_THREADS', 3)
+    @mock.patch.dict('seqr.utils.elasticsearch.utils._SEARCH_THREAD_POOLS', clear=True)
+    @mock.patch('seqr.utils.elasticsearch.utils.os.getpid')
+    @mock.patch('seqr.utils.elasticsearch.utils.ThreadPool')
+    def test_get_search_thread_pool(self, mock_thread_pool, mock_getpid):
+        mock_getpid.return_value = 1
+        mock_thread_pool.side_effect = lambda **kwargs: mock.MagicMock()
+
+        pool = get_search_thread_pool()
+        self.assertIs(get_search_thread_pool(), pool)
+        mock_thread_pool.assert_called_once_with(processes=3)
+
+        # forked processes do not reuse the parent process' threads
+        mock_getpid.return_value = 2
+        forked_pool = get_search_thread_pool()
+        self.assertIsNot(forked_pool, pool)
+        self.assertIs(get_search_thread_pool(), forked_pool)
+        self.assertEqual(mock_thread_pool.call_count, 2)
+
+
+class SearchPrefetchTest(TestCase):
+
+    @mock.patch('seqr.utils.elasticsearch.utils.SEARCH_PREFETCH_MAX_PER_USER', 2)
+    @mock.patch('seqr.utils.elasticsearch.utils.SEARCH_PREFETCH_THREADS', 0)
+    @mock.patch.dict('seqr.utils.elasticsearch.utils._SEARCH_PREFETCHES', clear=True)
+    @mock.patch('seqr.utils.elasticsearch.utils.logger')
+    @mock.patch('seqr.utils.elasticsearch.utils.connection')
+    @mock.patch('seqr.utils.elasticsearch.utils._get_process_thread_pool')
+    @mock.patch('seqr.utils.elasticsearch.utils.get_es_variant_gene_counts')
+    @mock.patch('seqr.utils.elasticsearch.utils.get_es_variants')
+    def test_prefetch_es_variants(self, mock_get_variants, mock_get_gene_counts, mock_get_pool, mock_connection, mock_logger):
+        mock_pool = mock_get_pool.return_value
+        user = mock.MagicMock(id=1)
+        search_model = mock.MagicMock(search_hash='abc')
+
+        # Prefetching is disabled by default
+        self.assertIsNone(prefetch_es_variants(search_model, user, page=2))
+        mock_get_pool.assert_not_called()
+
+        with mock.patch('seqr.utils.elasticsearch.utils.SEARCH_PREFETCH_THREADS', 3):
+            prefetch_es_variants(search_model, user, sort='xpos', page=2, num_results=100)
+            prefetch_es_variants(search_model, user, sort='consequence', page=3, num_results=10)
+            # users are limited to the max number of prefetches at once
+            self.assertIsNone(prefetch_es_variants(search_model, user, page=4))
+            prefetch_es_variants(search_model, mock.MagicMock(id=2))
+
+        mock_get_pool.assert_called_with({}, 3)
+        self.assertEqual(mock_pool.apply_async.call_count, 3)
+        xpos_task, consequence_task, other_user_task = [call[0] for call in mock_pool.apply_async.call_args_list]
+
+        xpos_task[0](*xpos_task[1])
+        mock_get_variants.assert_called_once_with(search_model, sort='xpos', page=2, num_results=100)
+        mock_get_gene_counts.assert_called_once_with(search_model)
+        mock_connection.close.assert_called_once_with()
+
+        # A new search cancels the user's prefetches for other searches
+        with mock.patch('seqr.utils.elasticsearch.utils.SEARCH_PREFETCH_THREADS', 3):
+            prefetch_es_variants(mock.MagicMock(search_hash='def'), user, page=2)
+        self.assertEqual(mock_pool.apply_async.call_count, 4)
+        mock_get_variants.reset_mock()
+        mock_get_gene_counts.reset_mock()
+        consequence_task[0](*consequence_task[1])
+        mock_get_variants.assert_not_called()
+        mock_get_gene_counts.assert_not_called()
+
+        # Prefetch errors are logged and not raised
+        mock_get_gene_counts.side_effect = Exception('Search failed')
+        other_user_task[0](*other_user_task[1])
+        mock_get_variants.assert_not_called()
+        mock_get_gene_counts.assert_called_once_with(search_model)
+        mock_logger.error.assert_called_with('Unable to prefetch search results: Search failed')
+        self.assertEqual(mock_connection.close.call_count, 3)
+
+        self.assertListEqual(list(_SEARCH_PREFETCHES.keys()), [1])
+        self.assertListEqual([prefetch.search_hash for prefetch in _SEARCH_PREFETCHES[1]], ['def'])
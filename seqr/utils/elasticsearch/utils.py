@@ -1,10 +1,22 @@
+from collections import defaultdict
+from django.db import connection
+from django.db.models import Count
 import elasticsearch
 from elasticsearch_dsl import Q
+import hashlib
+import json
 import logging
+from multiprocessing.pool import ThreadPool
+import os
+from threading import Event, Lock
 
-from settings import ELASTICSEARCH_SERVICE_HOSTNAME, ELASTICSEARCH_SERVICE_PORT
+from settings import ELASTICSEARCH_SERVICE_HOSTNAME, ELASTICSEARCH_SERVICE_PORT, ELASTICSEARCH_CONNECTION_POOL_SIZE, \
+    ELASTICSEARCH_KEEP_ALIVE, ELASTICSEARCH_SNIFF, ELASTICSEARCH_SNIFFER_TIMEOUT, ELASTICSEARCH_SEARCH_THREADS, \
+    REDIS_SEARCH_RESULTS_TTL, REDIS_INDEX_METADATA_TTL, SEARCH_PREFETCH_THREADS, SEARCH_PREFETCH_MAX_PER_USER
 from seqr.models import Sample
-from seqr.utils.redis_utils import safe_redis_get_json, safe_redis_set_json
+from seqr.utils.redis_utils import safe_redis_get_json, safe_redis_set_json, safe_redis_get_chunked_json, \
+    safe_redis_set_chunked_json, safe_redis_get_versions, safe_redis_bump_versions, safe_redis_hmget_json, \
+    safe_redis_hmset_json, ZLIB_JSON_CODEC
 from seqr.utils.elasticsearch.constants import XPOS_SORT_KEY, VARIANT_DOC_TYPE, SV_DOC_TYPE
 from seqr.utils.elasticsearch.es_gene_agg_search import EsGeneAggSearch
 from seqr.utils.elasticsearch.es_search import EsSearch
@@ -13,21 +25,93 @@ from seqr.utils.xpos_utils import get_xpos, get_chrom_pos
 
 logger = logging.getLogger(__name__)
 
+SEARCH_RESULTS_CACHE_CODEC = ZLIB_JSON_CODEC
+# Loaded results are cached in page sized chunks so a single page can be loaded or added without loading all results
+SEARCH_RESULTS_CACHE_LIST_FIELDS = ['all_results', 'grouped_results']
+SEARCH_RESULTS_CACHE_CHUNK_SIZE = 100
+# Active sample counts for all indices are cached as a single redis hash keyed by index name
+INDEX_SAMPLE_COUNTS_CACHE_KEY = 'index_sample_counts'
+
 
 class InvalidIndexException(Exception):
     pass
 
 
+# Clients are shared across requests so searches reuse warm pooled connections. Connection pools can not be shared
+# across forked processes, so clients are tracked by the pid of the process that created them
+_ES_CLIENTS = {}
+_ES_CLIENTS_LOCK = Lock()
+
+
 def get_es_client(timeout=60):
-    return elasticsearch.Elasticsearch(hosts=[{"host": ELASTICSEARCH_SERVICE_HOSTNAME, "port": ELASTICSEARCH_SERVICE_PORT}],  timeout=timeout)
+    pid = os.getpid()
+    client = _ES_CLIENTS.get((pid, timeout))
+    if client is None:
+        with _ES_CLIENTS_LOCK:
+            for key in [key for key in _ES_CLIENTS.keys() if key[0] != pid]:
+                del _ES_CLIENTS[key]
+            client = _ES_CLIENTS.get((pid, timeout))
+            if client is None:
+                client = _create_es_client(timeout)
+                _ES_CLIENTS[(pid, timeout)] = client
+    return client
+
+
+# Threads can not be shared across forked processes either, so thread pools are also tracked by pid
+_SEARCH_THREAD_POOLS = {}
+_SEARCH_PREFETCH_THREAD_POOLS = {}
+
+
+def get_search_thread_pool():
+    return _get_process_thread_pool(_SEARCH_THREAD_POOLS, ELASTICSEARCH_SEARCH_THREADS)
+
+
+def _get_process_thread_pool(pools, processes):
+    pid = os.getpid()
+    pool = pools.get(pid)
+    if pool is None:
+        with _ES_CLIENTS_LOCK:
+            pool = pools.get(pid)
+            if pool is None:
+                pools.clear()
+                pool = ThreadPool(processes=processes)
+                pools[pid] = pool
+    return pool
+
+
+def _create_es_client(timeout):
+    client_kwargs = {
+        'timeout': timeout,
+        'maxsize': ELASTICSEARCH_CONNECTION_POOL_SIZE,
+        'headers': {'Connection': 'keep-alive' if ELASTICSEARCH_KEEP_ALIVE else 'close'},
+    }
+    if ELASTICSEARCH_SNIFF:
+        client_kwargs.update({
+            'sniff_on_start': True,
+            'sniff_on_connection_fail': True,
+            'sniffer_timeout': ELASTICSEARCH_SNIFFER_TIMEOUT,
+        })
+    return elasticsearch.Elasticsearch(
+        hosts=[{"host": ELASTICSEARCH_SERVICE_HOSTNAME, "port": ELASTICSEARCH_SERVICE_PORT}], **client_kwargs)
+
+
+def get_index_metadata_cache_key(index_name):
+    return 'index_metadata__{}'.format(index_name)
 
 
 def get_index_metadata(index_name, client):
-    cache_key = 'index_metadata__{}'.format(index_name)
+    cache_key = get_index_metadata_cache_key(index_name)
     cached_metadata = safe_redis_get_json(cache_key)
     if cached_metadata:
         return cached_metadata
 
+    index_metadata = load_index_metadata(index_name, client)
+    safe_redis_set_json(cache_key, index_metadata, expire=REDIS_INDEX_METADATA_TTL)
+    return index_metadata
+
+
+def load_index_metadata(index_name, client):
+    """Loads the metadata for the given index from its ES mapping, without using the cache"""
     try:
         mappings = client.indices.get_mapping(index=index_name)
     except Exception as e:
@@ -38,13 +122,50 @@ def get_index_metadata(index_name, client):
         variant_mapping = mapping['mappings'].get(VARIANT_DOC_TYPE) or mapping['mappings'].get(SV_DOC_TYPE, {})
         index_metadata[index_name] = variant_mapping.get('_meta', {})
         index_metadata[index_name]['fields'] = variant_mapping['properties'].keys()
-    safe_redis_set_json(cache_key, index_metadata)
+        index_metadata[index_name]['nestedFields'] = [
+            field for field, field_mapping in variant_mapping['properties'].items() if field_mapping.get('type') == 'nested'
+        ]
     return index_metadata
 
 
+def get_index_sample_counts(indices):
+    """
+    Returns the number of active samples in each of the given indices. Counts are cached in redis, and any counts
+    missing from the cache are computed in a single query
+    """
+    sample_counts = safe_redis_hmget_json(INDEX_SAMPLE_COUNTS_CACHE_KEY, indices)
+    missing_indices = [index for index in indices if index not in sample_counts]
+    if missing_indices:
+        missing_counts = _get_db_index_sample_counts(missing_indices)
+        # Counts updated by update_index_sample_counts since they were computed here are not overwritten
+        safe_redis_hmset_json(
+            INDEX_SAMPLE_COUNTS_CACHE_KEY, missing_counts, expire=REDIS_INDEX_METADATA_TTL, overwrite=False)
+        sample_counts.update(missing_counts)
+    return sample_counts
+
+
+def update_index_sample_counts(indices):
+    """Recompute the cached active sample counts for the given indices. Should be called whenever samples are activated
+    or deactivated"""
+    indices = [index for index in set(indices) if index]
+    if indices:
+        safe_redis_hmset_json(
+            INDEX_SAMPLE_COUNTS_CACHE_KEY, _get_db_index_sample_counts(indices), expire=REDIS_INDEX_METADATA_TTL)
+
+
+def _get_db_index_sample_counts(indices):
+    sample_counts = {index: 0 for index in indices}
+    sample_counts.update({
+        agg['elasticsearch_index']: agg['count'] for agg in Sample.objects.filter(
+            elasticsearch_index__in=indices, is_active=True,
+        ).values('elasticsearch_index').annotate(count=Count('id'))
+    })
+    return sample_counts
+
+
 def get_single_es_variant(families, variant_id, return_all_queried_families=False):
     variants = EsSearch(
-        families, return_all_queried_families=return_all_queried_families,
+        families, return_all_queried_families=return_all_queried_families, wait_for_liftover=True,
     ).filter_by_location(variant_ids=[variant_id]).search(num_results=1)
     if not variants:
         raise Exception('Variant {} not found'.format(variant_id))
@@ -52,7 +173,7 @@ def get_single_es_variant(families, variant_id, return_all_queried_families=Fals
 
 
 def get_es_variants_for_variant_ids(families, variant_ids, dataset_type=None):
-    variants = EsSearch(families).filter_by_location(variant_ids=variant_ids)
+    variants = EsSearch(families, wait_for_liftover=True).filter_by_location(variant_ids=variant_ids)
     if dataset_type:
         variants = variants.update_dataset_type(dataset_type)
     return variants.search(num_results=len(variant_ids))
@@ -68,9 +189,36 @@ def get_es_variants_for_variant_tuples(families, xpos_ref_alt_tuples):
     return get_es_variants_for_variant_ids(families, variant_ids, dataset_type=Sample.DATASET_TYPE_VARIANT_CALLS)
 
 
-def get_es_variants(search_model, es_search_cls=EsSearch, sort=XPOS_SORT_KEY, **kwargs):
-    cache_key = 'search_results__{}__{}'.format(search_model.guid, sort or XPOS_SORT_KEY)
-    previous_search_results = safe_redis_get_json(cache_key) or {}
+def get_search_results_cache_key(search_model, sort, project_guids, data_version=None):
+    # Cached results are keyed by the data version of each searched project, so updating a project's data invalidates
+    # all its cached results at once without having to find or delete them
+    if data_version is None:
+        data_version = _get_projects_data_version(project_guids)
+    return 'search_results__{}__{}__{}'.format(search_model.guid, sort or XPOS_SORT_KEY, data_version)
+
+
+def get_search_query_plan_cache_key(search_model, project_guids, data_version=None):
+    # Query plans do not depend on the sort, so they are shared by all sorts and by gene breakdowns of the same search
+    if data_version is None:
+        data_version = _get_projects_data_version(project_guids)
+    search_hash = hashlib.md5(json.dumps(search_model.variant_search.search, sort_keys=True).encode('utf-8')).hexdigest()
+    family_guids = sorted(search_model.families.values_list('guid', flat=True))
+    families_hash = hashlib.md5(','.join(family_guids).encode('utf-8')).hexdigest()
+    return 'search_query_plan__{}__{}__{}'.format(search_hash, families_hash, data_version)
+
+
+def _get_projects_data_version(project_guids):
+    data_versions = safe_redis_get_versions([get_project_data_version_key(guid) for guid in project_guids])
+    return hashlib.md5(','.join(
+        '{}:{}'.format(guid, data_versions.get(get_project_data_version_key(guid), 0)) for guid in project_guids
+    ).encode('utf-8')).hexdigest()
+
+
+def get_es_variants(search_model, es_search_cls=EsSearch, sort=XPOS_SORT_KEY, parent_search_model=None, **kwargs):
+    project_guids = sorted(set(search_model.families.values_list('project__guid', flat=True)))
+    data_version = _get_projects_data_version(project_guids)
+    cache_key = get_search_results_cache_key(search_model, sort, project_guids, data_version=data_version)
+    previous_search_results = safe_redis_get_chunked_json(cache_key, SEARCH_RESULTS_CACHE_LIST_FIELDS) or {}
 
     previously_loaded_results, search_kwargs = es_search_cls.process_previous_results(previous_search_results,  **kwargs)
     if previously_loaded_results is not None:
@@ -78,12 +226,16 @@ def get_es_variants(search_model, es_search_cls=EsSearch, sort=XPOS_SORT_KEY, **
 
     search = search_model.variant_search.search
 
-    genes, intervals, invalid_items = parse_locus_list_items(search.get('locus', {}))
-    if invalid_items:
-        raise Exception('Invalid genes/intervals: {}'.format(', '.join(invalid_items)))
-    rs_ids, variant_ids, invalid_items = _parse_variant_items(search.get('locus', {}))
-    if invalid_items:
-        raise Exception('Invalid variants: {}'.format(', '.join(invalid_items)))
+    # Searches which only narrow a fully loaded parent search can be filtered from the parent's results instead of ES
+    parent_search_results = None
+    if parent_search_model:
+        parent_search_results = _get_refinable_parent_search_results(
+            search_model, parent_search_model, sort, project_guids, data_version)
+        if parent_search_results and previous_search_results.get(EsSearch.SAMPLE_TOPOLOGY_KEY) is None:
+            previous_search_results[EsSearch.SAMPLE_TOPOLOGY_KEY] = \
+                parent_search_results.get(EsSearch.SAMPLE_TOPOLOGY_KEY)
+
+    query_plan_cache_key, query_plan, locus_items = _get_search_query_plan(search_model, project_guids, data_version)
 
     es_search = es_search_cls(
         search_model.families.all(),
@@ -91,6 +243,161 @@ def get_es_variants(search_model, es_search_cls=EsSearch, sort=XPOS_SORT_KEY, **
         skip_unaffected_families=search.get('inheritance'),
     )
 
+    if sort:
+        es_search.sort(sort)
+
+    if parent_search_results:
+        refined_results = _refine_parent_search_results(es_search, search, parent_search_results)
+        if refined_results is not None:
+            _set_search_results_cache(cache_key, es_search, project_guids)
+            previously_loaded_results, _ = es_search_cls.process_previous_results(
+                es_search.previous_search_results, **kwargs)
+            return previously_loaded_results, es_search.previous_search_results['total_results']
+
+    search_kwargs.update(_apply_search_query_plan(es_search, search, query_plan_cache_key, query_plan, locus_items))
+
+    if hasattr(es_search, 'aggregate_by_gene'):
+        es_search.aggregate_by_gene()
+
+    variant_results = es_search.search(**search_kwargs)
+
+    if not es_search.missing_liftover:
+        _set_search_results_cache(cache_key, es_search, project_guids)
+
+    return variant_results, es_search.previous_search_results['total_results']
+
+
+def get_es_variant_counts(search_model):
+    """
+    Returns the total number of variants for a search and the counts by family and by index, without loading any of the
+    variants
+    """
+    project_guids = sorted(set(search_model.families.values_list('project__guid', flat=True)))
+    data_version = _get_projects_data_version(project_guids)
+    cache_key = 'search_counts__{}__{}'.format(search_model.guid, data_version)
+    counts = safe_redis_get_json(cache_key)
+    if counts:
+        return counts
+
+    search = search_model.variant_search.search
+    query_plan_cache_key, query_plan, locus_items = _get_search_query_plan(search_model, project_guids, data_version)
+
+    es_search = EsSearch(search_model.families.all(), skip_unaffected_families=search.get('inheritance'))
+    _apply_search_query_plan(es_search, search, query_plan_cache_key, query_plan, locus_items)
+    counts = es_search.count()
+
+    if not es_search.missing_liftover:
+        safe_redis_set_json(cache_key, counts, expire=REDIS_SEARCH_RESULTS_TTL)
+    return counts
+
+
+def _get_search_query_plan(search_model, project_guids, data_version):
+    # The compiled search filters are cached separately from the results, so paging past the loaded results, changing
+    # the sort, or loading the gene breakdown does not need to rebuild them
+    query_plan_cache_key = get_search_query_plan_cache_key(search_model, project_guids, data_version)
+    query_plan = safe_redis_get_json(query_plan_cache_key)
+    # Genotype filters are skipped when all the samples in an index are searched, so plans are rebuilt if the number of
+    # active samples in any of the searched indices changes
+    if query_plan and get_index_sample_counts(query_plan['es_search']['indices']) != query_plan['index_sample_counts']:
+        query_plan = None
+    locus_items = None if query_plan else _parse_locus_items(search_model.variant_search.search.get('locus', {}))
+    return query_plan_cache_key, query_plan, locus_items
+
+
+def _apply_search_query_plan(es_search, search, query_plan_cache_key, query_plan, locus_items):
+    if query_plan:
+        es_search.load_query_plan(query_plan['es_search'])
+        return query_plan['search_kwargs']
+
+    plan_search_kwargs = _apply_search_filters(es_search, search, **locus_items)
+    es_search_query_plan = es_search.get_query_plan()
+    if es_search_query_plan:
+        safe_redis_set_json(query_plan_cache_key, {
+            'es_search': es_search_query_plan,
+            'search_kwargs': plan_search_kwargs,
+            'index_sample_counts': get_index_sample_counts(es_search_query_plan['indices']),
+        }, expire=REDIS_SEARCH_RESULTS_TTL)
+    return plan_search_kwargs
+
+
+def _set_search_results_cache(cache_key, es_search, project_guids):
+    safe_redis_set_chunked_json(
+        cache_key, es_search.previous_search_results, SEARCH_RESULTS_CACHE_LIST_FIELDS, SEARCH_RESULTS_CACHE_CHUNK_SIZE,
+        expire=REDIS_SEARCH_RESULTS_TTL, codec=SEARCH_RESULTS_CACHE_CODEC,
+        index_keys=[get_project_search_results_index_key(project_guid) for project_guid in project_guids])
+
+
+def _get_refinable_parent_search_results(search_model, parent_search_model, sort, project_guids, data_version):
+    if not _is_frequency_refinement(parent_search_model.variant_search.search, search_model.variant_search.search):
+        return None
+
+    if set(parent_search_model.families.values_list('guid', flat=True)) != \
+            set(search_model.families.values_list('guid', flat=True)):
+        return None
+
+    parent_cache_key = get_search_results_cache_key(parent_search_model, sort, project_guids, data_version=data_version)
+    parent_search_results = safe_redis_get_chunked_json(parent_cache_key, SEARCH_RESULTS_CACHE_LIST_FIELDS) or {}
+    total_results = parent_search_results.get('total_results')
+    results = parent_search_results.get('grouped_results') or parent_search_results.get('all_results')
+    if total_results is None or results is None or len(results) != total_results:
+        return None
+    return parent_search_results
+
+
+def _is_frequency_refinement(parent_search, search):
+    """
+    Whether a search only differs from its parent by tighter frequency filters, so its results are a subset of the parent
+    results. Other filters can not be exactly applied to parsed variants, so searches changing them are not refinements
+    """
+    if {k: v for k, v in search.items() if k != 'freqs'} != {k: v for k, v in parent_search.items() if k != 'freqs'}:
+        return False
+
+    freq_filters = _get_frequency_filters(search.get('freqs'))
+    return all(
+        freq_filters.get(filter_key) is not None and freq_filters[filter_key] <= value
+        for filter_key, value in _get_frequency_filters(parent_search.get('freqs')).items()
+    )
+
+
+def _get_frequency_filters(frequencies):
+    # Allele counts are only filtered on if there is no allele frequency filter for the population
+    freq_filters = {}
+    for pop, freqs in (frequencies or {}).items():
+        if freqs.get('af') is not None:
+            freq_filters[(pop, 'af')] = freqs['af']
+        elif freqs.get('ac') is not None:
+            freq_filters[(pop, 'ac')] = freqs['ac']
+        if freqs.get('hh') is not None:
+            freq_filters[(pop, 'hh')] = freqs['hh']
+    return freq_filters
+
+
+def _refine_parent_search_results(es_search, search, parent_search_results):
+    grouped_results = parent_search_results.get('grouped_results')
+    results_key = 'grouped_results' if grouped_results else 'all_results'
+    results = es_search.filter_results_by_frequency(
+        search.get('freqs') or {}, list(parent_search_results[results_key]), grouped=bool(grouped_results))
+    if results is None:
+        return None
+
+    logger.info('Refined {} loaded parent search results to {} results'.format(
+        parent_search_results['total_results'], len(results)))
+    es_search.previous_search_results.update({results_key: results, 'total_results': len(results)})
+    return results
+
+
+def _parse_locus_items(locus):
+    genes, intervals, invalid_items = parse_locus_list_items(locus)
+    if invalid_items:
+        raise Exception('Invalid genes/intervals: {}'.format(', '.join(invalid_items)))
+    rs_ids, variant_ids, invalid_items = _parse_variant_items(locus)
+    if invalid_items:
+        raise Exception('Invalid variants: {}'.format(', '.join(invalid_items)))
+    return {'genes': genes, 'intervals': intervals, 'rs_ids': rs_ids, 'variant_ids': variant_ids}
+
+
+def _apply_search_filters(es_search, search, genes=None, intervals=None, rs_ids=None, variant_ids=None):
+    search_kwargs = {}
     if search.get('customQuery'):
         custom_q = search['customQuery']
         if not isinstance(custom_q, list):
@@ -98,9 +405,6 @@ def get_es_variants(search_model, es_search_cls=EsSearch, sort=XPOS_SORT_KEY, **
         for q_dict in custom_q:
             es_search.filter(Q(q_dict))
 
-    if sort:
-        es_search.sort(sort)
-
     if genes or intervals or rs_ids or variant_ids:
         es_search.filter_by_location(
             genes=genes, intervals=intervals, rs_ids=rs_ids, variant_ids=variant_ids, locus=search['locus'])
@@ -115,14 +419,19 @@ def get_es_variants(search_model, es_search_cls=EsSearch, sort=XPOS_SORT_KEY, **
         annotations=search.get('annotations'), annotations_secondary=search.get('annotations_secondary'),
         pathogenicity=search.get('pathogenicity'))
 
-    if hasattr(es_search, 'aggregate_by_gene'):
-        es_search.aggregate_by_gene()
+    return search_kwargs
 
-    variant_results = es_search.search(**search_kwargs)
 
-    safe_redis_set_json(cache_key, es_search.previous_search_results)
+def get_project_search_results_index_key(project_guid):
+    return 'project_search_results__{}'.format(project_guid)
 
-    return variant_results, es_search.previous_search_results['total_results']
+
+def get_project_data_version_key(project_guid):
+    return 'project_data_version__{}'.format(project_guid)
+
+
+def invalidate_project_search_results(project):
+    safe_redis_bump_versions([get_project_data_version_key(project.guid)])
 
 
 def get_es_variant_gene_counts(search_model):
@@ -130,6 +439,69 @@ def get_es_variant_gene_counts(search_model):
     return gene_counts
 
 
+class _SearchPrefetch(object):
+
+    def __init__(self, search_hash):
+        self.search_hash = search_hash
+        self.cancelled = Event()
+
+
+# Queued and running prefetches for each user id, so the number of prefetches per user can be limited and prefetches
+# for searches the user has moved on from can be cancelled
+_SEARCH_PREFETCHES = defaultdict(list)
+_SEARCH_PREFETCHES_LOCK = Lock()
+
+
+def prefetch_es_variants(search_model, user, sort=XPOS_SORT_KEY, page=None, num_results=100):
+    """
+    Loads a page of results and the gene breakdown for a search into the search results cache in the background, so
+    they are already cached when they are requested. Prefetches are skipped if prefetching is disabled or the user
+    already has the max number of prefetches.
+    Returns the AsyncResult for the prefetch, or None if it is skipped
+    """
+    if not SEARCH_PREFETCH_THREADS:
+        return None
+
+    cancel_es_variant_prefetches(user, search_model.search_hash)
+    with _SEARCH_PREFETCHES_LOCK:
+        user_prefetches = _SEARCH_PREFETCHES[user.id]
+        if len(user_prefetches) >= SEARCH_PREFETCH_MAX_PER_USER:
+            return None
+        prefetch = _SearchPrefetch(search_model.search_hash)
+        user_prefetches.append(prefetch)
+
+    pool = _get_process_thread_pool(_SEARCH_PREFETCH_THREAD_POOLS, SEARCH_PREFETCH_THREADS)
+    return pool.apply_async(_prefetch_es_variants, (prefetch, user.id, search_model, sort, page, num_results))
+
+
+def cancel_es_variant_prefetches(user, search_hash):
+    """
+    Cancels the user's prefetches for any search other than the given one. Running prefetches stop before their next
+    search, and queued prefetches do not run
+    """
+    with _SEARCH_PREFETCHES_LOCK:
+        for prefetch in _SEARCH_PREFETCHES.get(user.id, []):
+            if prefetch.search_hash != search_hash:
+                prefetch.cancelled.set()
+
+
+def _prefetch_es_variants(prefetch, user_id, search_model, sort, page, num_results):
+    try:
+        if page and not prefetch.cancelled.is_set():
+            get_es_variants(search_model, sort=sort, page=page, num_results=num_results)
+        if not prefetch.cancelled.is_set():
+            get_es_variant_gene_counts(search_model)
+    except Exception as e:
+        logger.error('Unable to prefetch search results: {}'.format(e))
+    finally:
+        with _SEARCH_PREFETCHES_LOCK:
+            _SEARCH_PREFETCHES[user_id].remove(prefetch)
+            if not _SEARCH_PREFETCHES[user_id]:
+                del _SEARCH_PREFETCHES[user_id]
+        # Database connections are not closed automatically outside of requests
+        connection.close()
+
+
 def _parse_variant_items(search_json):
     raw_items = search_json.get('rawVariantItems')
     if not raw_items:
@@ -0,0 +1,130 @@
+import logging
+import os
+from collections import OrderedDict
+from pyliftover.liftover import LiftOver
+from threading import Lock, Thread
+import time
+
+from reference_data.models import GENOME_VERSION_GRCh37, GENOME_VERSION_GRCh38
+from settings import LIFTOVER_CHAIN_DIR, LIFTOVER_MEMO_SIZE
+
+logger = logging.getLogger(__name__)
+
+LIFTOVER_DBS = {
+    GENOME_VERSION_GRCh37: 'hg19',
+    GENOME_VERSION_GRCh38: 'hg38',
+}
+LIFTED_GENOME_VERSIONS = {
+    GENOME_VERSION_GRCh37: GENOME_VERSION_GRCh38,
+    GENOME_VERSION_GRCh38: GENOME_VERSION_GRCh37,
+}
+
+
+class BatchLiftOver(object):
+    """
+    Memoizing wrapper around a LiftOver, which keeps a bounded LRU memo of recent lifts so repeated pages of results do
+    not redo the chain lookups
+    """
+
+    def __init__(self, liftover, memo_size=LIFTOVER_MEMO_SIZE):
+        self.liftover = liftover
+        self.memo_size = memo_size
+        self._memo = OrderedDict()
+        self._lock = Lock()
+
+    def lift_coordinates(self, coordinates):
+        """
+        Lifts over a list of (chrom, pos) tuples. Duplicate coordinates within the list are only lifted once, and
+        coordinates found in the LRU memo are not lifted again. Each remaining coordinate is lifted with its own
+        convert_coordinate call.
+        Returns a list with a lifted (chrom, pos) tuple, or None if the coordinate could not be lifted, for each input
+        """
+        coordinates = [(chrom.lstrip('chr'), int(pos)) for chrom, pos in coordinates]
+
+        lifted = {}
+        with self._lock:
+            for coord in set(coordinates):
+                if coord in self._memo:
+                    # Re-insert to mark as recently used
+                    lifted[coord] = self._memo.pop(coord)
+                    self._memo[coord] = lifted[coord]
+
+        missing = [coord for coord in OrderedDict.fromkeys(coordinates) if coord not in lifted]
+        for chrom, pos in missing:
+            lifted_coord = self.liftover.convert_coordinate('chr{}'.format(chrom), pos)
+            lifted[(chrom, pos)] = (lifted_coord[0][0].lstrip('chr'), lifted_coord[0][1]) \
+                if lifted_coord and lifted_coord[0] else None
+
+        if missing:
+            with self._lock:
+                for coord in missing:
+                    self._memo[coord] = lifted[coord]
+                while len(self._memo) > self.memo_size:
+                    self._memo.popitem(last=False)
+
+        return [lifted[coord] for coord in coordinates]
+
+    def lift_coordinate(self, chrom, pos):
+        return self.lift_coordinates([(chrom, pos)])[0]
+
+
+_LIFTOVERS = {}
+_LIFTOVERS_LOCK = Lock()
+# Maps genome version to the process id running a background load for it, as threads do not carry over to forked workers
+_BACKGROUND_LOADS = {}
+
+
+def load_liftovers():
+    """
+    Loads the liftover chains for all genome versions. This is run when the server starts, so when the app is preloaded
+    before forking workers they all share the loaded chains
+    """
+    for genome_version in sorted(LIFTOVER_DBS.keys()):
+        _load_liftover(genome_version)
+
+
+def get_liftover(genome_version, wait=False):
+    """
+    Returns a BatchLiftOver from the given genome version to the other supported version, or None if unavailable.
+    If the chain is not loaded yet, it is loaded in a background thread and None is returned so requests are never
+    blocked on loading, unless wait is set
+    """
+    if genome_version not in _LIFTOVERS:
+        if wait:
+            with _LIFTOVERS_LOCK:
+                if genome_version not in _LIFTOVERS:
+                    _load_liftover(genome_version)
+        else:
+            _start_background_load(genome_version)
+    return _LIFTOVERS.get(genome_version)
+
+
+def _start_background_load(genome_version):
+    with _LIFTOVERS_LOCK:
+        if _BACKGROUND_LOADS.get(genome_version) == os.getpid():
+            return
+        _BACKGROUND_LOADS[genome_version] = os.getpid()
+
+    thread = Thread(target=_load_liftover_in_background, args=(genome_version,))
+    thread.daemon = True
+    thread.start()
+
+
+def _load_liftover_in_background(genome_version):
+    try:
+        _load_liftover(genome_version)
+    finally:
+        _BACKGROUND_LOADS.pop(genome_version, None)
+
+
+def _load_liftover(genome_version):
+    from_db = LIFTOVER_DBS[genome_version]
+    to_db = LIFTOVER_DBS[LIFTED_GENOME_VERSIONS[genome_version]]
+    start = time.time()
+    try:
+        liftover = LiftOver(from_db, to_db, search_dir=LIFTOVER_CHAIN_DIR, cache_dir=LIFTOVER_CHAIN_DIR)
+    except Exception as e:
+        logger.warn('WARNING: Unable to set up liftover. {}'.format(e))
+        return
+    _LIFTOVERS[genome_version] = BatchLiftOver(liftover)
+    logger.info('Loaded {} to {} liftover chain in {:.2f} seconds'.format(from_db, to_db, time.time() - start))
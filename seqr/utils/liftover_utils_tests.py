@@ -0,0 +1,79 @@
+import mock
+from unittest import TestCase
+
+from settings import LIFTOVER_CHAIN_DIR
+from seqr.utils.liftover_utils import BatchLiftOver, get_liftover, load_liftovers, _load_liftover_in_background
+
+
+def _mock_convert_coordinate(chrom, pos):
+    return [] if pos < 0 else [(chrom, pos + 10, '+', 1)]
+
+
+class LiftoverUtilsTest(TestCase):
+
+    def test_lift_coordinates(self):
+        mock_liftover = mock.MagicMock()
+        mock_liftover.convert_coordinate.side_effect = _mock_convert_coordinate
+        liftover = BatchLiftOver(mock_liftover, memo_size=3)
+
+        self.assertListEqual(liftover.lift_coordinates([('2', 200), ('chr1', '100'), ('1', 100), ('X', -1)]), [
+            ('2', 210), ('1', 110), ('1', 110), None,
+        ])
+        self.assertListEqual(mock_liftover.convert_coordinate.call_args_list, [
+            mock.call('chr2', 200), mock.call('chr1', 100), mock.call('chrX', -1),
+        ])
+
+        # Memoized coordinates are not looked up again, and the least recently used are evicted
+        mock_liftover.reset_mock()
+        self.assertEqual(liftover.lift_coordinate('2', 200), ('2', 210))
+        self.assertEqual(liftover.lift_coordinate('3', 300), ('3', 310))
+        mock_liftover.convert_coordinate.assert_called_once_with('chr3', 300)
+
+        mock_liftover.reset_mock()
+        self.assertListEqual(liftover.lift_coordinates([('2', 200), ('1', 100)]), [('2', 210), ('1', 110)])
+        mock_liftover.convert_coordinate.assert_called_once_with('chr1', 100)
+
+    @mock.patch.dict('seqr.utils.liftover_utils._LIFTOVERS', clear=True)
+    @mock.patch.dict('seqr.utils.liftover_utils._BACKGROUND_LOADS', clear=True)
+    @mock.patch('seqr.utils.liftover_utils.Thread')
+    @mock.patch('seqr.utils.liftover_utils.logger')
+    @mock.patch('seqr.utils.liftover_utils.LiftOver')
+    def test_get_liftover(self, mock_liftover, mock_logger, mock_thread):
+        # Chains which are not loaded yet are loaded in the background
+        self.assertIsNone(get_liftover('38'))
+        self.assertIsNone(get_liftover('38'))
+        mock_thread.assert_called_once_with(target=_load_liftover_in_background, args=('38',))
+        mock_thread.return_value.start.assert_called_once_with()
+        mock_liftover.assert_not_called()
+
+        _load_liftover_in_background('38')
+        mock_liftover.assert_called_with('hg38', 'hg19', search_dir=LIFTOVER_CHAIN_DIR, cache_dir=LIFTOVER_CHAIN_DIR)
+        mock_logger.info.assert_called_with(mock.ANY)
+        self.assertRegexpMatches(
+            mock_logger.info.call_args[0][0], r'^Loaded hg38 to hg19 liftover chain in [\d.]+ seconds$')
+        liftover = get_liftover('38')
+        self.assertEqual(liftover.liftover, mock_liftover.return_value)
+        self.assertEqual(mock_thread.call_count, 1)
+
+        # Test waiting for the chain to load
+        mock_liftover.side_effect = Exception('Unable to download chain file')
+        self.assertIsNone(get_liftover('37', wait=True))
+        mock_logger.warn.assert_called_with('WARNING: Unable to set up liftover. Unable to download chain file')
+
+        mock_liftover.side_effect = None
+        self.assertEqual(get_liftover('37', wait=True).liftover, mock_liftover.return_value)
+        mock_liftover.assert_called_with('hg19', 'hg38', search_dir=LIFTOVER_CHAIN_DIR, cache_dir=LIFTOVER_CHAIN_DIR)
+        self.assertEqual(mock_thread.call_count, 1)
+
+    @mock.patch.dict('seqr.utils.liftover_utils._LIFTOVERS', clear=True)
+    @mock.patch('seqr.utils.liftover_utils.logger')
+    @mock.patch('seqr.utils.liftover_utils.LiftOver')
+    def test_load_liftovers(self, mock_liftover, mock_logger):
+        load_liftovers()
+        mock_liftover.assert_has_calls([
+            mock.call('hg19', 'hg38', search_dir=LIFTOVER_CHAIN_DIR, cache_dir=LIFTOVER_CHAIN_DIR),
+            mock.call('hg38', 'hg19', search_dir=LIFTOVER_CHAIN_DIR, cache_dir=LIFTOVER_CHAIN_DIR),
+        ])
+        self.assertEqual(mock_logger.info.call_count, 2)
+        self.assertEqual(get_liftover('37').liftover, mock_liftover.return_value)
+        self.assertEqual(get_liftover('38').liftover, mock_liftover.return_value)
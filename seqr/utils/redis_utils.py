@@ -1,21 +1,80 @@
 from __future__ import unicode_literals
 
+from collections import namedtuple
 import json
 import logging
 import redis
+import time
+import zlib
 
 from settings import REDIS_SERVICE_HOSTNAME
 
 logger = logging.getLogger(__name__)
 
+RedisCodec = namedtuple('RedisCodec', ['version', 'encode', 'decode'])
+
+JSON_CODEC = 'json'
+ZLIB_JSON_CODEC = 'zlib'
+
+REDIS_CODECS = {
+    JSON_CODEC: RedisCodec(version=1, encode=json.dumps, decode=json.loads),
+    ZLIB_JSON_CODEC: RedisCodec(
+        version=1,
+        encode=lambda value: zlib.compress(json.dumps(value).encode('utf-8'), 6),
+        decode=lambda value: json.loads(zlib.decompress(value).decode('utf-8')),
+    ),
+}
+
+# Values written with any codec other than plain json are prefixed with a header naming the codec and its version, so
+# the cache encoding can change without breaking previously cached values. json never starts with a null byte
+CODEC_HEADER_DELIMITER = b'\x00'
+
+# Lists cached with safe_redis_set_chunked_json are stored in fixed size chunks under their own keys, so a slice of a
+# long list can be loaded without loading the whole list. Their lengths are stored alongside the other cached fields
+CHUNKED_LISTS_FIELD = '__chunked_lists'
+
+# redis-py connection pools reset themselves when used from a forked process, so a single pool is safe to share
+_REDIS_CONNECTION_POOL = None
+
+
+def get_redis_client():
+    global _REDIS_CONNECTION_POOL
+    if _REDIS_CONNECTION_POOL is None:
+        _REDIS_CONNECTION_POOL = redis.ConnectionPool(host=REDIS_SERVICE_HOSTNAME, socket_connect_timeout=3)
+    return redis.StrictRedis(connection_pool=_REDIS_CONNECTION_POOL)
+
+
+def encode_redis_value(value, codec=JSON_CODEC):
+    redis_codec = REDIS_CODECS[codec]
+    encoded = redis_codec.encode(value)
+    if codec == JSON_CODEC:
+        return encoded
+    header = '{}:{}'.format(codec, redis_codec.version).encode('utf-8')
+    return CODEC_HEADER_DELIMITER + header + CODEC_HEADER_DELIMITER + encoded
+
+
+def decode_redis_value(value):
+    if value[:1] != CODEC_HEADER_DELIMITER:
+        return REDIS_CODECS[JSON_CODEC].decode(value)
+
+    header, encoded = value[1:].split(CODEC_HEADER_DELIMITER, 1)
+    codec, version = header.decode('utf-8').split(':')
+    redis_codec = REDIS_CODECS.get(codec)
+    if not redis_codec or '{}'.format(redis_codec.version) != version:
+        raise ValueError('Unsupported encoding "{}"'.format(header.decode('utf-8')))
+    try:
+        return redis_codec.decode(encoded)
+    except zlib.error as e:
+        raise ValueError(str(e))
+
 
 def safe_redis_get_json(cache_key):
     try:
-        redis_client = redis.StrictRedis(host=REDIS_SERVICE_HOSTNAME, socket_connect_timeout=3)
+        redis_client = get_redis_client()
         value = redis_client.get(cache_key)
         if value:
             logger.info('Loaded {} from redis'.format(cache_key))
-            return json.loads(value)
+            return decode_redis_value(value)
     except ValueError as e:
         logger.warn('Unable to fetch "{}" from redis: {}'.format(cache_key, str(e)))
     except Exception as e:
@@ -23,9 +82,341 @@ def safe_redis_get_json(cache_key):
     return None
 
 
-def safe_redis_set_json(cache_key, value):
+def safe_redis_mget_json(cache_keys):
+    """Fetch multiple keys in a single round trip. Only keys with a valid cached value are included in the result"""
+    cache_keys = list(cache_keys)
+    values_by_key = {}
+    try:
+        redis_client = get_redis_client()
+        values = redis_client.mget(cache_keys)
+    except Exception as e:
+        logger.warn('Unable to connect to redis host {}: {}'.format(REDIS_SERVICE_HOSTNAME, str(e)))
+        return values_by_key
+
+    for cache_key, value in zip(cache_keys, values):
+        if value:
+            try:
+                values_by_key[cache_key] = decode_redis_value(value)
+            except ValueError as e:
+                logger.warn('Unable to fetch "{}" from redis: {}'.format(cache_key, str(e)))
+    if values_by_key:
+        logger.info('Loaded {} from redis'.format(', '.join(sorted(values_by_key.keys()))))
+    return values_by_key
+
+
+def _new_version():
+    return int(time.time() * 1000)
+
+
+def safe_redis_get_versions(version_keys):
+    """
+    Fetch the current value of each version counter, initializing any missing counters. Counters start at the current
+    time in milliseconds, so a counter which is evicted and re-initialized never repeats a previous version
+    """
     try:
-        redis_client = redis.StrictRedis(host=REDIS_SERVICE_HOSTNAME, socket_connect_timeout=3)
-        redis_client.set(cache_key, json.dumps(value))
+        redis_client = get_redis_client()
+        versions = dict(zip(version_keys, redis_client.mget(version_keys)))
+        missing_keys = [key for key in version_keys if versions[key] is None]
+        if missing_keys:
+            pipeline = redis_client.pipeline(transaction=False)
+            for key in missing_keys:
+                pipeline.set(key, _new_version(), nx=True)
+            pipeline.mget(missing_keys)
+            versions.update(zip(missing_keys, pipeline.execute()[-1]))
+        return {key: int(version) for key, version in versions.items()}
+    except Exception as e:
+        logger.warn('Unable to connect to redis host {}: {}'.format(REDIS_SERVICE_HOSTNAME, str(e)))
+    return {}
+
+
+def safe_redis_bump_versions(version_keys):
+    """Increment the given version counters. Missing counters are initialized as in safe_redis_get_versions first"""
+    try:
+        redis_client = get_redis_client()
+        pipeline = redis_client.pipeline()
+        for key in version_keys:
+            pipeline.set(key, _new_version(), nx=True)
+            pipeline.incr(key)
+        pipeline.execute()
+    except Exception as e:
+        logger.warn('Unable to write to redis host {}: {}'.format(REDIS_SERVICE_HOSTNAME, str(e)))
+
+
+def safe_redis_set_json(cache_key, value, expire=None, codec=JSON_CODEC):
+    try:
+        redis_client = get_redis_client()
+        redis_client.set(cache_key, encode_redis_value(value, codec=codec), ex=expire)
+    except Exception as e:
+        logger.warn('Unable to write to redis host {}: {}'.format(REDIS_SERVICE_HOSTNAME, str(e)))
+
+
+def safe_redis_mset_json(values_by_key, expire=None, codec=JSON_CODEC):
+    """Write multiple keys in a single round trip, optionally setting the same expiry time (in seconds) for all keys"""
+    try:
+        redis_client = get_redis_client()
+        pipeline = redis_client.pipeline(transaction=False)
+        for cache_key, value in values_by_key.items():
+            pipeline.set(cache_key, encode_redis_value(value, codec=codec), ex=expire)
+        pipeline.execute()
     except Exception as e:
         logger.warn('Unable to write to redis host {}: {}'.format(REDIS_SERVICE_HOSTNAME, str(e)))
+
+
+def safe_redis_hmget_json(cache_key, fields):
+    """Fetch multiple fields of a redis hash in a single round trip. Only fields with a valid cached value are included"""
+    fields = list(fields)
+    values_by_field = {}
+    try:
+        redis_client = get_redis_client()
+        values = redis_client.hmget(cache_key, fields)
+    except Exception as e:
+        logger.warn('Unable to connect to redis host {}: {}'.format(REDIS_SERVICE_HOSTNAME, str(e)))
+        return values_by_field
+
+    for field, value in zip(fields, values):
+        if value:
+            try:
+                values_by_field[field] = decode_redis_value(value)
+            except ValueError as e:
+                logger.warn('Unable to fetch "{}" from redis: {}'.format(cache_key, str(e)))
+    if values_by_field:
+        logger.info('Loaded {} from redis'.format(cache_key))
+    return values_by_field
+
+
+def safe_redis_hmset_json(cache_key, values_by_field, expire=None, overwrite=True):
+    """
+    Write multiple fields of a redis hash in a single round trip. If overwrite is False, fields which are already set
+    are left unchanged
+    """
+    try:
+        redis_client = get_redis_client()
+        pipeline = redis_client.pipeline()
+        if overwrite:
+            pipeline.hmset(cache_key, {field: encode_redis_value(value) for field, value in values_by_field.items()})
+        else:
+            for field, value in values_by_field.items():
+                pipeline.hsetnx(cache_key, field, encode_redis_value(value))
+        if expire:
+            pipeline.expire(cache_key, expire)
+        pipeline.execute()
+    except Exception as e:
+        logger.warn('Unable to write to redis host {}: {}'.format(REDIS_SERVICE_HOSTNAME, str(e)))
+
+
+def _chunked_list_cache_key(cache_key, field):
+    return '{}__{}'.format(cache_key, field)
+
+
+class RedisChunkedList(object):
+    """
+    List-like view of a list cached by safe_redis_set_chunked_json. Only the chunks containing the requested items are
+    loaded from redis, and new items are held locally until the list is cached again
+    """
+
+    def __init__(self, cache_key, length, chunk_size, redis_client=None, loaded_chunks=None, appended=None):
+        self.cache_key = cache_key
+        self.cached_length = length
+        self.chunk_size = chunk_size
+        self.appended = appended or []
+        self._redis_client = redis_client
+        self._loaded_chunks = loaded_chunks if loaded_chunks is not None else {}
+
+    def __len__(self):
+        return self.cached_length + len(self.appended)
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return self[:][index]
+            items = []
+            if start < min(stop, self.cached_length):
+                items += self._get_cached_items(start, min(stop, self.cached_length))
+            if stop > self.cached_length:
+                items += self.appended[max(start - self.cached_length, 0):stop - self.cached_length]
+            return items
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('list index out of range')
+        return self[index:index + 1][0]
+
+    def __add__(self, other):
+        return RedisChunkedList(
+            self.cache_key, self.cached_length, self.chunk_size, redis_client=self._redis_client,
+            loaded_chunks=self._loaded_chunks, appended=self.appended + list(other),
+        )
+
+    def __radd__(self, other):
+        return list(other) + self[:]
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    def append(self, item):
+        self.appended.append(item)
+
+    def extend(self, items):
+        self.appended += list(items)
+
+    def _get_cached_items(self, start, stop):
+        first_chunk = start // self.chunk_size
+        last_chunk = (stop - 1) // self.chunk_size
+        missing_chunks = [i for i in range(first_chunk, last_chunk + 1) if i not in self._loaded_chunks]
+        if missing_chunks:
+            redis_client = self._redis_client or get_redis_client()
+            chunks = redis_client.lrange(self.cache_key, missing_chunks[0], missing_chunks[-1])
+            if len(chunks) != missing_chunks[-1] - missing_chunks[0] + 1:
+                raise ValueError('Missing cached chunks for "{}"'.format(self.cache_key))
+            for i, chunk in enumerate(chunks):
+                self._loaded_chunks[missing_chunks[0] + i] = decode_redis_value(chunk)
+
+        items = []
+        for i in range(first_chunk, last_chunk + 1):
+            items += self._loaded_chunks[i]
+        offset = first_chunk * self.chunk_size
+        return items[start - offset:stop - offset]
+
+
+def safe_redis_get_chunked_json(cache_key, list_fields):
+    """
+    Fetch a dictionary cached by safe_redis_set_chunked_json. Chunked list fields are returned as RedisChunkedList
+    views, and are not loaded until they are accessed. Values cached as a single json blob are also supported
+    """
+    try:
+        redis_client = get_redis_client()
+        pipeline = redis_client.pipeline(transaction=False)
+        pipeline.hgetall(cache_key)
+        for field in list_fields:
+            pipeline.llen(_chunked_list_cache_key(cache_key, field))
+        try:
+            cached = pipeline.execute()
+        except redis.ResponseError:
+            return safe_redis_get_json(cache_key)
+        cached_fields = cached[0]
+        if not cached_fields:
+            return None
+
+        logger.info('Loaded {} from redis'.format(cache_key))
+        value = {field.decode('utf-8'): decode_redis_value(field_value) for field, field_value in cached_fields.items()}
+        num_cached_chunks = dict(zip(list_fields, cached[1:]))
+        for field, list_metadata in value.pop(CHUNKED_LISTS_FIELD, {}).items():
+            list_key = _chunked_list_cache_key(cache_key, field)
+            length = list_metadata['length']
+            chunk_size = list_metadata['chunkSize']
+            # Chunks may be evicted independently of the rest of the value
+            if num_cached_chunks.get(field) != (length + chunk_size - 1) // chunk_size:
+                raise ValueError('Missing cached chunks for "{}"'.format(list_key))
+            value[field] = RedisChunkedList(list_key, length, chunk_size, redis_client=redis_client)
+        return value
+    except ValueError as e:
+        logger.warn('Unable to fetch "{}" from redis: {}'.format(cache_key, str(e)))
+    except Exception as e:
+        logger.warn('Unable to connect to redis host {}: {}'.format(REDIS_SERVICE_HOSTNAME, str(e)))
+    return None
+
+
+def safe_redis_set_chunked_json(cache_key, value, list_fields, chunk_size, expire=None, codec=JSON_CODEC,
+                                index_keys=None):
+    """
+    Cache a dictionary as a redis hash, with the given list fields stored in chunks of chunk_size items. Lists loaded
+    with safe_redis_get_chunked_json only write the newly added items. If the value was updated by another process
+    since it was loaded, it is not written. All the keys used to store the value are added to the given index keys,
+    which can be passed to delete_redis_indexed_keys to delete them without scanning the keyspace
+    """
+    try:
+        redis_client = get_redis_client()
+        with redis_client.pipeline() as pipeline:
+            pipeline.watch(cache_key)
+            try:
+                cached_lists = pipeline.hget(cache_key, CHUNKED_LISTS_FIELD)
+            except redis.ResponseError:
+                # Values cached as a single json blob are overwritten
+                cached_lists = None
+            cached_lists = decode_redis_value(cached_lists) if cached_lists else {}
+            for field in list_fields:
+                field_value = value.get(field)
+                if isinstance(field_value, RedisChunkedList) and \
+                        cached_lists.get(field, {}).get('length') != field_value.cached_length:
+                    logger.info('Skipped caching {}, it was updated by another request'.format(cache_key))
+                    return
+
+            pipeline.multi()
+            pipeline.delete(cache_key)
+            fields = {}
+            chunked_lists = {}
+            for field, field_value in value.items():
+                if field in list_fields:
+                    list_key = _chunked_list_cache_key(cache_key, field)
+                    chunked_lists[field] = _set_chunked_list(pipeline, list_key, field_value, chunk_size, codec)
+                else:
+                    fields[field] = encode_redis_value(field_value, codec=codec)
+            fields[CHUNKED_LISTS_FIELD] = encode_redis_value(chunked_lists)
+            pipeline.hmset(cache_key, fields)
+
+            list_keys = [_chunked_list_cache_key(cache_key, field) for field in list_fields]
+            removed_list_keys = [list_key for field, list_key in zip(list_fields, list_keys) if field not in value]
+            if removed_list_keys:
+                pipeline.delete(*removed_list_keys)
+            if expire:
+                for key in [cache_key] + list_keys:
+                    pipeline.expire(key, expire)
+            for index_key in index_keys or []:
+                _add_indexed_keys(pipeline, index_key, [cache_key] + list_keys, expire)
+            pipeline.execute()
+    except redis.WatchError:
+        logger.info('Skipped caching {}, it was updated by another request'.format(cache_key))
+    except Exception as e:
+        logger.warn('Unable to write to redis host {}: {}'.format(REDIS_SERVICE_HOSTNAME, str(e)))
+
+
+def _set_chunked_list(pipeline, list_key, items, chunk_size, codec):
+    if isinstance(items, RedisChunkedList) and items.cache_key == list_key:
+        # Only write new items, completing the last cached chunk if it is partially filled
+        chunk_size = items.chunk_size
+        new_items = items.appended
+        num_partial = items.cached_length % chunk_size
+        if num_partial and new_items:
+            last_chunk = items[items.cached_length - num_partial:items.cached_length] + \
+                         new_items[:chunk_size - num_partial]
+            pipeline.lset(list_key, -1, encode_redis_value(last_chunk, codec=codec))
+            new_items = new_items[chunk_size - num_partial:]
+    else:
+        pipeline.delete(list_key)
+        new_items = list(items)
+
+    chunks = [
+        encode_redis_value(new_items[i:i + chunk_size], codec=codec) for i in range(0, len(new_items), chunk_size)
+    ]
+    if chunks:
+        pipeline.rpush(list_key, *chunks)
+    return {'length': len(items), 'chunkSize': chunk_size}
+
+
+def _add_indexed_keys(pipeline, index_key, keys, expire):
+    # Indices are sorted sets scored by the expiry time of each key, so expired keys can be dropped from the index
+    now = time.time()
+    expire_at = now + expire if expire else float('inf')
+    pipeline.zadd(index_key, {key: expire_at for key in keys})
+    pipeline.zremrangebyscore(index_key, '-inf', now)
+    if expire:
+        pipeline.expire(index_key, expire)
+
+
+def delete_redis_indexed_keys(index_keys, redis_client=None):
+    """Delete all the keys in the given indices, and the indices themselves. Returns the number of deleted keys"""
+    if not index_keys:
+        return 0
+    redis_client = redis_client or get_redis_client()
+    pipeline = redis_client.pipeline(transaction=False)
+    for index_key in index_keys:
+        pipeline.zrange(index_key, 0, -1)
+    keys_to_delete = sorted({key for keys in pipeline.execute() for key in keys})
+    redis_client.delete(*(keys_to_delete + list(index_keys)))
+    return len(keys_to_delete)
@@ -2,8 +2,12 @@ from __future__ import unicode_literals
 
 import json
 import mock
+import redis
 from unittest import TestCase
-from seqr.utils.redis_utils import safe_redis_set_json, safe_redis_get_json
+from seqr.utils.redis_utils import safe_redis_set_json, safe_redis_get_json, safe_redis_mget_json, \
+    safe_redis_mset_json, encode_redis_value, decode_redis_value, safe_redis_get_chunked_json, \
+    safe_redis_set_chunked_json, RedisChunkedList, delete_redis_indexed_keys, safe_redis_get_versions, \
+    safe_redis_bump_versions, safe_redis_hmget_json, safe_redis_hmset_json
 
 
 @mock.patch('seqr.utils.redis_utils.logger')
@@ -40,7 +44,11 @@ class RedisUtilsTest(TestCase):
 
     def test_safe_redis_set_json(self, mock_redis, mock_logger):
         safe_redis_set_json('test_key', {'a': 1})
-        mock_redis.return_value.set.assert_called_with('test_key', '{"a": 1}')
+        mock_redis.return_value.set.assert_called_with('test_key', '{"a": 1}', ex=None)
+        mock_logger.warn.assert_not_called()
+
+        safe_redis_set_json('test_key', {'a': 1}, expire=60)
+        mock_redis.return_value.set.assert_called_with('test_key', '{"a": 1}', ex=60)
         mock_logger.warn.assert_not_called()
 
         # test with redis connection error
@@ -48,3 +56,317 @@ class RedisUtilsTest(TestCase):
         mock_redis.side_effect = Exception('invalid redis')
         safe_redis_set_json('test_key', {'a': 1})
         mock_logger.warn.assert_called_with('Unable to write to redis host localhost: invalid redis')
+
+    def test_safe_redis_json_codecs(self, mock_redis, mock_logger):
+        value = {'all_results': [{'variantId': '1-248367227-TC-T', 'ref': 'TC', 'alt': 'T'}] * 10, 'total_results': 10}
+
+        safe_redis_set_json('test_key', value, codec='zlib')
+        encoded = mock_redis.return_value.set.call_args[0][1]
+        self.assertTrue(encoded.startswith(b'\x00zlib:1\x00'))
+        self.assertLess(len(encoded), len(json.dumps(value)))
+
+        mock_redis.return_value.get.side_effect = lambda key: encoded
+        self.assertDictEqual(safe_redis_get_json('test_key'), value)
+        mock_logger.warn.assert_not_called()
+
+        # test values cached with an unsupported codec version
+        mock_redis.return_value.get.side_effect = lambda key: b'\x00zlib:0\x00' + encoded.split(b'\x00', 2)[2]
+        self.assertIsNone(safe_redis_get_json('test_key'))
+        mock_logger.warn.assert_called_with('Unable to fetch "test_key" from redis: Unsupported encoding "zlib:0"')
+
+        # test corrupted values
+        mock_redis.return_value.get.side_effect = lambda key: b'\x00zlib:1\x00invalid'
+        self.assertIsNone(safe_redis_get_json('test_key'))
+        self.assertEqual(mock_logger.warn.call_count, 2)
+
+    def test_encode_redis_value(self, mock_redis, mock_logger):
+        value = {'a': [1, 2, 3]}
+        self.assertEqual(encode_redis_value(value), json.dumps(value))
+        self.assertDictEqual(decode_redis_value(encode_redis_value(value)), value)
+        self.assertDictEqual(decode_redis_value(encode_redis_value(value, codec='zlib')), value)
+
+    def test_redis_connection_pool(self, mock_redis, mock_logger):
+        safe_redis_get_json('test_key')
+        safe_redis_set_json('test_key', {'a': 1})
+        self.assertEqual(mock_redis.call_count, 2)
+        first_pool = mock_redis.call_args_list[0][1]['connection_pool']
+        second_pool = mock_redis.call_args_list[1][1]['connection_pool']
+        self.assertIs(first_pool, second_pool)
+
+    def test_safe_redis_mget_json(self, mock_redis, mock_logger):
+        cache = {'key_1': json.dumps({'a': 1}), 'key_2': json.dumps([1, 2]), 'invalid_key': 'invalid'}
+        mock_redis.return_value.mget.side_effect = lambda keys: [cache.get(key) for key in keys]
+
+        self.assertDictEqual(safe_redis_mget_json(['key_1', 'key_2', 'missing_key']), {'key_1': {'a': 1}, 'key_2': [1, 2]})
+        mock_redis.return_value.mget.assert_called_once_with(['key_1', 'key_2', 'missing_key'])
+        mock_logger.info.assert_called_with('Loaded key_1, key_2 from redis')
+        mock_logger.warn.assert_not_called()
+
+        # test with no values in cache
+        mock_logger.reset_mock()
+        self.assertDictEqual(safe_redis_mget_json(['missing_key']), {})
+        mock_logger.info.assert_not_called()
+        mock_logger.warn.assert_not_called()
+
+        # test with invalid json in cache
+        mock_logger.reset_mock()
+        self.assertDictEqual(safe_redis_mget_json(['key_1', 'invalid_key']), {'key_1': {'a': 1}})
+        mock_logger.info.assert_called_with('Loaded key_1 from redis')
+        self.assertEqual(mock_logger.warn.call_count, 1)
+
+        # test with redis connection error
+        mock_logger.reset_mock()
+        mock_redis.side_effect = Exception('invalid redis')
+        self.assertDictEqual(safe_redis_mget_json(['key_1']), {})
+        mock_logger.info.assert_not_called()
+        mock_logger.warn.assert_called_with('Unable to connect to redis host localhost: invalid redis')
+
+    def test_safe_redis_mset_json(self, mock_redis, mock_logger):
+        mock_pipeline = mock_redis.return_value.pipeline.return_value
+        safe_redis_mset_json({'key_1': {'a': 1}, 'key_2': [1, 2]}, expire=60)
+        mock_redis.return_value.pipeline.assert_called_with(transaction=False)
+        mock_pipeline.set.assert_has_calls([
+            mock.call('key_1', '{"a": 1}', ex=60), mock.call('key_2', '[1, 2]', ex=60),
+        ], any_order=True)
+        mock_pipeline.execute.assert_called_once()
+        mock_redis.return_value.set.assert_not_called()
+        mock_logger.warn.assert_not_called()
+
+        # test with redis connection error
+        mock_logger.reset_mock()
+        mock_redis.side_effect = Exception('invalid redis')
+        safe_redis_mset_json({'key_1': {'a': 1}})
+        mock_logger.warn.assert_called_with('Unable to write to redis host localhost: invalid redis')
+
+    def test_safe_redis_hmget_json(self, mock_redis, mock_logger):
+        cache = {'field_1': json.dumps(1), 'field_2': json.dumps([1, 2]), 'invalid_field': 'invalid'}
+        mock_redis.return_value.hmget.side_effect = lambda key, fields: [cache.get(field) for field in fields]
+
+        self.assertDictEqual(
+            safe_redis_hmget_json('test_key', ['field_1', 'field_2', 'missing_field']), {'field_1': 1, 'field_2': [1, 2]})
+        mock_redis.return_value.hmget.assert_called_once_with('test_key', ['field_1', 'field_2', 'missing_field'])
+        mock_logger.info.assert_called_with('Loaded test_key from redis')
+        mock_logger.warn.assert_not_called()
+
+        # test with no values in cache
+        mock_logger.reset_mock()
+        self.assertDictEqual(safe_redis_hmget_json('test_key', ['missing_field']), {})
+        mock_logger.info.assert_not_called()
+
+        # test with invalid json in cache
+        mock_logger.reset_mock()
+        self.assertDictEqual(safe_redis_hmget_json('test_key', ['field_1', 'invalid_field']), {'field_1': 1})
+        self.assertEqual(mock_logger.warn.call_count, 1)
+
+        # test with redis connection error
+        mock_logger.reset_mock()
+        mock_redis.side_effect = Exception('invalid redis')
+        self.assertDictEqual(safe_redis_hmget_json('test_key', ['field_1']), {})
+        mock_logger.warn.assert_called_with('Unable to connect to redis host localhost: invalid redis')
+
+    def test_safe_redis_hmset_json(self, mock_redis, mock_logger):
+        mock_pipeline = mock_redis.return_value.pipeline.return_value
+        safe_redis_hmset_json('test_key', {'field_1': 1, 'field_2': [1, 2]}, expire=60)
+        mock_pipeline.hmset.assert_called_once_with('test_key', {'field_1': '1', 'field_2': '[1, 2]'})
+        mock_pipeline.hsetnx.assert_not_called()
+        mock_pipeline.expire.assert_called_once_with('test_key', 60)
+        mock_pipeline.execute.assert_called_once()
+        mock_logger.warn.assert_not_called()
+
+        # test without overwriting
+        mock_redis.reset_mock()
+        safe_redis_hmset_json('test_key', {'field_1': 1, 'field_2': [1, 2]}, overwrite=False)
+        mock_pipeline.hmset.assert_not_called()
+        mock_pipeline.hsetnx.assert_has_calls([
+            mock.call('test_key', 'field_1', '1'), mock.call('test_key', 'field_2', '[1, 2]'),
+        ], any_order=True)
+        mock_pipeline.expire.assert_not_called()
+        mock_pipeline.execute.assert_called_once()
+
+        # test with redis connection error
+        mock_redis.side_effect = Exception('invalid redis')
+        safe_redis_hmset_json('test_key', {'field_1': 1})
+        mock_logger.warn.assert_called_with('Unable to write to redis host localhost: invalid redis')
+
+    def test_safe_redis_get_chunked_json(self, mock_redis, mock_logger):
+        chunks = [json.dumps([1, 2]), json.dumps([3, 4]), json.dumps([5])]
+        mock_pipeline = mock_redis.return_value.pipeline.return_value
+        mock_pipeline.execute.return_value = [{
+            b'total_results': b'10',
+            b'__chunked_lists': json.dumps({'all_results': {'length': 5, 'chunkSize': 2}}).encode('utf-8'),
+        }, 3, 0]
+        mock_redis.return_value.lrange.side_effect = lambda key, start, end: chunks[start:end + 1]
+
+        cached = safe_redis_get_chunked_json('test_key', ['all_results', 'grouped_results'])
+        mock_redis.return_value.pipeline.assert_called_with(transaction=False)
+        mock_pipeline.hgetall.assert_called_with('test_key')
+        mock_pipeline.llen.assert_has_calls([
+            mock.call('test_key__all_results'), mock.call('test_key__grouped_results'),
+        ])
+        mock_logger.info.assert_called_with('Loaded test_key from redis')
+        self.assertEqual(cached['total_results'], 10)
+        results = cached['all_results']
+        self.assertIsInstance(results, RedisChunkedList)
+        self.assertEqual(len(results), 5)
+        mock_redis.return_value.lrange.assert_not_called()
+
+        self.assertListEqual(results[1:3], [2, 3])
+        mock_redis.return_value.lrange.assert_called_once_with('test_key__all_results', 0, 1)
+
+        # Loaded chunks are not fetched again
+        mock_redis.return_value.lrange.reset_mock()
+        self.assertListEqual(results[2:4], [3, 4])
+        self.assertEqual(results[-1], 5)
+        mock_redis.return_value.lrange.assert_called_once_with('test_key__all_results', 2, 2)
+
+        # Added results are not cached until the results are saved
+        mock_redis.return_value.lrange.reset_mock()
+        results += [6, 7]
+        results.append(8)
+        updated_results = results + [9]
+        self.assertEqual(len(results), 8)
+        self.assertEqual(len(updated_results), 9)
+        self.assertListEqual(updated_results[4:], [5, 6, 7, 8, 9])
+        self.assertListEqual(list(results), [1, 2, 3, 4, 5, 6, 7, 8])
+        self.assertListEqual([0] + results, [0, 1, 2, 3, 4, 5, 6, 7, 8])
+        mock_redis.return_value.lrange.assert_not_called()
+
+        # test with evicted chunks
+        mock_pipeline.execute.return_value = [{
+            b'__chunked_lists': json.dumps({'all_results': {'length': 5, 'chunkSize': 2}}).encode('utf-8'),
+        }, 2, 0]
+        self.assertIsNone(safe_redis_get_chunked_json('test_key', ['all_results', 'grouped_results']))
+        mock_logger.warn.assert_called_with(
+            'Unable to fetch "test_key" from redis: Missing cached chunks for "test_key__all_results"')
+
+        # test with values cached as a single json blob
+        mock_logger.reset_mock()
+        mock_pipeline.execute.side_effect = redis.ResponseError('WRONGTYPE')
+        mock_redis.return_value.get.side_effect = lambda key: json.dumps({'all_results': [1, 2]})
+        self.assertDictEqual(safe_redis_get_chunked_json('test_key', ['all_results']), {'all_results': [1, 2]})
+
+        # test with no value in cache
+        mock_pipeline.execute.side_effect = None
+        mock_pipeline.execute.return_value = [{}, 0]
+        self.assertIsNone(safe_redis_get_chunked_json('test_key', ['all_results']))
+        mock_logger.warn.assert_not_called()
+
+        # test with redis connection error
+        mock_redis.side_effect = Exception('invalid redis')
+        self.assertIsNone(safe_redis_get_chunked_json('test_key', ['all_results']))
+        mock_logger.warn.assert_called_with('Unable to connect to redis host localhost: invalid redis')
+
+    def test_safe_redis_set_chunked_json(self, mock_redis, mock_logger):
+        mock_pipeline = mock_redis.return_value.pipeline.return_value.__enter__.return_value
+        mock_pipeline.hget.return_value = None
+
+        with mock.patch('seqr.utils.redis_utils.time.time', lambda: 1000):
+            safe_redis_set_chunked_json(
+                'test_key', {'total_results': 10, 'all_results': [1, 2, 3, 4, 5]}, ['all_results', 'grouped_results'],
+                2, expire=60, index_keys=['test_index'])
+        mock_pipeline.watch.assert_called_with('test_key')
+        mock_pipeline.multi.assert_called_once()
+        mock_pipeline.delete.assert_has_calls([
+            mock.call('test_key'), mock.call('test_key__all_results'), mock.call('test_key__grouped_results'),
+        ])
+        mock_pipeline.rpush.assert_called_once_with('test_key__all_results', '[1, 2]', '[3, 4]', '[5]')
+        mock_pipeline.lset.assert_not_called()
+        mock_pipeline.hmset.assert_called_once_with('test_key', {
+            'total_results': '10', '__chunked_lists': '{"all_results": {"length": 5, "chunkSize": 2}}',
+        })
+        mock_pipeline.expire.assert_has_calls([
+            mock.call('test_key', 60), mock.call('test_key__all_results', 60), mock.call('test_key__grouped_results', 60),
+            mock.call('test_index', 60),
+        ])
+        mock_pipeline.zadd.assert_called_once_with('test_index', {
+            'test_key': 1060, 'test_key__all_results': 1060, 'test_key__grouped_results': 1060,
+        })
+        mock_pipeline.zremrangebyscore.assert_called_once_with('test_index', '-inf', 1000)
+        mock_pipeline.execute.assert_called_once()
+
+        # test only writing new items for cached lists
+        mock_pipeline.reset_mock()
+        mock_pipeline.hget.return_value = '{"all_results": {"length": 5, "chunkSize": 2}}'
+        mock_redis.return_value.lrange.return_value = ['[5]']
+        cached_results = RedisChunkedList('test_key__all_results', 5, 2) + [6, 7, 8]
+        safe_redis_set_chunked_json(
+            'test_key', {'total_results': 10, 'all_results': cached_results}, ['all_results'], 2)
+        mock_redis.return_value.lrange.assert_called_once_with('test_key__all_results', 2, 2)
+        mock_pipeline.lset.assert_called_once_with('test_key__all_results', -1, '[5, 6]')
+        mock_pipeline.rpush.assert_called_once_with('test_key__all_results', '[7, 8]')
+        mock_pipeline.delete.assert_called_once_with('test_key')
+        mock_pipeline.hmset.assert_called_once_with('test_key', {
+            'total_results': '10', '__chunked_lists': '{"all_results": {"length": 8, "chunkSize": 2}}',
+        })
+        mock_pipeline.expire.assert_not_called()
+        mock_pipeline.zadd.assert_not_called()
+        mock_pipeline.execute.assert_called_once()
+        mock_logger.warn.assert_not_called()
+
+        # test skipping lists which were updated since they were loaded
+        mock_pipeline.reset_mock()
+        mock_pipeline.hget.return_value = '{"all_results": {"length": 7, "chunkSize": 2}}'
+        safe_redis_set_chunked_json('test_key', {'all_results': cached_results}, ['all_results'], 2)
+        mock_pipeline.multi.assert_not_called()
+        mock_pipeline.execute.assert_not_called()
+        mock_logger.info.assert_called_with('Skipped caching test_key, it was updated by another request')
+
+        mock_pipeline.hget.return_value = None
+        mock_pipeline.execute.side_effect = redis.WatchError()
+        safe_redis_set_chunked_json('test_key', {'all_results': [1]}, ['all_results'], 2)
+        mock_logger.info.assert_called_with('Skipped caching test_key, it was updated by another request')
+        mock_logger.warn.assert_not_called()
+
+        # test with redis connection error
+        mock_redis.side_effect = Exception('invalid redis')
+        safe_redis_set_chunked_json('test_key', {'all_results': [1]}, ['all_results'], 2)
+        mock_logger.warn.assert_called_with('Unable to write to redis host localhost: invalid redis')
+
+    def test_delete_redis_indexed_keys(self, mock_redis, mock_logger):
+        mock_pipeline = mock_redis.return_value.pipeline.return_value
+        mock_pipeline.execute.return_value = [['key_1', 'key_2'], ['key_2', 'key_3']]
+
+        self.assertEqual(delete_redis_indexed_keys(['index_1', 'index_2']), 3)
+        mock_pipeline.zrange.assert_has_calls([mock.call('index_1', 0, -1), mock.call('index_2', 0, -1)])
+        mock_redis.return_value.delete.assert_called_with('key_1', 'key_2', 'key_3', 'index_1', 'index_2')
+
+        mock_redis.reset_mock()
+        self.assertEqual(delete_redis_indexed_keys([]), 0)
+        mock_redis.return_value.delete.assert_not_called()
+
+    @mock.patch('seqr.utils.redis_utils.time.time', lambda: 1000)
+    def test_safe_redis_get_versions(self, mock_redis, mock_logger):
+        mock_redis.return_value.mget.return_value = [b'12', None]
+        mock_pipeline = mock_redis.return_value.pipeline.return_value
+        mock_pipeline.execute.return_value = [True, [b'1000000']]
+
+        self.assertDictEqual(safe_redis_get_versions(['key_1', 'key_2']), {'key_1': 12, 'key_2': 1000000})
+        mock_redis.return_value.mget.assert_called_with(['key_1', 'key_2'])
+        mock_pipeline.set.assert_called_once_with('key_2', 1000000, nx=True)
+        mock_pipeline.mget.assert_called_once_with(['key_2'])
+
+        # test with all versions set
+        mock_redis.reset_mock()
+        mock_redis.return_value.mget.return_value = [b'12', b'13']
+        self.assertDictEqual(safe_redis_get_versions(['key_1', 'key_2']), {'key_1': 12, 'key_2': 13})
+        mock_redis.return_value.pipeline.assert_not_called()
+        mock_logger.warn.assert_not_called()
+
+        # test with redis connection error
+        mock_redis.side_effect = Exception('invalid redis')
+        self.assertDictEqual(safe_redis_get_versions(['key_1']), {})
+        mock_logger.warn.assert_called_with('Unable to connect to redis host localhost: invalid redis')
+
+    @mock.patch('seqr.utils.redis_utils.time.time', lambda: 1000)
+    def test_safe_redis_bump_versions(self, mock_redis, mock_logger):
+        mock_pipeline = mock_redis.return_value.pipeline.return_value
+        safe_redis_bump_versions(['key_1'])
+        mock_pipeline.set.assert_called_once_with('key_1', 1000000, nx=True)
+        mock_pipeline.incr.assert_called_once_with('key_1')
+        mock_pipeline.execute.assert_called_once()
+        mock_logger.warn.assert_not_called()
+
+        # test with redis connection error
+        mock_redis.side_effect = Exception('invalid redis')
+        safe_redis_bump_versions(['key_1'])
+        mock_logger.warn.assert_called_with('Unable to write to redis host localhost: invalid redis')
@@ -9,6 +9,7 @@ from django.views.decorators.csrf import csrf_exempt
 from django.utils import timezone
 
 from seqr.models import Individual, Sample, Family, IgvSample
+from seqr.utils.elasticsearch.utils import invalidate_project_search_results, update_index_sample_counts
 from seqr.views.utils.dataset_utils import match_sample_ids_to_sample_records, validate_index_metadata, \
     get_elasticsearch_index_samples, load_mapping_file, validate_alignment_dataset_path
 from seqr.views.utils.file_utils import save_uploaded_file
@@ -117,6 +118,8 @@ def add_variants_dataset_handler(request, project_guid):
     if not matched_sample_id_to_sample_record:
         return create_json_response({'samplesByGuid': {}})
 
+    invalidate_project_search_results(project)
+
     family_guids_to_update = [
         family.guid for family in included_families if family.analysis_status == Family.ANALYSIS_STATUS_WAITING_FOR_DATA
     ]
@@ -235,9 +238,15 @@ def _update_variant_samples(matched_sample_id_to_sample_record, elasticsearch_in
         is_active=True,
         dataset_type=dataset_type,
     ).exclude(id__in=updated_samples)
-    inactivate_sample_guids = [sample.guid for sample in inactivate_samples]
+    inactivate_sample_guids = []
+    updated_indices = {elasticsearch_index}
+    for sample in inactivate_samples:
+        inactivate_sample_guids.append(sample.guid)
+        updated_indices.add(sample.elasticsearch_index)
     inactivate_samples.update(is_active=False)
 
+    update_index_sample_counts(updated_indices)
+
     return inactivate_sample_guids
 
 
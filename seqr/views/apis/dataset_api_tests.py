@@ -19,11 +19,14 @@ ADD_DATASET_PAYLOAD = json.dumps({'elasticsearchIndex': INDEX_NAME, 'datasetType
 class DatasetAPITest(AuthenticationTestCase):
     fixtures = ['users', '1kg_project']
 
+    @mock.patch('seqr.views.apis.dataset_api.update_index_sample_counts')
+    @mock.patch('seqr.views.apis.dataset_api.invalidate_project_search_results')
     @mock.patch('seqr.views.utils.dataset_utils.random.randint')
     @mock.patch('seqr.views.utils.dataset_utils.file_iter')
     @mock.patch('seqr.views.utils.dataset_utils.get_index_metadata')
     @mock.patch('seqr.views.utils.dataset_utils.elasticsearch_dsl.Search')
-    def test_add_variants_dataset(self, mock_es_search, mock_get_index_metadata, mock_file_iter, mock_random):
+    def test_add_variants_dataset(self, mock_es_search, mock_get_index_metadata, mock_file_iter, mock_random,
+                                  mock_invalidate_search_results, mock_update_index_sample_counts):
         url = reverse(add_variants_dataset_handler, args=[PROJECT_GUID])
         self.check_manager_login(url)
 
@@ -121,6 +124,8 @@ class DatasetAPITest(AuthenticationTestCase):
         }))
         self.assertEqual(response.status_code, 400)
         self.assertDictEqual(response.json(), {'errors': ['The following families are included in the callset but are missing some family members: 1 (NA19675_1, NA19678).']})
+        mock_invalidate_search_results.assert_not_called()
+        mock_update_index_sample_counts.assert_not_called()
 
         # Send valid request
         mock_es_search.return_value.params.return_value.execute.return_value.aggregations.sample_ids.buckets = [
@@ -133,6 +138,10 @@ class DatasetAPITest(AuthenticationTestCase):
             'datasetType': 'VARIANTS',
         }))
         self.assertEqual(response.status_code, 200)
+        mock_invalidate_search_results.assert_called_once()
+        self.assertEqual(mock_invalidate_search_results.call_args[0][0].guid, PROJECT_GUID)
+        mock_update_index_sample_counts.assert_called_once_with(
+            {INDEX_NAME, existing_old_index_sample.elasticsearch_index})
 
         response_json = response.json()
         self.assertSetEqual(set(response_json.keys()), {'samplesByGuid', 'individualsByGuid', 'familiesByGuid'})
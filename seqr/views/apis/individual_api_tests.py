@@ -59,8 +59,9 @@ class IndividualAPITest(AuthenticationTestCase):
     fixtures = ['users', '1kg_project', 'reference_data']
     multi_db = True
 
+    @mock.patch('seqr.views.utils.json_to_orm_utils.invalidate_project_search_results')
     @mock.patch('seqr.views.utils.json_to_orm_utils.timezone.now', lambda: datetime.strptime('2020-01-01', '%Y-%m-%d'))
-    def test_update_individual_handler(self):
+    def test_update_individual_handler(self, mock_invalidate_search_results):
         edit_individuals_url = reverse(update_individual_handler, args=[INDIVIDUAL_UPDATE_GUID])
         self.check_manager_login(edit_individuals_url)
 
@@ -90,6 +91,15 @@ class IndividualAPITest(AuthenticationTestCase):
         self.assertEqual(response_json[INDIVIDUAL_UPDATE_GUID]['caseReviewStatus'], 'A')
         self.assertEqual(response_json[INDIVIDUAL_UPDATE_GUID]['caseReviewStatusLastModifiedDate'], '2020-01-01T00:00:00')
         self.assertEqual(response_json[INDIVIDUAL_UPDATE_GUID]['caseReviewStatusLastModifiedBy'], 'test_user@test.com')
+        mock_invalidate_search_results.assert_not_called()
+
+        # test editing affected status invalidates search results
+        response = self.client.post(edit_individuals_url, content_type='application/json',
+                                    data=json.dumps({'affected': 'N'}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()[INDIVIDUAL_UPDATE_GUID]['affected'], 'N')
+        mock_invalidate_search_results.assert_called_once()
+        self.assertEqual(mock_invalidate_search_results.call_args[0][0].guid, PROJECT_GUID)
 
     def test_update_individual_hpo_terms(self):
         edit_individuals_url = reverse(update_individual_hpo_terms, args=[INDIVIDUAL_UPDATE_GUID])
@@ -122,7 +132,8 @@ class IndividualAPITest(AuthenticationTestCase):
             {'id': 'HP:0011675', 'notes': 'A new term'},
         ])
 
-    def test_edit_individuals(self):
+    @mock.patch('seqr.views.utils.json_to_orm_utils.invalidate_project_search_results')
+    def test_edit_individuals(self, mock_invalidate_search_results):
         edit_individuals_url = reverse(edit_individuals_handler, args=[PROJECT_GUID])
         self.check_staff_login(edit_individuals_url)
 
@@ -133,6 +144,7 @@ class IndividualAPITest(AuthenticationTestCase):
         self.assertEqual(response.status_code, 400)
         self.assertListEqual(response.json()['errors'],
                              ["NA20870 is the mother of NA19678_1 but doesn't have a separate record in the table"])
+        mock_invalidate_search_results.assert_not_called()
 
         # send valid request
         response = self.client.post(edit_individuals_url, content_type='application/json', data=json.dumps({
@@ -152,7 +164,12 @@ class IndividualAPITest(AuthenticationTestCase):
         self.assertEqual(response_json['individualsByGuid'][ID_UPDATE_GUID]['maternalId'], UPDATED_MATERNAL_ID)
         self.assertEqual(response_json['individualsByGuid'][CHILD_UPDATE_GUID]['paternalId'], UPDATED_ID)
 
-    def test_delete_individuals(self):
+        # Only moving an individual to a new family changes the searched samples
+        mock_invalidate_search_results.assert_called_once()
+        self.assertEqual(mock_invalidate_search_results.call_args[0][0].guid, PROJECT_GUID)
+
+    @mock.patch('seqr.views.utils.individual_utils.invalidate_project_search_results')
+    def test_delete_individuals(self, mock_invalidate_search_results):
         individuals_url = reverse(delete_individuals_handler, args=[PROJECT_GUID])
         self.check_staff_login(individuals_url)
 
@@ -169,6 +186,8 @@ class IndividualAPITest(AuthenticationTestCase):
         self.assertEqual(response.status_code, 200)
         response_json = response.json()
         self.assertListEqual(response_json.keys(), ['individualsByGuid', 'familiesByGuid'])
+        mock_invalidate_search_results.assert_called_once()
+        self.assertEqual(mock_invalidate_search_results.call_args[0][0].guid, PROJECT_GUID)
 
     def test_individuals_table_handler(self):
         individuals_url = reverse(receive_individuals_table_handler, args=[PROJECT_GUID])
@@ -404,6 +404,7 @@ class StaffAPITest(AuthenticationTestCase):
     fixtures = ['users', '1kg_project', 'reference_data']
     multi_db = True
 
+    @mock.patch.dict('seqr.utils.elasticsearch.utils._ES_CLIENTS', clear=True)
     @mock.patch('elasticsearch_dsl.index.Index.get_mapping')
     @mock.patch('elasticsearch.Elasticsearch')
     def test_elasticsearch_status(self, mock_elasticsearch, mock_get_mapping):
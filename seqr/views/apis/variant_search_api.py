@@ -14,11 +14,11 @@ from reference_data.models import GENOME_VERSION_GRCh37
 from seqr.models import Project, Family, Individual, SavedVariant, VariantSearch, VariantSearchResults, Sample, \
     IgvSample, AnalysisGroup, ProjectCategory, VariantTagType, LocusList
 from seqr.utils.elasticsearch.utils import get_es_variants, get_single_es_variant, get_es_variant_gene_counts,\
-    InvalidIndexException
+    get_es_variant_counts, prefetch_es_variants, cancel_es_variant_prefetches, InvalidIndexException
 from seqr.utils.elasticsearch.constants import XPOS_SORT_KEY, PATHOGENICTY_SORT_KEY, PATHOGENICTY_HGMD_SORT_KEY
 from seqr.utils.xpos_utils import get_xpos
 from seqr.views.apis.saved_variant_api import _saved_variant_genes, _add_locus_lists
-from seqr.views.utils.export_utils import export_table
+from seqr.views.utils.export_utils import export_streaming_table
 from seqr.utils.gene_utils import get_genes
 from seqr.views.utils.json_utils import create_json_response
 from seqr.views.utils.orm_to_json_utils import \
@@ -50,6 +50,8 @@ GENOTYPE_AC_LOOKUP = {
 AFFECTED = Individual.AFFECTED_STATUS_AFFECTED
 UNAFFECTED = Individual.AFFECTED_STATUS_UNAFFECTED
 
+EXPORT_PAGE_SIZE = 1000
+
 
 @login_required(login_url=API_LOGIN_REQUIRED_URL)
 @csrf_exempt
@@ -62,16 +64,31 @@ def query_variants_handler(request, search_hash):
     if sort == PATHOGENICTY_SORT_KEY and request.user.is_staff:
         sort = PATHOGENICTY_HGMD_SORT_KEY
 
+    search_context = json.loads(request.body or '{}')
     try:
-        results_model = _get_or_create_results_model(search_hash, json.loads(request.body or '{}'), request.user)
+        results_model = _get_or_create_results_model(search_hash, search_context, request.user)
     except Exception as e:
         logger.error(e)
         return create_json_response({'error': e.message}, status=400, reason=e.message)
 
     _check_results_permission(results_model, request.user)
 
+    # Count only requests return the number of matching variants without loading any of them
+    if request.GET.get('count_only') == 'true':
+        return _query_variant_counts(results_model)
+
+    cancel_es_variant_prefetches(request.user, search_hash)
+
+    # A search narrowing a previous search can be filtered from the previous search's loaded results
+    parent_results_model = None
+    if search_context.get('parentSearchHash'):
+        parent_results_model = VariantSearchResults.objects.filter(search_hash=search_context['parentSearchHash']).first()
+        if parent_results_model:
+            _check_results_permission(parent_results_model, request.user)
+
     try:
-        variants, total_results = get_es_variants(results_model, sort=sort, page=page, num_results=per_page)
+        variants, total_results = get_es_variants(
+            results_model, sort=sort, page=page, num_results=per_page, parent_search_model=parent_results_model)
     except InvalidIndexException as e:
         logger.error('InvalidIndexException: {}'.format(e))
         return create_json_response({'error': e.message}, status=400, reason=e.message)
@@ -82,9 +99,30 @@ def query_variants_handler(request, search_hash):
     response['search'] = _get_search_context(results_model)
     response['search']['totalResults'] = total_results
 
+    next_page = page + 1 if page * per_page < total_results else None
+    prefetch_es_variants(results_model, request.user, sort=sort, page=next_page, num_results=per_page)
+
     return create_json_response(response)
 
 
+def _query_variant_counts(results_model):
+    try:
+        variant_counts = get_es_variant_counts(results_model)
+    except InvalidIndexException as e:
+        logger.error('InvalidIndexException: {}'.format(e))
+        return create_json_response({'error': e.message}, status=400, reason=e.message)
+    except ConnectionTimeout:
+        return create_json_response({}, status=504, reason='Query Time Out')
+
+    search_context = _get_search_context(results_model)
+    search_context.update({
+        'totalResults': variant_counts['total'],
+        'familyCounts': variant_counts['families'],
+        'indexCounts': variant_counts['indices'],
+    })
+    return create_json_response({'search': search_context})
+
+
 def _get_or_create_results_model(search_hash, search_context, user):
     results_model = VariantSearchResults.objects.filter(search_hash=search_hash).first()
     if not results_model:
@@ -254,42 +292,65 @@ def export_variants_handler(request, search_hash):
     families = results_model.families.all()
     family_ids_by_guid = {family.guid: family.family_id for family in families}
 
-    variants, _ = get_es_variants(results_model, page=1, load_all=True)
-    variants = _flatten_variants(variants)
+    # The number of family and sample columns is only known once every variant is loaded, so the variant data is loaded
+    # once and kept as compact rows, and the header is built from the same rows that are written
+    variant_rows = []
+    for variants in _get_es_variant_pages(results_model):
+        variant_rows += _get_variant_export_rows(variants, families, family_ids_by_guid)
+    max_families_per_variant = max([0] + [len(family_rows) for _, family_rows, _ in variant_rows])
+    max_samples_per_variant = max([0] + [len(genotype_row) for _, _, genotype_row in variant_rows])
+
+    header = [config['header'] for config in VARIANT_EXPORT_DATA]
+    for i in range(max_families_per_variant):
+        header += ['{}_{}'.format(config['header'], i+1) for config in VARIANT_FAMILY_EXPORT_DATA]
+    header += ['sample_{}:num_alt_alleles:gq:ab'.format(i+1) for i in range(max_samples_per_variant)]
+
+    empty_family_row = [''] * len(VARIANT_FAMILY_EXPORT_DATA)
+    rows = (
+        row + [value for family_row in family_rows for value in family_row] +
+        empty_family_row * (max_families_per_variant - len(family_rows)) +
+        genotype_row + [''] * (max_samples_per_variant - len(genotype_row))
+        for row, family_rows, genotype_row in variant_rows
+    )
+
+    file_format = request.GET.get('file_format', 'tsv')
+
+    return export_streaming_table(
+        'search_results_{}'.format(search_hash), header, rows, file_format, titlecase_header=False)
 
-    json, variants_to_saved_variants = _get_saved_variants(variants, families)
 
-    max_families_per_variant = max([len(variant['familyGuids']) for variant in variants])
-    max_samples_per_variant = max([len(variant['genotypes']) for variant in variants])
+def _get_es_variant_pages(results_model):
+    """Generates the flattened variants for each page of search results"""
+    page = 1
+    while True:
+        variants, total_results = get_es_variants(results_model, page=page, num_results=EXPORT_PAGE_SIZE)
+        if variants:
+            yield _flatten_variants(variants)
+        if len(variants) < EXPORT_PAGE_SIZE or page * EXPORT_PAGE_SIZE >= total_results:
+            return
+        page += 1
+
+
+def _get_variant_export_rows(variants, families, family_ids_by_guid):
+    """Returns the variant values, the values for each family and the genotype values for each variant"""
+    json, variants_to_saved_variants = _get_saved_variants(variants, families)
 
     rows = []
     for variant in variants:
         row = [_get_field_value(variant, config) for config in VARIANT_EXPORT_DATA]
-        for i in range(max_families_per_variant):
-            family_guid = variant['familyGuids'][i] if i < len(variant['familyGuids']) else ''
+        family_rows = []
+        for family_guid in variant['familyGuids']:
             variant_guid = variants_to_saved_variants.get(variant['variantId'], {}).get(family_guid, '')
             family_tags = {
                 'family_id': family_ids_by_guid.get(family_guid),
                 'tags': [tag for tag in json['variantTagsByGuid'].values() if variant_guid in tag['variantGuids']],
                 'notes': [note for note in json['variantNotesByGuid'].values() if variant_guid in note['variantGuids']],
             }
-            row += [_get_field_value(family_tags, config) for config in VARIANT_FAMILY_EXPORT_DATA]
-        genotypes = variant['genotypes'].values()
-        for i in range(max_samples_per_variant):
-            if i < len(genotypes):
-                row.append('{sampleId}:{numAlt}:{gq}:{ab}'.format(**genotypes[i]))
-            else:
-                row.append('')
-        rows.append(row)
-
-    header = [config['header'] for config in VARIANT_EXPORT_DATA]
-    for i in range(max_families_per_variant):
-        header += ['{}_{}'.format(config['header'], i+1) for config in VARIANT_FAMILY_EXPORT_DATA]
-    header += ['sample_{}:num_alt_alleles:gq:ab'.format(i+1) for i in range(max_samples_per_variant)]
-
-    file_format = request.GET.get('file_format', 'tsv')
-
-    return export_table('search_results_{}'.format(search_hash), header, rows, file_format, titlecase_header=False)
+            family_rows.append([_get_field_value(family_tags, config) for config in VARIANT_FAMILY_EXPORT_DATA])
+        genotype_row = [
+            '{sampleId}:{numAlt}:{gq}:{ab}'.format(**genotype) for genotype in variant['genotypes'].values()]
+        rows.append((row, family_rows, genotype_row))
+    return rows
 
 
 def _get_field_value(value, config):
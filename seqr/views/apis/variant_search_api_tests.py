@@ -2,9 +2,11 @@ import json
 import mock
 from copy import deepcopy
 
+from django.contrib.auth.models import Group
 from django.urls.base import reverse
+from guardian.shortcuts import remove_perm
 
-from seqr.models import VariantSearchResults, LocusList, Project
+from seqr.models import VariantSearchResults, LocusList, Project, Family, CAN_VIEW
 from seqr.utils.elasticsearch.utils import InvalidIndexException
 from seqr.views.apis.variant_search_api import query_variants_handler, query_single_variant_handler, \
     export_variants_handler, search_context_handler, get_saved_search_handler, create_saved_search_handler, \
@@ -48,9 +50,11 @@ class VariantSearchAPITest(AuthenticationTestCase):
     fixtures = ['users', '1kg_project', 'reference_data', 'variant_searches']
     multi_db = True
 
+    @mock.patch('seqr.views.apis.variant_search_api.cancel_es_variant_prefetches')
+    @mock.patch('seqr.views.apis.variant_search_api.prefetch_es_variants')
     @mock.patch('seqr.views.apis.variant_search_api.get_es_variant_gene_counts')
     @mock.patch('seqr.views.apis.variant_search_api.get_es_variants')
-    def test_query_variants(self, mock_get_variants, mock_get_gene_counts):
+    def test_query_variants(self, mock_get_variants, mock_get_gene_counts, mock_prefetch, mock_cancel_prefetch):
         url = reverse(query_variants_handler, args=['abc'])
         self.check_collaborator_login(url, request_data={'projectFamilies': PROJECT_FAMILIES})
         url = reverse(query_variants_handler, args=[SEARCH_HASH])
@@ -110,23 +114,52 @@ class VariantSearchAPITest(AuthenticationTestCase):
         )
 
         results_model = VariantSearchResults.objects.get(search_hash=SEARCH_HASH)
-        mock_get_variants.assert_called_with(results_model, sort='xpos', page=1, num_results=100)
+        mock_get_variants.assert_called_with(results_model, sort='xpos', page=1, num_results=100, parent_search_model=None)
+        mock_cancel_prefetch.assert_called_with(self.collaborator_user, SEARCH_HASH)
+        mock_prefetch.assert_called_with(results_model, self.collaborator_user, sort='xpos', page=None, num_results=100)
 
         # Test pagination
         response = self.client.get('{}?page=3'.format(url))
         self.assertEqual(response.status_code, 200)
-        mock_get_variants.assert_called_with(results_model, sort='xpos', page=3, num_results=100)
+        mock_get_variants.assert_called_with(results_model, sort='xpos', page=3, num_results=100, parent_search_model=None)
+
+        response = self.client.get('{}?page=1&per_page=2'.format(url))
+        self.assertEqual(response.status_code, 200)
+        mock_get_variants.assert_called_with(results_model, sort='xpos', page=1, num_results=2, parent_search_model=None)
+        mock_prefetch.assert_called_with(results_model, self.collaborator_user, sort='xpos', page=2, num_results=2)
 
         # Test sort
         response = self.client.get('{}?sort=consequence'.format(url))
         self.assertEqual(response.status_code, 200)
-        mock_get_variants.assert_called_with(results_model, sort='consequence', page=1, num_results=100)
+        mock_get_variants.assert_called_with(results_model, sort='consequence', page=1, num_results=100, parent_search_model=None)
+
+        # Test refining a parent search
+        refined_url = reverse(query_variants_handler, args=['refined_{}'.format(SEARCH_HASH)])
+        refined_search = dict(SEARCH, freqs={'gnomad_genomes': {'af': 0.001}})
+        response = self.client.post(refined_url, content_type='application/json', data=json.dumps({
+            'projectFamilies': PROJECT_FAMILIES, 'search': refined_search, 'parentSearchHash': SEARCH_HASH,
+        }))
+        self.assertEqual(response.status_code, 200)
+        refined_results_model = VariantSearchResults.objects.get(search_hash='refined_{}'.format(SEARCH_HASH))
+        mock_get_variants.assert_called_with(
+            refined_results_model, sort='xpos', page=1, num_results=100, parent_search_model=results_model)
+
+        # Test parent searches are only used if the user has access to their families
+        inaccessible_results_model = VariantSearchResults.objects.create(
+            variant_search=results_model.variant_search, search_hash='inaccessible_{}'.format(SEARCH_HASH))
+        inaccessible_results_model.families.set(Family.objects.filter(guid='F000011_11'))
+        remove_perm(CAN_VIEW, Group.objects.get(pk=3), Project.objects.get(guid='R0003_test'))
+        response = self.client.post(refined_url, content_type='application/json', data=json.dumps({
+            'projectFamilies': PROJECT_FAMILIES, 'search': refined_search,
+            'parentSearchHash': 'inaccessible_{}'.format(SEARCH_HASH),
+        }))
+        self.assertEqual(response.status_code, 403)
 
         # Test export
         export_url = reverse(export_variants_handler, args=[SEARCH_HASH])
         response = self.client.get(export_url)
         self.assertEqual(response.status_code, 200)
-        export_content = [row.split('\t') for row in response.content.rstrip('\n').split('\n')]
+        export_content = [row.split('\t') for row in b''.join(response.streaming_content).rstrip('\n').split('\n')]
         self.assertEqual(len(export_content), 4)
         self.assertListEqual(
             export_content[0],
@@ -144,7 +177,48 @@ class VariantSearchAPITest(AuthenticationTestCase):
             ['12', '48367227', 'TC', 'T', '', '', '', '', '', '', '', '', '', '', '', '', '', '', '', '', '', '', '',
              '', '2', 'Known gene for phenotype (None)|Review (None)', 'test n\xc3\xb8te (None)', '', '', '', '', ''])
 
-        mock_get_variants.assert_called_with(results_model, page=1, load_all=True)
+        mock_get_variants.assert_called_with(results_model, page=1, num_results=1000)
+
+        # Test export is loaded in pages
+        def _get_es_variants_page(results_model, page=1, num_results=100):
+            return deepcopy(VARIANTS[(page - 1) * num_results:page * num_results]), len(VARIANTS)
+        mock_get_variants.side_effect = _get_es_variants_page
+        mock_get_variants.reset_mock()
+        with mock.patch('seqr.views.apis.variant_search_api.EXPORT_PAGE_SIZE', 2):
+            response = self.client.get(export_url)
+            self.assertEqual(response.status_code, 200)
+            paged_export_content = [
+                row.split('\t') for row in b''.join(response.streaming_content).rstrip('\n').split('\n')]
+        self.assertListEqual(paged_export_content, export_content)
+        mock_get_variants.assert_has_calls([
+            mock.call(results_model, page=1, num_results=2), mock.call(results_model, page=2, num_results=2),
+        ])
+        self.assertEqual(mock_get_variants.call_count, 2)
+        mock_get_variants.side_effect = _get_es_variants
+
+        # Test export includes every family and genotype, even for variants loaded in later pages
+        paged_variants = deepcopy(VARIANTS)
+        paged_variants[2]['familyGuids'] += ['F000001_1', 'F000003_3']
+        paged_variants[2]['genotypes'] = {
+            sample_id: dict(paged_variants[1]['genotypes']['NA19679'], sampleId=sample_id)
+            for sample_id in ['NA19675', 'NA19678', 'NA19679']
+        }
+        mock_get_variants.side_effect = [(paged_variants[:2], len(VARIANTS)), (paged_variants[2:], len(VARIANTS))]
+        with mock.patch('seqr.views.apis.variant_search_api.EXPORT_PAGE_SIZE', 2):
+            response = self.client.get(export_url)
+            self.assertEqual(response.status_code, 200)
+            expanded_export_content = [
+                row.split('\t') for row in b''.join(response.streaming_content).rstrip('\n').split('\n')]
+        self.assertListEqual(expanded_export_content[0], export_content[0][:-2] + [
+            'family_id_3', 'tags_3', 'notes_3', 'sample_1:num_alt_alleles:gq:ab', 'sample_2:num_alt_alleles:gq:ab',
+            'sample_3:num_alt_alleles:gq:ab'])
+        self.assertListEqual([len(row) for row in expanded_export_content], [len(expanded_export_content[0])] * 4)
+        self.assertListEqual(expanded_export_content[1], export_content[1][:-2] + ['', '', ''] + export_content[1][-2:] + [''])
+        self.assertListEqual(expanded_export_content[3][24:33],
+            ['2', 'Known gene for phenotype (None)|Review (None)', 'test n\xc3\xb8te (None)', '1', '', '', '', '', ''])
+        self.assertListEqual(
+            sorted(expanded_export_content[3][-3:]), ['NA19675:0:99.0:0.0', 'NA19678:0:99.0:0.0', 'NA19679:0:99.0:0.0'])
+        mock_get_variants.side_effect = _get_es_variants
 
         # Test gene breakdown
         gene_counts = {
@@ -287,6 +361,37 @@ class VariantSearchAPITest(AuthenticationTestCase):
         self.assertTrue(PROJECT_GUID in response_json['projectsByGuid'])
         self.assertTrue('F000001_1' in response_json['familiesByGuid'])
 
+    @mock.patch('seqr.views.apis.variant_search_api.cancel_es_variant_prefetches')
+    @mock.patch('seqr.views.apis.variant_search_api.get_es_variants')
+    @mock.patch('seqr.views.apis.variant_search_api.get_es_variant_counts')
+    def test_query_variant_counts(self, mock_get_variant_counts, mock_get_variants, mock_cancel_prefetch):
+        url = '{}?count_only=true'.format(reverse(query_variants_handler, args=[SEARCH_HASH]))
+        self.check_collaborator_login(url, request_data={'projectFamilies': PROJECT_FAMILIES})
+
+        mock_get_variant_counts.side_effect = InvalidIndexException('Invalid index')
+        response = self.client.post(url, content_type='application/json', data=json.dumps({
+            'projectFamilies': PROJECT_FAMILIES, 'search': SEARCH
+        }))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.reason_phrase, 'Invalid index')
+
+        mock_get_variant_counts.side_effect = None
+        mock_get_variant_counts.return_value = {
+            'total': 7, 'families': {'F000001_1': 4, 'F000002_2': 5}, 'indices': {'test_index': 5, 'test_index_sv': 2},
+        }
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertDictEqual(response.json(), {'search': {
+            'search': {},
+            'projectFamilies': PROJECT_FAMILIES,
+            'totalResults': 7,
+            'familyCounts': {'F000001_1': 4, 'F000002_2': 5},
+            'indexCounts': {'test_index': 5, 'test_index_sv': 2},
+        }})
+        mock_get_variant_counts.assert_called_with(VariantSearchResults.objects.get(search_hash=SEARCH_HASH))
+        mock_get_variants.assert_not_called()
+        mock_cancel_prefetch.assert_not_called()
+
     @mock.patch('seqr.views.apis.variant_search_api.get_single_es_variant')
     def test_query_single_variant(self, mock_get_variant):
         mock_get_variant.return_value = VARIANTS[0]
@@ -1,10 +1,13 @@
 from collections import OrderedDict
+from io import BytesIO
+from itertools import chain, islice
 import json
 import openpyxl as xl
 from tempfile import NamedTemporaryFile
+from wsgiref.util import FileWrapper
 import zipfile
 
-from django.http.response import HttpResponse
+from django.http.response import HttpResponse, StreamingHttpResponse
 
 from seqr.views.utils.json_utils import _to_title_case
 
@@ -26,32 +29,20 @@ def export_table(filename_prefix, header, rows, file_format='tsv', titlecase_hea
         Django HttpResponse object with the table data as an attachment.
     """
     for i, row in enumerate(rows):
-        if len(header) != len(row):
-            raise ValueError('len(header) != len(row): %s != %s\n%s\n%s' % (len(header), len(row), header, row))
-        rows[i] = ['' if value is None else value for value in row]
+        rows[i] = _format_row(header, row)
 
     if file_format == "tsv":
         response = HttpResponse(content_type='text/tsv')
         response['Content-Disposition'] = 'attachment; filename="{}.tsv"'.format(filename_prefix)
-        response.writelines(['\t'.join(header)+'\n'])
-        response.writelines(('\t'.join(map(unicode, row))+'\n' for row in rows))
+        response.writelines(_tsv_lines(header, rows))
         return response
     elif file_format == "json":
         response = HttpResponse(content_type='application/json')
         response['Content-Disposition'] = 'attachment; filename="{}.json"'.format(filename_prefix)
-        for row in rows:
-            json_keys = map(lambda s: s.replace(" ", "_").lower(), header)
-            json_values = map(unicode, row)
-            response.write(json.dumps(OrderedDict(zip(json_keys, json_values)))+'\n')
+        response.writelines(_json_lines(header, rows))
         return response
     elif file_format == "xls":
-        wb = xl.Workbook(write_only=True)
-        ws = wb.create_sheet()
-        if titlecase_header:
-            header = map(_to_title_case, header)
-        ws.append(header)
-        for row in rows:
-            ws.append(row)
+        wb = _xls_workbook(header, rows, titlecase_header)
         with NamedTemporaryFile() as temporary_file:
             wb.save(temporary_file.name)
             temporary_file.seek(0)
@@ -62,6 +53,76 @@ def export_table(filename_prefix, header, rows, file_format='tsv', titlecase_hea
         raise ValueError("Invalid file_format: %s" % file_format)
 
 
+def export_streaming_table(filename_prefix, header, rows, file_format='tsv', titlecase_header=True):
+    """Generates a streaming HTTP response for a table with the given header and rows, exported into the given file_format.
+    Rows are written to the response as they are generated, so the full table is never held in memory. The first row is
+    validated before the response is created, so a table with the wrong number of columns raises an error rather than
+    sending a truncated file.
+
+    Args:
+        filename_prefix (string): Filename without the extension.
+        header (list): List of column names
+        rows (iterable): Iterable of rows, such as a generator, where each row is a list of column values
+        file_format (string): "tsv", "xls", or "json"
+    Returns:
+        Django StreamingHttpResponse object with the table data as an attachment.
+    """
+    rows = iter(rows)
+    first_rows = [_format_row(header, row) for row in islice(rows, 1)]
+    rows = chain(first_rows, (_format_row(header, row) for row in rows))
+
+    if file_format == "tsv":
+        response = StreamingHttpResponse(_tsv_lines(header, rows), content_type='text/tsv')
+        response['Content-Disposition'] = 'attachment; filename="{}.tsv"'.format(filename_prefix)
+        return response
+    elif file_format == "json":
+        response = StreamingHttpResponse(_json_lines(header, rows), content_type='application/json')
+        response['Content-Disposition'] = 'attachment; filename="{}.json"'.format(filename_prefix)
+        return response
+    elif file_format == "xls":
+        # The xlsx zip archive can only be written once all rows are added, so the compressed workbook is saved to an
+        # in-memory buffer and streamed back in chunks
+        wb = _xls_workbook(header, rows, titlecase_header)
+        workbook_file = BytesIO()
+        wb.save(workbook_file)
+        workbook_file.seek(0)
+        response = StreamingHttpResponse(FileWrapper(workbook_file), content_type="application/ms-excel")
+        response['Content-Disposition'] = 'attachment; filename="{}.xlsx"'.format(filename_prefix)
+        return response
+    else:
+        raise ValueError("Invalid file_format: %s" % file_format)
+
+
+def _format_row(header, row):
+    if len(header) != len(row):
+        raise ValueError('len(header) != len(row): %s != %s\n%s\n%s' % (len(header), len(row), header, row))
+    return ['' if value is None else value for value in row]
+
+
+def _tsv_lines(header, rows):
+    yield '\t'.join(header)+'\n'
+    for row in rows:
+        yield '\t'.join(map(unicode, row))+'\n'
+
+
+def _json_lines(header, rows):
+    json_keys = [s.replace(" ", "_").lower() for s in header]
+    for row in rows:
+        json_values = map(unicode, row)
+        yield json.dumps(OrderedDict(zip(json_keys, json_values)))+'\n'
+
+
+def _xls_workbook(header, rows, titlecase_header):
+    wb = xl.Workbook(write_only=True)
+    ws = wb.create_sheet()
+    if titlecase_header:
+        header = map(_to_title_case, header)
+    ws.append(header)
+    for row in rows:
+        ws.append(row)
+    return wb
+
+
 def export_multiple_files(files, zip_filename, file_format='csv', add_header_prefix=False, blank_value=''):
     if file_format not in DELIMITERS:
         raise ValueError('Invalid file_format: {}'.format(file_format))
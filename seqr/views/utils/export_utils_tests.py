@@ -6,7 +6,7 @@ from openpyxl import load_workbook
 from StringIO import StringIO
 import mock
 
-from seqr.views.utils.export_utils import export_table, export_multiple_files
+from seqr.views.utils.export_utils import export_table, export_streaming_table, export_multiple_files
 
 
 class ExportTableUtilsTest(TestCase):
@@ -39,6 +39,48 @@ class ExportTableUtilsTest(TestCase):
             lambda: export_table('test_file', header, rows, file_format='unknown_format')
         )
 
+    def test_export_streaming_table(self):
+        header = ['column1', 'column 2']
+        rows = [['row1_v1', 'row1_v2'], ['row2_v1', None]]
+
+        # test tsv format
+        response = export_streaming_table('test_file', header, (row for row in rows), file_format='tsv')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get('content-disposition'), 'attachment; filename="test_file.tsv"')
+        self.assertEqual(
+            b''.join(response.streaming_content), 'column1\tcolumn 2\nrow1_v1\trow1_v2\nrow2_v1\t\n')
+
+        # test json format
+        response = export_streaming_table('test_file', header, (row for row in rows), file_format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get('content-disposition'), 'attachment; filename="test_file.json"')
+        self.assertEqual(
+            b''.join(response.streaming_content),
+            '{"column1": "row1_v1", "column_2": "row1_v2"}\n{"column1": "row2_v1", "column_2": ""}\n')
+
+        # test Excel format
+        response = export_streaming_table('test_file', header, (row for row in rows), file_format='xls')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get('content-disposition'), 'attachment; filename="test_file.xlsx"')
+        wb = load_workbook(StringIO(b''.join(response.streaming_content)))
+        worksheet = wb.active
+
+        self.assertListEqual([cell.value for cell in worksheet['A']], ['Column1', 'row1_v1', 'row2_v1'])
+        self.assertListEqual([cell.value for cell in worksheet['B']], ['Column 2', 'row1_v2', None])
+
+        # test invalid rows
+        with self.assertRaises(ValueError):
+            export_streaming_table('test_file', header, (row for row in [['row1_v1']]), file_format='tsv')
+        response = export_streaming_table(
+            'test_file', header, (row for row in [rows[0], ['row2_v1']]), file_format='tsv')
+        with self.assertRaises(ValueError):
+            b''.join(response.streaming_content)
+
+        # test unknown format
+        self.assertRaisesRegexp(ValueError, '.*format.*',
+            lambda: export_streaming_table('test_file', header, (row for row in rows), file_format='unknown_format')
+        )
+
     @mock.patch('seqr.views.utils.export_utils.zipfile.ZipFile')
     def test_export_multiple_files(self, mock_zip):
         mock_zip_content = {}
@@ -5,6 +5,7 @@ APIs for retrieving, updating, creating, and deleting Individual records
 import logging
 
 from seqr.models import Sample, IgvSample, Individual
+from seqr.utils.elasticsearch.utils import invalidate_project_search_results
 from seqr.views.utils.pedigree_image_utils import update_pedigree_images
 
 logger = logging.getLogger(__name__)
@@ -36,6 +37,7 @@ def delete_individuals(project, individual_guids):
     families = {individual.family for individual in individuals_to_delete}
 
     individuals_to_delete.delete()
+    invalidate_project_search_results(project)
 
     update_pedigree_images(families)
 
@@ -3,10 +3,14 @@ from django.core.exceptions import PermissionDenied
 from django.utils import timezone
 
 from seqr.models import Individual
+from seqr.utils.elasticsearch.utils import invalidate_project_search_results
 from seqr.views.utils.json_utils import _to_snake_case
 
 logger = logging.getLogger(__name__)
 
+# Changes to these fields change the samples and inheritance used to search the individual's project
+INDIVIDUAL_SEARCH_FIELDS = ['family_id', 'affected', 'sex']
+
 
 def update_project_from_json(project, json, allow_unknown_keys=False):
 
@@ -37,6 +41,8 @@ def update_individual_from_json(individual, json, user=None, allow_unknown_keys=
     if json.get('displayName') and json['displayName'] == individual.individual_id:
         json['displayName'] = ''
 
+    search_field_values = [getattr(individual, field) for field in INDIVIDUAL_SEARCH_FIELDS]
+
     update_model_from_json(
         individual, json, user=user, allow_unknown_keys=allow_unknown_keys,
         immutable_keys=[
@@ -45,6 +51,9 @@ def update_individual_from_json(individual, json, user=None, allow_unknown_keys=
         ],
     )
 
+    if search_field_values != [getattr(individual, field) for field in INDIVIDUAL_SEARCH_FIELDS]:
+        invalidate_project_search_results(individual.family.project)
+
 
 def _parse_parent_field(json, individual, parent_key, parent_id_key):
     parent = getattr(individual, parent_key, None)
@@ -1,9 +1,8 @@
 import logging
-import redis
 
-from seqr.models import SavedVariant, VariantSearchResults
-from seqr.utils.elasticsearch.utils import get_es_variants_for_variant_ids
-from settings import REDIS_SERVICE_HOSTNAME
+from seqr.models import SavedVariant
+from seqr.utils.elasticsearch.utils import get_es_variants_for_variant_ids, get_project_search_results_index_key
+from seqr.utils.redis_utils import get_redis_client, delete_redis_indexed_keys
 
 logger = logging.getLogger(__name__)
 
@@ -39,17 +38,18 @@ def update_project_saved_variant_json(project, family_id=None):
 
 def reset_cached_search_results(project):
     try:
-        redis_client = redis.StrictRedis(host=REDIS_SERVICE_HOSTNAME, socket_connect_timeout=3)
-        keys_to_delete = []
+        redis_client = get_redis_client()
         if project:
-            result_guids = [res.guid for res in VariantSearchResults.objects.filter(families__project=project)]
-            for guid in result_guids:
-                keys_to_delete += redis_client.keys(pattern='search_results__{}*'.format(guid))
+            num_deleted = delete_redis_indexed_keys(
+                [get_project_search_results_index_key(project.guid)], redis_client=redis_client)
         else:
-            keys_to_delete = redis_client.keys(pattern='search_results__*')
-        if keys_to_delete:
-            redis_client.delete(*keys_to_delete)
-            logger.info('Reset {} cached results'.format(len(keys_to_delete)))
+            keys_to_delete = list(redis_client.scan_iter(match='search_results__*'))
+            index_keys = list(redis_client.scan_iter(match=get_project_search_results_index_key('*')))
+            if keys_to_delete or index_keys:
+                redis_client.delete(*(keys_to_delete + index_keys))
+            num_deleted = len(keys_to_delete)
+        if num_deleted:
+            logger.info('Reset {} cached results'.format(num_deleted))
         else:
             logger.info('No cached results to reset')
     except Exception as e:
@@ -253,6 +253,19 @@ ELASTICSEARCH_SERVICE_HOSTNAME = os.environ.get('ELASTICSEARCH_SERVICE_HOSTNAME'
 ELASTICSEARCH_SERVICE_PORT = os.environ.get('ELASTICSEARCH_SERVICE_PORT', '9200')
 ELASTICSEARCH_SERVER = '{host}:{port}'.format(
     host=ELASTICSEARCH_SERVICE_HOSTNAME, port=ELASTICSEARCH_SERVICE_PORT)
+ELASTICSEARCH_CONNECTION_POOL_SIZE = int(os.environ.get('ELASTICSEARCH_CONNECTION_POOL_SIZE', '10'))
+ELASTICSEARCH_KEEP_ALIVE = os.environ.get('ELASTICSEARCH_KEEP_ALIVE', 'true') == 'true'
+ELASTICSEARCH_SNIFF = os.environ.get('ELASTICSEARCH_SNIFF') == 'true'
+ELASTICSEARCH_SNIFFER_TIMEOUT = int(os.environ.get('ELASTICSEARCH_SNIFFER_TIMEOUT', '60'))
+# Max number of threads per process used to search each index of a multi-index search in parallel. If set to 0, all
+# indices are searched in a single multi-search request
+ELASTICSEARCH_SEARCH_THREADS = int(os.environ.get('ELASTICSEARCH_SEARCH_THREADS', '0'))
+ELASTICSEARCH_INDEX_SEARCH_TIMEOUT = int(os.environ.get('ELASTICSEARCH_INDEX_SEARCH_TIMEOUT', '60'))
+# Max number of threads per process used to load the next page of search results and the gene breakdown in the background
+# after each search request. If set to 0, results are not prefetched
+SEARCH_PREFETCH_THREADS = int(os.environ.get('SEARCH_PREFETCH_THREADS', '0'))
+# Max number of prefetches each user can have queued or running at once in each process
+SEARCH_PREFETCH_MAX_PER_USER = int(os.environ.get('SEARCH_PREFETCH_MAX_PER_USER', '2'))
 
 KIBANA_SERVER = '{host}:{port}'.format(
     host=os.environ.get('KIBANA_SERVICE_HOSTNAME', 'localhost'),
@@ -260,6 +273,15 @@ KIBANA_SERVER = '{host}:{port}'.format(
 )
 
 REDIS_SERVICE_HOSTNAME = os.environ.get('REDIS_SERVICE_HOSTNAME', 'localhost')
+# Expiry times in seconds for each type of cached value. Set to 0 to cache values without expiring them
+REDIS_SEARCH_RESULTS_TTL = int(os.environ.get('REDIS_SEARCH_RESULTS_TTL', '604800')) or None
+REDIS_INDEX_METADATA_TTL = int(os.environ.get('REDIS_INDEX_METADATA_TTL', '86400')) or None
+REDIS_INDEX_ALIAS_TTL = int(os.environ.get('REDIS_INDEX_ALIAS_TTL', '86400')) or None
+
+# Directory with the liftover chain files. Missing chain files are downloaded to this directory
+LIFTOVER_CHAIN_DIR = os.environ.get('LIFTOVER_CHAIN_DIR', os.path.join(os.path.expanduser('~'), '.pyliftover'))
+# Max number of recently lifted over coordinates kept in memory by each process, per genome version
+LIFTOVER_MEMO_SIZE = int(os.environ.get('LIFTOVER_MEMO_SIZE', '100000'))
 
 # Matchmaker
 MME_DEFAULT_CONTACT_NAME = 'Samantha Baxter'
@@ -25,6 +25,11 @@ from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
 application = DjangoWhiteNoise(application)
 
+# Load liftover chains up front, so the first searches do not have to wait for them. When the app is preloaded, forked
+# workers share the loaded chains
+from seqr.utils.liftover_utils import load_liftovers
+load_liftovers()
+
 # Apply WSGI middleware here.
 # from helloworld.wsgi import HelloWorldApplication
 # application = HelloWorldApplication(application)